@@ -14,6 +14,8 @@ from .manager import *
 from .email import *
 from .modifier import *
 from .sender import *
+from .spool import *
+from .outbox import *
 
 class meta():
   @property
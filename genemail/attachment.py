@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# lib:  genemail.attachment
+# auth: Philip J Grabner <grabner@cadit.com>
+# date: 2013/12/02
+# copy: (C) Copyright 2013 Cadit Health Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+'''
+Support for attachments whose content is not held in memory: the
+content is read from a file (memory-mapped, where possible) or an
+existing buffer and base64-encoded in chunks only when the message is
+serialized.
+'''
+
+from __future__ import absolute_import
+
+__all__ = ('AttachmentContent', 'LazyMimePart')
+
+import mmap, base64
+import email.MIMEBase
+
+#------------------------------------------------------------------------------
+class AttachmentContent(object):
+  '''
+  The content of a lazily-read attachment. Exactly one of the
+  following sources must be specified:
+
+  :Parameters:
+
+  path : str
+    the name of a file to read the content from; the file is opened
+    (and memory-mapped) each time the content is read.
+
+  file : file
+    an open file-like object; if it has a usable `fileno`, the entire
+    underlying file is memory-mapped, otherwise it is read from the
+    beginning with `seek` and `read`. The file is not closed.
+
+  buffer : { str, bytearray, buffer, mmap.mmap }
+    an object supporting `len` and slicing that holds the content.
+  '''
+
+  # note: a multiple of 57, so that each chunk base64-encodes into
+  #       complete 76-character lines
+  chunksize = 57 * 4096
+
+  #----------------------------------------------------------------------------
+  def __init__(self, path=None, file=None, buffer=None):
+    if len([src for src in (path, file, buffer) if src is not None]) != 1:
+      raise ValueError('exactly one of path, file or buffer is required')
+    self.path   = path
+    self.file   = file
+    self.buffer = buffer
+
+  #----------------------------------------------------------------------------
+  def _mapFile(self, fp):
+    try:
+      fileno = fp.fileno()
+    except (AttributeError, IOError, ValueError):
+      return None
+    try:
+      return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (mmap.error, ValueError):
+      # note: empty files cannot be mapped; neither can pipes etc.
+      return None
+
+  #----------------------------------------------------------------------------
+  def _iterBuffer(self, buf):
+    for idx in xrange(0, len(buf), self.chunksize):
+      yield str(buf[idx:idx + self.chunksize])
+
+  #----------------------------------------------------------------------------
+  def _iterFile(self, fp):
+    buf = self._mapFile(fp)
+    if buf is None:
+      fp.seek(0)
+      for chunk in iter(lambda: fp.read(self.chunksize), ''):
+        yield chunk
+      return
+    try:
+      for chunk in self._iterBuffer(buf):
+        yield chunk
+    finally:
+      buf.close()
+
+  #----------------------------------------------------------------------------
+  def iterChunks(self):
+    'Generates the raw content in chunks of (at most) `chunksize` bytes.'
+    if self.buffer is not None:
+      return self._iterBuffer(self.buffer)
+    if self.file is not None:
+      return self._iterFile(self.file)
+    return self._iterPath()
+
+  def _iterPath(self):
+    with open(self.path, 'rb') as fp:
+      for chunk in self._iterFile(fp):
+        yield chunk
+
+  #----------------------------------------------------------------------------
+  def iterBase64(self):
+    '''
+    Generates the base64-encoded content in chunks. The joined output
+    is identical to what :func:`email.encoders.encode_base64` produces
+    for the same content.
+    '''
+    last = None
+    for chunk in self.iterChunks():
+      if last is not None:
+        yield base64.encodestring(last)
+      last = chunk
+    if not last:
+      return
+    value = base64.encodestring(last)
+    # note: mimics `email.encoders._bencode`, which drops the trailing
+    #       newline unless the content itself ends with a newline
+    if last[-1] != '\n' and value[-1] == '\n':
+      value = value[:-1]
+    yield value
+
+  #----------------------------------------------------------------------------
+  def read(self):
+    'Returns the entire raw content as a string.'
+    return ''.join(self.iterChunks())
+
+#------------------------------------------------------------------------------
+class LazyMimePart(email.MIMEBase.MIMEBase):
+  '''
+  A base64-encoded MIME part whose payload is generated from an
+  :class:`AttachmentContent` on demand. :func:`genemail.util.streamMessage`
+  uses :meth:`iterPayload` to serialize the payload chunk by chunk;
+  anything else that calls :meth:`get_payload` (e.g. ``as_string`` or
+  the DKIM and PGP modifiers) gets the fully encoded payload.
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self, content, maintype, subtype, **params):
+    email.MIMEBase.MIMEBase.__init__(self, maintype, subtype, **params)
+    self['Content-Transfer-Encoding'] = 'base64'
+    self.content = content
+
+  #----------------------------------------------------------------------------
+  def iterPayload(self):
+    return self.content.iterBase64()
+
+  #----------------------------------------------------------------------------
+  def get_payload(self, i=None, decode=False):
+    if i is not None:
+      raise TypeError('Expected list, got %s' % type(self.content))
+    if decode:
+      return self.content.read()
+    return ''.join(self.iterPayload())
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
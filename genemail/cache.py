@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# lib:  genemail.cache
+# auth: Philip J Grabner <grabner@cadit.com>
+# date: 2013/12/02
+# copy: (C) Copyright 2013 Cadit Health Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+
+__all__ = ('LruCache', 'resetAfterFork')
+
+import time
+import weakref
+import threading
+from collections import OrderedDict
+
+#------------------------------------------------------------------------------
+# note: all LruCache instances, for :func:`resetAfterFork`
+_caches = weakref.WeakSet()
+
+#------------------------------------------------------------------------------
+class LruCache(object):
+  '''
+  A thread-safe, bounded, least-recently-used cache. The :meth:`get`
+  method follows the same "auto-caching" convention as the per-email
+  ``cache`` template parameter: if the key is not present, the default
+  value (or the result of calling it, if it is callable) is stored and
+  returned.
+
+  The :attr:`hits` and :attr:`misses` attributes count the lookups
+  that were and were not satisfied by the cache, respectively.
+
+  :Parameters:
+
+  maxsize : int, optional, default: 128
+    the maximum number of entries to hold; when exceeded, the least
+    recently used entries are evicted. If ``None``, the number of
+    entries is unbounded.
+
+  maxbytes : int, optional
+    the maximum total size of all entries, as measured by `sizeof`;
+    when exceeded, the least recently used entries are evicted. Note
+    that a single value larger than `maxbytes` is never retained.
+
+  sizeof : callable, optional, default: len
+    the function used to measure the size of each value for the
+    purposes of `maxbytes`.
+
+  ttl : float, optional
+    the default number of seconds after which entries expire; if
+    ``None``, entries do not expire. This can be overridden per entry
+    with the `ttl` parameter of :meth:`get` and :meth:`set`.
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self, maxsize=128, maxbytes=None, sizeof=None, ttl=None):
+    self.maxsize  = maxsize
+    self.maxbytes = maxbytes
+    self.sizeof   = sizeof or len
+    self.ttl      = ttl
+    self.hits     = 0
+    self.misses   = 0
+    self.bytes    = 0
+    self._data    = OrderedDict()
+    self._sizes   = dict()
+    self._expires = dict()
+    self._lock    = threading.RLock()
+    _caches.add(self)
+
+  #----------------------------------------------------------------------------
+  def get(self, key, default=None, ttl=None):
+    '''
+    Returns the value for `key`. If not present (or expired), the
+    `default` (or the result of calling it, if callable) is stored,
+    with an expiration of `ttl` seconds if specified, and returned.
+    '''
+    with self._lock:
+      if self._lookup(key):
+        self.hits += 1
+        return self._data[key]
+      self.misses += 1
+    # note: the default is evaluated outside of the lock so that slow
+    #       factories don't serialize all cache users
+    if callable(default):
+      default = default()
+    self.set(key, default, ttl=ttl)
+    return default
+
+  #----------------------------------------------------------------------------
+  def _lookup(self, key):
+    # returns whether `key` is present (and not expired), marking it
+    # as recently used if so; must be called with the lock held
+    if key not in self._data:
+      return False
+    expires = self._expires.get(key)
+    if expires is not None and expires <= time.time():
+      self._remove(key)
+      return False
+    self._data[key] = self._data.pop(key)
+    return True
+
+  #----------------------------------------------------------------------------
+  def set(self, key, value, ttl=None):
+    'Stores `value` for `key`, expiring after `ttl` (or :attr:`ttl`) seconds.'
+    if ttl is None:
+      ttl = self.ttl
+    with self._lock:
+      self._remove(key)
+      self._data[key] = value
+      if ttl is not None:
+        self._expires[key] = time.time() + ttl
+      if self.maxbytes is not None:
+        self._sizes[key] = self.sizeof(value)
+        self.bytes += self._sizes[key]
+      self._evict()
+
+  def __setitem__(self, key, value):
+    self.set(key, value)
+
+  #----------------------------------------------------------------------------
+  def _remove(self, key):
+    if key not in self._data:
+      return
+    del self._data[key]
+    self._expires.pop(key, None)
+    self.bytes -= self._sizes.pop(key, 0)
+
+  #----------------------------------------------------------------------------
+  def _evict(self):
+    while self._data and (
+        ( self.maxsize is not None and len(self._data) > self.maxsize )
+        or ( self.maxbytes is not None and self.bytes > self.maxbytes )):
+      self._remove(next(iter(self._data)))
+
+  #----------------------------------------------------------------------------
+  def __getitem__(self, key):
+    'Returns the value for `key` (marking it as recently used).'
+    with self._lock:
+      if not self._lookup(key):
+        self.misses += 1
+        raise KeyError(key)
+      self.hits += 1
+      return self._data[key]
+
+  def __delitem__(self, key):
+    with self._lock:
+      if key not in self._data:
+        raise KeyError(key)
+      self._remove(key)
+
+  def __contains__(self, key):
+    with self._lock:
+      if key not in self._data:
+        return False
+      expires = self._expires.get(key)
+      return expires is None or expires > time.time()
+
+  def __len__(self):
+    return len(self._data)
+
+  def keys(self):
+    with self._lock:
+      return list(self._data.keys())
+
+  #----------------------------------------------------------------------------
+  def clear(self):
+    'Removes all entries and resets the hit and miss counters.'
+    with self._lock:
+      self._data.clear()
+      self._sizes.clear()
+      self._expires.clear()
+      self.bytes  = 0
+      self.hits   = 0
+      self.misses = 0
+
+#------------------------------------------------------------------------------
+def resetAfterFork():
+  '''
+  Replaces the lock of, and empties, every :class:`LruCache`. This is
+  intended to be called in a child process right after ``fork()``:
+  another thread of the parent may have held a cache's lock (and been
+  in the middle of modifying the cache) at that moment, in which case
+  the child would otherwise deadlock on its first access.
+  '''
+  for cache in list(_caches):
+    cache._lock = threading.RLock()
+    cache.clear()
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
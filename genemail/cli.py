@@ -7,17 +7,180 @@
 # copy: (C) Copyright 2013 Cadit Health Inc., All Rights Reserved.
 #------------------------------------------------------------------------------
 
-import sys, argparse, yaml, os.path, getpass
+import sys, time, argparse, yaml, os.path, getpass, multiprocessing
 import templatealchemy as ta
 from templatealchemy import stream
-from . import manager, sender
+from . import manager, sender, spool, outbox
+
+#------------------------------------------------------------------------------
+def addSmtpOptions(cli):
+
+  cli.add_argument(
+    '--smtp-host', metavar='HOST',
+    default='localhost',
+    help='set the SMTP server hostname (default: %(default)r)')
+
+  cli.add_argument(
+    '--smtp-port', metavar='PORT',
+    default=25, type=int,
+    help='set the SMTP server port number (default: %(default)r)')
+
+  cli.add_argument(
+    '--smtp-ssl',
+    default=False, action='store_true',
+    help='enable SSL communication with the SMTP server')
+
+  cli.add_argument(
+    '--smtp-starttls',
+    default=False, action='store_true',
+    help='enable STARTTLS with the SMTP server')
+
+  cli.add_argument(
+    '--smtp-username', metavar='USERNAME',
+    help='set the SMTP username to authenticate as')
+
+  cli.add_argument(
+    '--smtp-password', metavar='PASSWORD',
+    help='set the SMTP password to authenticate with (if `--smtp-username`'
+    ' is specified, but not `--smtp-password` or the password is exactly'
+    ' "-", the password will be prompted for securely)')
+
+#------------------------------------------------------------------------------
+def makeSmtpSender(options):
+  if options.smtp_username and (
+    not options.smtp_password or options.smtp_password == '-' ):
+    options.smtp_password = getpass.getpass(prompt='SMTP Password: ')
+  return sender.SmtpSender(
+    host     = options.smtp_host,
+    port     = options.smtp_port,
+    ssl      = options.smtp_ssl,
+    starttls = options.smtp_starttls,
+    username = options.smtp_username,
+    password = options.smtp_password,
+    )
+
+#------------------------------------------------------------------------------
+def drain(args=None, output=None):
+
+  cli = argparse.ArgumentParser(
+    prog='genemail drain',
+    description='Delivers the messages in a `genemail` spool directory'
+    ' (as written by `genemail.SpoolSender`) or outbox database (as'
+    ' written by `genemail.OutboxSender`) via SMTP.'
+    )
+
+  cli.add_argument(
+    '-v', '--verbose',
+    action='count',
+    help='enable verbose output (multiple invocations increase verbosity)')
+
+  addSmtpOptions(cli)
+
+  cli.add_argument(
+    '-1', '--once',
+    action='store_true',
+    help='exit after delivering the currently spooled messages instead'
+    ' of polling the spool for new ones')
+
+  cli.add_argument(
+    '-i', '--interval', metavar='SECONDS',
+    default=5, type=float,
+    help='set the spool polling interval (default: %(default)r)')
+
+  cli.add_argument(
+    '-b', '--batch', metavar='COUNT',
+    default=100, type=int,
+    help='set the number of messages claimed at a time'
+    ' (default: %(default)r)')
+
+  cli.add_argument(
+    '--stale', metavar='SECONDS',
+    default=3600, type=float,
+    help='return messages that were claimed (but not delivered) more than'
+    ' this many seconds ago, e.g. by a crashed drain process, to the spool'
+    ' (default: %(default)r)')
+
+  cli.add_argument(
+    '-o', '--outbox',
+    action='store_true',
+    help='`SPOOL` is a SQLite outbox database (as written by'
+    ' `genemail.OutboxSender`) instead of a spool directory')
+
+  cli.add_argument(
+    '-P', '--processes', metavar='COUNT',
+    default=1, type=int,
+    help='set the number of concurrent delivery processes'
+    ' (default: %(default)r)')
+
+  cli.add_argument(
+    '--stats',
+    action='store_true',
+    help='don\'t deliver anything; just display the outbox statistics')
+
+  cli.add_argument(
+    'spool', metavar='SPOOL',
+    help='the spool directory or, with `--outbox`, the outbox database')
+
+  options = cli.parse_args(args)
+  output  = output or sys.stdout
+
+  if options.stats:
+    if not options.outbox:
+      cli.error('"--stats" requires "--outbox"')
+    stats = outbox.Outbox(options.spool).stats()
+    for key in ('depth', 'pending', 'sending', 'sent', 'failed'):
+      output.write('%s: %d\n' % (key, stats[key]))
+    if stats.oldest is not None:
+      output.write('oldest: %.0fs\n' % (stats.oldest,))
+    return 0
+
+  smtp = makeSmtpSender(options)
+
+  if options.processes <= 1:
+    return drainLoop(options, smtp, output)
+
+  # note: spool and outbox claims are atomic across processes
+  procs = [multiprocessing.Process(target=drainProcess,
+                                   args=(options, smtp, output))
+           for idx in range(options.processes)]
+  for proc in procs:
+    proc.start()
+  for proc in procs:
+    proc.join()
+  return max(proc.exitcode for proc in procs)
+
+#------------------------------------------------------------------------------
+def drainProcess(options, smtp, output):
+  sys.exit(drainLoop(options, smtp, output))
+
+#------------------------------------------------------------------------------
+def drainLoop(options, smtp, output):
+  if options.outbox:
+    msgs = outbox.Outbox(options.spool)
+  else:
+    msgs = spool.Spool(options.spool)
+  while True:
+    msgs.recover(options.stale)
+    res = msgs.drain(smtp, batch=options.batch)
+    if options.verbose:
+      output.write('sent: %d, failed: %d, deferred: %d\n'
+                   % (res.sent, res.failed, res.deferred))
+    if options.once:
+      return 0 if not res.failed else 1
+    time.sleep(options.interval)
 
 #------------------------------------------------------------------------------
 def main(args=None, output=None):
 
+  if args is None:
+    args = sys.argv[1:]
+  if args and args[0] == 'drain':
+    return drain(args[1:], output=output)
+
   cli = argparse.ArgumentParser(
     description='Command-line interface to the `genemail` email generation'
-    ' library.'
+    ' library. Use `genemail drain --help` for help on delivering spooled'
+    ' messages.'
     )
 
   cli.add_argument(
@@ -50,35 +213,7 @@ def main(args=None, output=None):
     default='mako',
     help='sets the TemplateAlchemy rendering driver (default: %(default)r)')
 
-  cli.add_argument(
-    '--smtp-host', metavar='HOST',
-    default='localhost',
-    help='set the SMTP server hostname (default: %(default)r)')
-
-  cli.add_argument(
-    '--smtp-port', metavar='PORT',
-    default=25, type=int,
-    help='set the SMTP server port number (default: %(default)r)')
-
-  cli.add_argument(
-    '--smtp-ssl',
-    default=False, action='store_true',
-    help='enable SSL communication with the SMTP server')
-
-  cli.add_argument(
-    '--smtp-starttls',
-    default=False, action='store_true',
-    help='enable STARTTLS with the SMTP server')
-
-  cli.add_argument(
-    '--smtp-username', metavar='USERNAME',
-    help='set the SMTP username to authenticate as')
-
-  cli.add_argument(
-    '--smtp-password', metavar='PASSWORD',
-    help='set the SMTP password to authenticate with (if `--smtp-username`'
-    ' is specified, but not `--smtp-password` or the password is exactly'
-    ' "-", the password will be prompted for securely)')
+  addSmtpOptions(cli)
 
   cli.add_argument(
     '-T', '--text',
@@ -144,18 +279,7 @@ def main(args=None, output=None):
     renderer = options.renderer,
     )
 
-  if options.smtp_username and (
-    not options.smtp_password or options.smtp_password == '-' ):
-    options.smtp_password = getpass.getpass(prompt='SMTP Password: ')
-
-  emlsender = sender.SmtpSender(
-    host     = options.smtp_host,
-    port     = options.smtp_port,
-    ssl      = options.smtp_ssl,
-    starttls = options.smtp_starttls,
-    username = options.smtp_username,
-    password = options.smtp_password,
-    )
+  emlsender = makeSmtpSender(options)
 
   emlman = manager.Manager(provider=template, sender=emlsender)
   eml    = emlman.newEmail(options.name)
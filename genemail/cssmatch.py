@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# lib:  genemail.cssmatch
+# auth: Philip J Grabner <grabner@cadit.com>
+# date: 2013/12/02
+# copy: (C) Copyright 2013 Cadit Health Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+'''
+CSS selector matching directly against ElementTree nodes. Selectors
+are parsed by `cssselect` and then compiled into matching functions
+with the signature ``match(element, document)``, where `document` is
+a :class:`DocumentIndex` of the tree that `element` belongs to.
+
+Element and attribute names are matched case-sensitively and without
+regard to namespace (i.e. the selector ``p`` matches both the ``p``
+and the ``{http://www.w3.org/1999/xhtml}p`` elements), which mirrors
+what cssselect's ``GenericTranslator`` does for XHTML documents.
+'''
+
+from __future__ import absolute_import
+
+import itertools
+
+import cssselect
+from cssselect.parser import parse_series
+from cssselect.xpath import ExpressionError
+
+#------------------------------------------------------------------------------
+# note: duplicated from genemail.util to avoid a circular import
+htmlns = 'http://www.w3.org/1999/xhtml'
+
+#------------------------------------------------------------------------------
+def localName(name):
+  'Returns `name` with any "{namespace}" prefix removed.'
+  if name[:1] == '{':
+    return name.split('}', 1)[1]
+  return name
+
+#------------------------------------------------------------------------------
+def getAttribute(element, name, default=None):
+  '''
+  Returns the value of attribute `name` of `element`, also checking
+  for an HTML-namespace-qualified version of the attribute (as
+  generated by :func:`genemail.util.serializeHtml`).
+  '''
+  ret = element.get(name)
+  if ret is None:
+    ret = element.get('{%s}%s' % (htmlns, name), default)
+  return ret
+
+#------------------------------------------------------------------------------
+class DocumentIndex(object):
+  '''
+  Collects, in a single pass over an ElementTree document, the
+  structural information (i.e. element parents and sibling positions)
+  needed to evaluate CSS combinators and structural pseudo-classes in
+  constant time, as well as an index of
+  all elements by tag name, id and class. The latter allows
+  :meth:`select` to only test a selector against the elements in the
+  bucket of its right-most compound selector (e.g. only elements with
+  class "note" for ``div > p.note``), much like browsers do.
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self, root):
+    self.root     = root
+    self.parents  = {}
+    self.children = {}
+    self.elements = []
+    self.buckets  = dict(tag={}, id={}, class_={})
+    self.position = {}
+    # note: the position of each element among its (element) siblings
+    #       and among its siblings of the same type, and the number of
+    #       children of each type per parent
+    self.sibpos   = {root: 0}
+    self.typepos  = {root: 0}
+    self.types    = {}
+    for node in root.iter():
+      if not isinstance(node.tag, basestring):
+        continue
+      self.position[node] = len(self.elements)
+      self.elements.append(node)
+      self.buckets['tag'].setdefault(localName(node.tag), []).append(node)
+      ident = getAttribute(node, 'id')
+      if ident is not None:
+        self.buckets['id'].setdefault(ident, []).append(node)
+      for name in (getAttribute(node, 'class') or '').split():
+        self.buckets['class_'].setdefault(name, []).append(node)
+      children = self.children[node] = []
+      types    = self.types[node] = {}
+      for child in node:
+        self.parents[child] = node
+        if isinstance(child.tag, basestring):
+          name = localName(child.tag)
+          self.sibpos[child]  = len(children)
+          self.typepos[child] = types.get(name, 0)
+          types[name] = self.typepos[child] + 1
+          children.append(child)
+
+  #----------------------------------------------------------------------------
+  def parent(self, element):
+    return self.parents.get(element)
+
+  #----------------------------------------------------------------------------
+  def siblings(self, element):
+    'Returns the list of elements that share `element`\'s parent.'
+    parent = self.parents.get(element)
+    if parent is None:
+      return [element]
+    return self.children[parent]
+
+  #----------------------------------------------------------------------------
+  def siblingIndex(self, element):
+    'Returns the (0-based) position of `element` among its siblings.'
+    return self.sibpos[element]
+
+  #----------------------------------------------------------------------------
+  def typeIndex(self, element):
+    '''
+    Returns the tuple (position, count) of `element` among its
+    siblings of the same type, where `position` is 0-based.
+    '''
+    parent = self.parents.get(element)
+    if parent is None:
+      return (0, 1)
+    return (self.typepos[element],
+            self.types[parent][localName(element.tag)])
+
+  #----------------------------------------------------------------------------
+  def candidates(self, matcher):
+    '''
+    Returns the elements, in document order, that `matcher` could
+    possibly match based on its `buckets` attribute (see
+    :func:`compileSelector`).
+    '''
+    buckets = getattr(matcher, 'buckets', None)
+    if buckets is None:
+      return self.elements
+    if len(buckets) == 1:
+      kind, key = buckets[0]
+      return self.buckets[kind].get(key, [])
+    ret = set()
+    for kind, key in buckets:
+      ret.update(self.buckets[kind].get(key, []))
+    return sorted(ret, key=self.position.get)
+
+  #----------------------------------------------------------------------------
+  def select(self, matcher, exclude=None):
+    '''
+    Returns all elements in the document matched by `matcher`,
+    skipping (without testing) any elements in the set `exclude`.
+    '''
+    if exclude:
+      return [el for el in self.candidates(matcher)
+              if el not in exclude and matcher(el, self)]
+    return [el for el in self.candidates(matcher) if matcher(el, self)]
+
+#------------------------------------------------------------------------------
+def compileSelector(css):
+  '''
+  Compiles the CSS *group of selectors* `css` into a matching
+  function; see the module documentation for the function signature.
+
+  :raises:
+    cssselect.SelectorSyntaxError on invalid selectors and
+    cssselect.ExpressionError on unsupported selectors (including
+    pseudo-elements).
+  '''
+  matchers = []
+  buckets  = []
+  for selector in cssselect.parse(css):
+    if selector.pseudo_element:
+      raise ExpressionError('Pseudo-elements are not supported.')
+    matchers.append(_compile(selector.parsed_tree))
+    if buckets is not None:
+      bucket = _bucket(selector.parsed_tree)
+      buckets = None if bucket is None else buckets + [bucket]
+  if len(matchers) == 1:
+    ret = matchers[0]
+  else:
+    ret = lambda el, doc: any(match(el, doc) for match in matchers)
+  ret.buckets = buckets
+  return ret
+
+#------------------------------------------------------------------------------
+def _bucket(tree):
+  '''
+  Returns the most selective (kind, key) DocumentIndex bucket that all
+  elements matched by the parsed selector `tree` must be in, based on
+  its right-most compound selector, or ``None`` if there is no such
+  bucket (e.g. for ``*`` or ``[href]``).
+  '''
+  if isinstance(tree, cssselect.parser.CombinedSelector):
+    tree = tree.subselector
+  found = dict()
+  while tree is not None:
+    kind = type(tree).__name__
+    if kind == 'Hash':
+      found.setdefault('id', tree.id)
+    elif kind == 'Class':
+      found.setdefault('class_', tree.class_name)
+    elif kind == 'Element' and tree.element and tree.element != '*':
+      found.setdefault('tag', tree.element)
+    # note: Negation.subselector is intentionally not traversed
+    tree = getattr(tree, 'selector', None)
+  for kind in ('id', 'class_', 'tag'):
+    if kind in found:
+      return (kind, found[kind])
+  return None
+
+#------------------------------------------------------------------------------
+def _compile(tree):
+  method = globals().get('_compile_' + type(tree).__name__.lower())
+  if method is None:
+    raise ExpressionError('%s is not supported.' % (type(tree).__name__,))
+  return method(tree)
+
+#------------------------------------------------------------------------------
+def _compile_element(tree):
+  if not tree.element or tree.element == '*':
+    return lambda el, doc: True
+  name = tree.element
+  return lambda el, doc: localName(el.tag) == name
+
+#------------------------------------------------------------------------------
+def _compile_hash(tree):
+  base = _compile(tree.selector)
+  ident = tree.id
+  return lambda el, doc: getAttribute(el, 'id') == ident and base(el, doc)
+
+#------------------------------------------------------------------------------
+def _compile_class(tree):
+  base = _compile(tree.selector)
+  name = tree.class_name
+  def match(el, doc):
+    return name in (getAttribute(el, 'class') or '').split() and base(el, doc)
+  return match
+
+#------------------------------------------------------------------------------
+attribute_operators = {
+  'exists' : lambda val, chk: True,
+  '='      : lambda val, chk: val == chk,
+  '!='     : lambda val, chk: val != chk,
+  '~='     : lambda val, chk: chk in val.split(),
+  '|='     : lambda val, chk: val == chk or val.startswith(chk + '-'),
+  '^='     : lambda val, chk: bool(chk) and val.startswith(chk),
+  '$='     : lambda val, chk: bool(chk) and val.endswith(chk),
+  '*='     : lambda val, chk: bool(chk) and chk in val,
+}
+
+def _compile_attrib(tree):
+  base = _compile(tree.selector)
+  name = tree.attrib
+  oper = attribute_operators.get(tree.operator)
+  if oper is None:
+    raise ExpressionError('attribute operator %r is not supported.'
+                          % (tree.operator,))
+  # note: cssselect >= 1.0 uses tokens for values, earlier uses strings
+  value = getattr(tree.value, 'value', tree.value)
+  def match(el, doc):
+    val = getAttribute(el, name)
+    if val is None:
+      return tree.operator == '!=' and base(el, doc)
+    return oper(val, value) and base(el, doc)
+  return match
+
+#------------------------------------------------------------------------------
+def _compile_negation(tree):
+  base = _compile(tree.selector)
+  sub  = _compile(tree.subselector)
+  return lambda el, doc: not sub(el, doc) and base(el, doc)
+
+#------------------------------------------------------------------------------
+def _compile_combinedselector(tree):
+  left  = _compile(tree.selector)
+  right = _compile(tree.subselector)
+  if tree.combinator == ' ':
+    def match(el, doc):
+      if not right(el, doc):
+        return False
+      el = doc.parent(el)
+      while el is not None:
+        if left(el, doc):
+          return True
+        el = doc.parent(el)
+      return False
+    return match
+  if tree.combinator == '>':
+    def match(el, doc):
+      if not right(el, doc):
+        return False
+      parent = doc.parent(el)
+      return parent is not None and left(parent, doc)
+    return match
+  if tree.combinator == '+':
+    def match(el, doc):
+      if not right(el, doc):
+        return False
+      idx = doc.siblingIndex(el)
+      return idx > 0 and left(doc.siblings(el)[idx - 1], doc)
+    return match
+  if tree.combinator == '~':
+    def match(el, doc):
+      if not right(el, doc):
+        return False
+      return any(left(sib, doc) for sib in itertools.islice(
+        doc.siblings(el), doc.siblingIndex(el)))
+    return match
+  raise ExpressionError('combinator %r is not supported.' % (tree.combinator,))
+
+#------------------------------------------------------------------------------
+def _lastOfType(el, doc):
+  pos, count = doc.typeIndex(el)
+  return pos == count - 1
+
+def _never(el, doc):
+  return False
+
+pseudo_classes = {
+  'root'          : lambda el, doc: doc.parent(el) is None,
+  'first-child'   : lambda el, doc: doc.siblings(el)[0] is el,
+  'last-child'    : lambda el, doc: doc.siblings(el)[-1] is el,
+  'only-child'    : lambda el, doc: len(doc.siblings(el)) == 1,
+  'first-of-type' : lambda el, doc: doc.typeIndex(el)[0] == 0,
+  'last-of-type'  : _lastOfType,
+  'only-of-type'  : lambda el, doc: doc.typeIndex(el)[1] == 1,
+  'empty'         : lambda el, doc: len(el) == 0 and not el.text,
+  # dynamic and UI-state pseudo-classes never match in an email
+  'link'          : _never,
+  'visited'       : _never,
+  'hover'         : _never,
+  'active'        : _never,
+  'focus'         : _never,
+  'target'        : _never,
+  'enabled'       : _never,
+  'disabled'      : _never,
+  'checked'       : _never,
+}
+
+def _compile_pseudo(tree):
+  base = _compile(tree.selector)
+  test = pseudo_classes.get(tree.ident)
+  if test is None:
+    raise ExpressionError('The pseudo-class :%s is unknown' % (tree.ident,))
+  return lambda el, doc: base(el, doc) and test(el, doc)
+
+#------------------------------------------------------------------------------
+def _nth(a, b, pos):
+  # `pos` is 1-based; matches if pos == a*n + b for some n >= 0
+  if a == 0:
+    return pos == b
+  return (pos - b) % a == 0 and (pos - b) / a >= 0
+
+def _childIndex(el, doc):
+  return (doc.siblingIndex(el), len(doc.siblings(el)))
+
+# each maps an element to its (0-based position, count) and whether
+# the position is counted from the end
+pseudo_functions = {
+  'nth-child'        : (_childIndex, False),
+  'nth-last-child'   : (_childIndex, True),
+  'nth-of-type'      : (lambda el, doc: doc.typeIndex(el), False),
+  'nth-last-of-type' : (lambda el, doc: doc.typeIndex(el), True),
+}
+
+def _argument(tree):
+  # note: cssselect >= 1.0 uses tokens for arguments, earlier uses strings
+  args = tree.arguments
+  if len(args) != 1 \
+      or getattr(args[0], 'type', 'STRING') not in ('STRING', 'IDENT'):
+    raise ExpressionError('Expected a single string or ident for :%s(), got %r'
+                          % (tree.name, args))
+  return getattr(args[0], 'value', args[0])
+
+def _contains(value):
+  return lambda el, doc: value in ''.join(el.itertext())
+
+def _lang(value):
+  # note: like XPath's lang(), but also honors the HTML `lang` attribute
+  value = value.lower()
+  def match(el, doc):
+    while el is not None:
+      lang = el.get('{http://www.w3.org/XML/1998/namespace}lang')
+      if lang is None:
+        lang = getAttribute(el, 'lang')
+      if lang is not None:
+        lang = lang.lower()
+        return lang == value or lang.startswith(value + '-')
+      el = doc.parent(el)
+    return False
+  return match
+
+# each maps the (string) argument to a test function
+argument_functions = {
+  'contains' : _contains,
+  'lang'     : _lang,
+}
+
+def _compile_function(tree):
+  base = _compile(tree.selector)
+  factory = argument_functions.get(tree.name)
+  if factory is not None:
+    test = factory(_argument(tree))
+    return lambda el, doc: base(el, doc) and test(el, doc)
+  group = pseudo_functions.get(tree.name)
+  if group is None:
+    raise ExpressionError('The pseudo-class :%s() is unknown' % (tree.name,))
+  try:
+    a, b = parse_series(tree.arguments)
+  except ValueError:
+    raise ExpressionError('Invalid series: %r' % (tree.arguments,))
+  index, last = group
+  def match(el, doc):
+    if not base(el, doc):
+      return False
+    pos, count = index(el, doc)
+    pos = count - pos if last else pos + 1
+    return _nth(a, b, pos)
+  return match
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
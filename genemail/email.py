@@ -10,18 +10,23 @@
 from __future__ import absolute_import
 
 import re
+import ast
 import copy
 import base64
+import hashlib
 import mimetypes
 import xml.etree.ElementTree as ET
 import html2text
 from templatealchemy.util import adict
 import email.Encoders, email.Message, email.MIMEMultipart, email.MIMEText
-import email.MIMEImage, email.Utils
+import email.MIMEImage, email.MIMEAudio, email.MIMEBase, email.Utils
 import uuid
 
 from . import util
 from .idict import idict
+from .cache import LruCache
+from .attachment import AttachmentContent, LazyMimePart
+from .future import Future
 
 #------------------------------------------------------------------------------
 __all__ = ('Email',)
@@ -39,6 +44,475 @@ class AutoCachingDict(dict):
     self[key] = default
     return default
 
+#------------------------------------------------------------------------------
+def _paramsKey(params):
+  'Returns a hashable key for dict `params`, or ``None`` if not possible.'
+  try:
+    key = tuple(sorted((params or {}).items()))
+    hash(key)
+    return key
+  except TypeError:
+    return None
+
+#------------------------------------------------------------------------------
+# the following containers increment their `generation` attribute
+# whenever they are modified so that an Email can detect when its
+# render cache has gone stale (see :meth:`Email._getRenderCache`),
+# and refuse modification once `frozen` (see :meth:`Email.freeze`).
+#------------------------------------------------------------------------------
+def _tracked(base, name):
+  meth = getattr(base, name)
+  def method(self, *args, **kw):
+    if self.frozen:
+      raise TypeError('cannot modify a frozen Email prototype; use clone()')
+    ret = meth(self, *args, **kw)
+    self.generation += 1
+    return ret
+  method.__name__ = name
+  return method
+
+class TrackingDict(dict):
+  generation  = 0
+  frozen      = False
+  __setitem__ = _tracked(dict, '__setitem__')
+  __delitem__ = _tracked(dict, '__delitem__')
+  update      = _tracked(dict, 'update')
+  setdefault  = _tracked(dict, 'setdefault')
+  pop         = _tracked(dict, 'pop')
+  popitem     = _tracked(dict, 'popitem')
+  clear       = _tracked(dict, 'clear')
+
+class TrackingIdict(idict):
+  generation  = 0
+  frozen      = False
+  __setitem__ = _tracked(idict, '__setitem__')
+  __delitem__ = _tracked(idict, '__delitem__')
+
+class TrackingList(list):
+  generation   = 0
+  frozen       = False
+  __setitem__  = _tracked(list, '__setitem__')
+  __delitem__  = _tracked(list, '__delitem__')
+  __setslice__ = _tracked(list, '__setslice__')
+  __delslice__ = _tracked(list, '__delslice__')
+  __iadd__     = _tracked(list, '__iadd__')
+  append       = _tracked(list, 'append')
+  extend       = _tracked(list, 'extend')
+  insert       = _tracked(list, 'insert')
+  remove       = _tracked(list, 'remove')
+  pop          = _tracked(list, 'pop')
+  sort         = _tracked(list, 'sort')
+  reverse      = _tracked(list, 'reverse')
+
+#------------------------------------------------------------------------------
+def scanTemplateXml(xdoc):
+  '''
+  Walks the parsed template `xdoc` exactly once and collects all of
+  the genemail-specific nodes into a "template manifest" with the
+  following attributes:
+
+  * `headers`:     an idict of headers set by ``email:header`` elements
+                   and attributes.
+  * `subject`:     a list of the text content of ``email:subject``
+                   elements and ``email:subject="content"`` attributes.
+  * `attachments`: a list of adicts (name, contentType, value, cid) as
+                   declared by ``email:attachment`` elements, with
+                   base64-encoded values already decoded.
+  * `styles`:      a list of the ``<head><style type="text/css">``
+                   contents.
+
+  If `xdoc` is None, an empty manifest is returned.
+  '''
+  ret = adict(headers=idict(), subject=[], attachments=[], styles=[])
+  if xdoc is None:
+    return ret
+  hdrtag  = '{%s}header' % (xmlns,)
+  subjtag = '{%s}subject' % (xmlns,)
+  atttag  = '{%s}attachment' % (xmlns,)
+  headtag = '{%s}head' % (htmlns,)
+  styltag = '{%s}style' % (htmlns,)
+  def scan(node, parent, depth):
+    if node.tag == hdrtag:
+      ret.headers[node.get('name')] = node.get('value') or node.text
+    elif node.get(hdrtag) is not None:
+      ret.headers[node.get(hdrtag)] = node.text
+    if node.tag == subjtag or node.get(subjtag) == 'content':
+      ret.subject.append(node.text)
+    if node.tag == atttag:
+      att = adict(
+        name        = node.get('name'),
+        contentType = node.get('content-type', None),
+        value       = node.get('value', None) or node.text,
+        cid         = node.get('cid', 'false').lower() == 'true',
+      )
+      if node.get('encoding', None) == 'base64':
+        att.value = base64.b64decode(att.value)
+      ret.attachments.append(att)
+    if depth == 2 and node.tag == styltag and parent.tag == headtag \
+        and node.get('type') == 'text/css':
+      ret.styles.append(node.text)
+    for child in node:
+      scan(child, node, depth + 1)
+  scan(xdoc, None, 0)
+  return ret
+
+#------------------------------------------------------------------------------
+# the encoded MIME attachment parts, keyed by content hash, so that
+# static attachments (such as logos) are only encoded once per process
+attachmentCache = LruCache(
+  maxsize=None, maxbytes=32 * 1024 * 1024, sizeof=lambda entry: len(entry[1]))
+
+def makeMimeAttachment(att):
+  '''
+  Returns a new MIME part for the attachment `att` (an adict with the
+  attributes `name`, `value`, `contentType` and `cid`). The headers
+  and encoded payload are cached in the module-level `attachmentCache`
+  keyed by a hash of the content (and the other attributes), so that
+  identical attachments are only encoded once; a fresh MIME part
+  object is returned each time since the parts get attached to (and
+  possibly modified within) different messages.
+  '''
+  value = att.value
+  if isinstance(value, AttachmentContent):
+    return _makeLazyMimeAttachment(att)
+  data  = value.encode('utf-8') if isinstance(value, unicode) else value
+  key   = (hashlib.sha1(data).hexdigest(), isinstance(value, unicode),
+           att.name, att.contentType, bool(att.cid))
+  headers, payload = attachmentCache.get(
+    key, lambda: _encodeMimeAttachment(att))
+  ret = email.Message.Message()
+  for name, val in headers:
+    ret[name] = val
+  ret.set_payload(payload)
+  return ret
+
+def _encodeMimeAttachment(att):
+  maintype, subtype = (att.contentType or 'application/octet-stream').split('/', 1)
+  if maintype == 'text':
+    # note: we should handle calculating the charset
+    matt = email.MIMEText.MIMEText(att.value, _subtype=subtype)
+  elif maintype == 'image':
+    matt = email.MIMEImage.MIMEImage(att.value, _subtype=subtype, name=att.name)
+  elif maintype == 'audio':
+    matt = email.MIMEAudio.MIMEAudio(att.value, _subtype=subtype)
+  else:
+    matt = email.MIMEBase.MIMEBase(maintype, subtype)
+    matt.set_payload(att.value)
+    email.Encoders.encode_base64(matt)
+  if att.cid:
+    matt.add_header('Content-Disposition', 'attachment')
+    matt.add_header('Content-ID', '<' + att.name + '>')
+  else:
+    matt.add_header('Content-Disposition', 'attachment', filename=att.name)
+  return (matt.items(), matt.get_payload())
+
+def _makeLazyMimeAttachment(att):
+  # note: file-backed attachments are not cached (that would require
+  #       reading them) and are always base64-encoded
+  maintype, subtype = (att.contentType or 'application/octet-stream').split('/', 1)
+  if maintype in ('multipart', 'message'):
+    return makeMimeAttachment(adict(att, value=att.value.read()))
+  params = dict(name=att.name) if maintype == 'image' else dict()
+  matt = LazyMimePart(att.value, maintype, subtype, **params)
+  if att.cid:
+    matt.add_header('Content-Disposition', 'attachment')
+    matt.add_header('Content-ID', '<' + att.name + '>')
+  else:
+    matt.add_header('Content-Disposition', 'attachment', filename=att.name)
+  return matt
+
+#------------------------------------------------------------------------------
+# the compiled `Email.structure` specs, keyed by a frozen copy of the spec
+structureCache = LruCache(maxsize=64)
+
+def compileStructure(structure):
+  '''
+  Compiles the email `structure` spec (see ``Email.DEFAULTS``) into a
+  tree of :class:`StructureNode` objects. Component strings such as
+  ``'mime:related; type="text/html"'`` are parsed (with keyword values
+  evaluated as Python literals) only once per distinct spec: compiled
+  trees are cached in the module-level `structureCache`.
+  '''
+  try:
+    key = _structureKey(structure)
+    hash(key)
+  except TypeError:
+    return _compileStructure(structure)
+  return structureCache.get(key, lambda: _compileStructure(structure))
+
+def _structureKey(spec):
+  if isinstance(spec, dict):
+    return ('{',) + tuple(sorted(
+      (key, _structureKey(val)) for key, val in spec.items()))
+  if isinstance(spec, (list, tuple)):
+    return ('[',) + tuple(_structureKey(item) for item in spec)
+  return spec
+
+def _compileStructure(spec):
+  kls, children = spec, None
+  if isinstance(spec, dict) and len(spec) == 1:
+    kls, children = spec.items()[0]
+  if not isinstance(kls, basestring) or ':' not in kls:
+    raise SyntaxError('unsupported email structure component: %r' % (spec,))
+  kls, comp = kls.split(':', 1)
+  kw = dict()
+  if ';' in comp:
+    comp, kw = comp.split(';', 1)
+    kw = [pairs.strip().split('=', 1) for pairs in kw.strip().split(',')]
+    kw = {k: ast.literal_eval(v) for k, v in kw}
+  factory = structureComponents.get((kls, comp))
+  if factory is None:
+    raise SyntaxError('unsupported email structure component: %r' % (spec,))
+  if kls == 'mime':
+    if isinstance(children, basestring):
+      children = [children]
+    children = [_compileStructure(child) for child in children or []]
+  return StructureNode(factory, kw, children)
+
+#------------------------------------------------------------------------------
+class StructureNode(object):
+  '''
+  A compiled email structure component: calling :meth:`build` invokes
+  the component's factory with the email being built, the per-build
+  `state` (an adict with `atts`, `bndidx` and `include` attributes),
+  the compiled child nodes and the keyword parameters from the spec.
+  '''
+  def __init__(self, factory, kw, children):
+    self.factory  = factory
+    self.kw       = kw
+    self.children = children
+  def build(self, eml, state):
+    return self.factory(eml, state, self.children, **self.kw)
+
+def _make_email_text(eml, state, children):
+  if state.include and 'text' not in state.include:
+    return None
+  txtenc  = eml.textEncoding or eml.transferEncoding or eml.encoding
+  src = eml.getText()
+  return email.MIMEText.MIMEText(
+    src, 'plain', txtenc or util.selectCharset(src))
+
+def _make_email_html(eml, state, children):
+  if state.include and 'html' not in state.include:
+    return None
+  htmlenc = eml.htmlEncoding or eml.transferEncoding or eml.encoding
+  src = eml.getHtml()
+  return email.MIMEText.MIMEText(
+    src, 'html', htmlenc or util.selectCharset(src))
+
+def _make_email_attachments(eml, state, children, cid=False):
+  if state.include and 'attachments' not in state.include:
+    return None
+  if state.atts is None:
+    state.atts = eml.getAttachments()
+  return [att for att in state.atts if att.cid == cid]
+
+def _make_boundary(eml, state, type):
+  if not eml.boundary:
+    return None
+  state.bndidx += 1
+  return '==%s-%s-%i==' % (eml.boundary, type, state.bndidx)
+
+def _extend(eml, state, comp, children):
+  for child in children:
+    item = child.build(eml, state)
+    if not item:
+      continue
+    if isinstance(comp, list):
+      if isinstance(item, list):
+        comp.extend(item)
+      else:
+        comp.append(item)
+    else:
+      if isinstance(item, list):
+        for cur in item:
+          comp.attach(cur)
+      else:
+        comp.attach(item)
+  return comp
+
+def _checkMinimalMime(eml, comp):
+  if eml.minimalMime:
+    load = comp.get_payload()
+    if not isinstance(load, basestring) \
+        and len(load) == 1:
+      return load[0]
+  return comp
+
+def _make_multipart(subtype, bndtype):
+  # note: `optimize` is accepted for compatibility but, as before,
+  #       only `Email.minimalMime` controls the collapsing of parts
+  # TODO: do something with `type`...
+  def make(eml, state, children, type=None, optimize=None):
+    comp = email.MIMEMultipart.MIMEMultipart(
+      subtype, boundary=_make_boundary(eml, state, bndtype))
+    return _checkMinimalMime(eml, _extend(eml, state, comp, children))
+  return make
+
+def _make_mime_attachments(eml, state, children):
+  if state.include and 'attachments' not in state.include:
+    return None
+  atts = _extend(eml, state, [], children)
+  if not atts:
+    return None
+  return [makeMimeAttachment(att) for att in atts]
+
+structureComponents = {
+  ('email', 'text')        : _make_email_text,
+  ('email', 'html')        : _make_email_html,
+  ('email', 'attachments') : _make_email_attachments,
+  ('mime', 'mixed')        : _make_multipart('mixed', 'mix'),
+  ('mime', 'alternative')  : _make_multipart('alternative', 'alt'),
+  ('mime', 'related')      : _make_multipart('related', 'rel'),
+  ('mime', 'attachments')  : _make_mime_attachments,
+}
+
+#------------------------------------------------------------------------------
+# the style-inlined content of ``email:cache`` template regions, keyed
+# by (template URI, declared key, genemail_format, stylesheet hash,
+# region markup hash) -- see :class:`_FragmentRegions`
+fragmentCache = LruCache(maxsize=256)
+
+def _unwrap(parent, node):
+  '''
+  Replaces the element `node` within `parent` by its content (i.e. its
+  text and children) and returns the list of (former) children.
+  '''
+  idx      = list(parent).index(node)
+  children = list(node)
+  def addText(pos, text):
+    if not text:
+      return
+    if pos == 0:
+      parent.text = (parent.text or '') + text
+    else:
+      parent[pos - 1].tail = (parent[pos - 1].tail or '') + text
+  parent.remove(node)
+  addText(idx, node.text)
+  for off, child in enumerate(children):
+    parent.insert(idx + off, child)
+  addText(idx + len(children), node.tail)
+  return children
+
+class _FragmentRegions(object):
+  '''
+  Manages the ``email:cache`` regions of one HTML rendering: regions
+  found in the `fragmentCache` have their content replaced by the
+  cached, already style-inlined content, which is then excluded from
+  CSS inlining; the content of all other regions is added to the
+  cache once inlined. The cache key includes a hash of the rendered
+  region markup, so a region is never replaced with stale content --
+  the declared key only asserts that the region's styling does not
+  depend on anything outside of the region.
+  '''
+
+  def __init__(self, uri, fmt, style):
+    if isinstance(style, unicode):
+      style = style.encode('utf-8')
+    self.prefix  = (uri, fmt, hashlib.sha1(style).hexdigest())
+    self.regions = []
+
+  def add(self, parent, node):
+    # note: nested regions are simply unwrapped along with their parent
+    for other in self.regions:
+      if node in other.node.iter():
+        return
+    tail, node.tail = node.tail, None
+    digest = hashlib.sha1(ET.tostring(node, encoding='utf-8')).hexdigest()
+    node.tail = tail
+    self.regions.append(adict(
+      parent=parent, node=node, key=self.prefix + (node.get('key'), digest)))
+
+  def apply(self):
+    'Unwraps all regions and returns the set of elements already styled.'
+    exclude = set()
+    cachetag = '{%s}cache' % (xmlns,)
+    for region in self.regions:
+      try:
+        text, content = fragmentCache[region.key]
+      except KeyError:
+        region.hit = False
+      else:
+        region.hit = True
+        region.node.text = text
+        del region.node[:]
+        region.node.extend(copy.deepcopy(content))
+        for child in region.node:
+          exclude.update(child.iter())
+      # unwrap any nested regions (deepest first)
+      for parent in reversed(list(region.node.iter())):
+        for node in list(parent):
+          if node.tag == cachetag:
+            _unwrap(parent, node)
+      region.text = region.node.text
+      region.lastTail = region.node[-1].tail if len(region.node) else None
+      region.content = _unwrap(region.parent, region.node)
+    return exclude
+
+  def store(self):
+    'Adds the (now styled) content of all cache misses to the cache.'
+    for region in self.regions:
+      if region.hit:
+        continue
+      content = copy.deepcopy(region.content)
+      if content:
+        content[-1].tail = region.lastTail
+      fragmentCache[region.key] = (region.text, content)
+
+#------------------------------------------------------------------------------
+def _smtpString(msg):
+  ret = msg.as_string()
+  if not ret.endswith('\n'):
+    ret += '\n'
+  return ret
+
+#------------------------------------------------------------------------------
+def streamSmtpData(msg):
+  '''
+  Generates the SMTP data for the MIME message `msg` as a sequence of
+  string chunks (see :func:`genemail.util.streamMessage`), ensuring
+  that the data is terminated by a newline.
+  '''
+  last = None
+  for chunk in util.streamMessage(msg):
+    if chunk:
+      last = chunk
+      yield chunk
+  if not last or not last.endswith('\n'):
+    yield '\n'
+
+#------------------------------------------------------------------------------
+_immutable = (basestring, int, long, float, bool, type(None), tuple, frozenset)
+
+def _defaultProperty(name):
+  '''
+  Returns a copy-on-write property for the ``Email.DEFAULTS``
+  attribute `name`. Until the attribute is set, reading it returns the
+  Email's default value; mutable defaults are deep-copied into the
+  Email on first read, since the caller may modify them in-place.
+  Deleting the attribute restores the default.
+  '''
+  slot = '_' + name
+  def get(self):
+    try:
+      return getattr(self, slot)
+    except AttributeError:
+      pass
+    value = self._getDefault(name)
+    if isinstance(value, _immutable):
+      return value
+    value = copy.deepcopy(value)
+    setattr(self, slot, value)
+    return value
+  def set(self, value):
+    self._checkFrozen()
+    setattr(self, slot, value)
+  def delete(self):
+    self._checkFrozen()
+    if hasattr(self, slot):
+      delattr(self, slot)
+  return property(get, set, delete)
+
 #------------------------------------------------------------------------------
 class Email(object):
 
@@ -86,18 +560,24 @@ class Email(object):
     minimalMime          = True,
   )
 
+  # note: the attributes in DEFAULTS are stored in the "_"-prefixed
+  #       slots, which remain unset (i.e. copy-on-write) until the
+  #       attribute is first accessed or set
+  __slots__ = ('manager', 'name', 'provider', 'template', '_default',
+               '_frozen', '_renderCache', '_renderCacheState') \
+    + tuple('_' + attr for attr in DEFAULTS)
+
   #----------------------------------------------------------------------------
-  def __init__(self, manager, name, provider=None, default=None):
+  def __init__(self, manager, name, provider=None, default=None,
+               template=None):
     self.manager  = manager
     self.name     = name
     self.provider = provider or self.manager.provider
-    self.template = self.provider.getTemplate(self.name)
-    self._headers = idict()
-    if default is None:
-      default = adict(self.DEFAULTS)
-    for attr in self.DEFAULTS.keys():
-      setattr(self, attr, copy.deepcopy(getattr(default, attr, None)))
-    self.params['cache'] = AutoCachingDict()
+    self.template = template or self.provider.getTemplate(self.name)
+    self._default = default
+    self._frozen  = False
+    self._renderCache = None
+    self._renderCacheState = None
     # self.attachmentTable    = None
     # for key, val in self.provider.getMap('headers', {}).items():
     #   self.headers[key] = val
@@ -138,17 +618,200 @@ class Email(object):
     '''
     del self.headers[key]
 
+  #----------------------------------------------------------------------------
+  def freeze(self):
+    '''
+    Turns this Email into an immutable prototype: the template's spec
+    and the email structure are resolved up front, and any further
+    attempt to change the attributes, `params`, `headers` or
+    `attachments` raises a TypeError. Use :meth:`clone` to create the
+    actual emails from the prototype. Returns `self`.
+    '''
+    self.template.meta
+    compileStructure(self._peek('structure'))
+    for container in (self.params, self.headers, self.attachments):
+      container.frozen = True
+    self._frozen = True
+    return self
+
+  #----------------------------------------------------------------------------
+  def clone(self, **params):
+    '''
+    Returns a new Email that inherits all of this Email's attributes,
+    template, parameters, headers and attachments, updated with the
+    template parameters `params`. This is intended to be called on
+    a prototype created with :meth:`freeze` (e.g. by
+    :meth:`genemail.manager.Manager.compile`), in which case the
+    inherited state is shared by reference rather than copied and
+    constructing the clone costs almost nothing. Note that the
+    parameter *values* are shared as well, and should therefore not
+    be modified in-place.
+    '''
+    ret = Email(self.manager, self.name, provider=self.provider,
+                default=self, template=self.template)
+    if params:
+      ret.params.update(params)
+    return ret
+
+  #----------------------------------------------------------------------------
+  def _checkFrozen(self):
+    if self._frozen:
+      raise TypeError('cannot modify a frozen Email prototype; use clone()')
+
+  #----------------------------------------------------------------------------
+  def _copyDefault(self, attr):
+    value = self._getDefault(attr)
+    if isinstance(self._default, Email) and self._default._frozen:
+      # the tracking container constructors make a shallow copy, which
+      # is sufficient since the prototype's containers cannot change
+      return value
+    if attr == 'params' and value:
+      # note: the per-Email `cache` and the Manager's `sharedCache` are
+      #       (re-)added by getParams; the latter must not be copied
+      #       since it is shared (and holds a lock).
+      value = dict((key, val) for key, val in value.items()
+                   if key not in ('cache', 'sharedCache'))
+    return copy.deepcopy(value)
+
+  #----------------------------------------------------------------------------
+  def _getDefault(self, attr):
+    'Returns the (shared, not to be modified) default value of `attr`.'
+    if self._default is None:
+      return self.DEFAULTS[attr]
+    if isinstance(self._default, Email):
+      return self._default._peek(attr)
+    return getattr(self._default, attr, None)
+
+  def _peek(self, attr):
+    '''
+    Returns the current value of the DEFAULTS attribute `attr`
+    *without* triggering a copy-on-write of the default value; the
+    returned value must therefore not be modified.
+    '''
+    try:
+      return getattr(self, '_' + attr)
+    except AttributeError:
+      return self._getDefault(attr)
+
+  structure         = _defaultProperty('structure')
+  includeComponents = _defaultProperty('includeComponents')
+  maxSubjectLength  = _defaultProperty('maxSubjectLength')
+  snipIndicator     = _defaultProperty('snipIndicator')
+  textEncoding      = _defaultProperty('textEncoding')
+  htmlEncoding      = _defaultProperty('htmlEncoding')
+  transferEncoding  = _defaultProperty('transferEncoding')
+  encoding          = _defaultProperty('encoding')
+  boundary          = _defaultProperty('boundary')
+  minimalMime       = _defaultProperty('minimalMime')
+
   #----------------------------------------------------------------------------
   # note: for some reason @property...(setter|deleter) don't work with
   # with setattr(...) in python 2.7.3. ugh. need to use old-style.
+  # note: the tracking containers are created from the defaults on
+  #       first access without incrementing their `generation`, so
+  #       that their creation does not invalidate the render cache.
   def getHeaders(self):
+    try:
+      return self._headers
+    except AttributeError:
+      self._headers = TrackingIdict(self._copyDefault('headers'))
     return self._headers
   def setHeaders(self, val):
-    self._headers = idict(val)
+    self._checkFrozen()
+    self._headers = TrackingIdict(val)
+    self._renderCache = None
   def delHeaders(self):
-    self._headers = idict()
+    self._checkFrozen()
+    self._headers = TrackingIdict()
+    self._renderCache = None
   headers = property(getHeaders, setHeaders, delHeaders)
 
+  def getParams(self):
+    try:
+      return self._params
+    except AttributeError:
+      self._params = TrackingDict(self._copyDefault('params') or {})
+      dict.__setitem__(self._params, 'cache', AutoCachingDict())
+      dict.__setitem__(self._params, 'sharedCache',
+                       getattr(self.manager, 'sharedCache', None))
+    return self._params
+  def setParams(self, val):
+    self._checkFrozen()
+    self._params = TrackingDict(val or {})
+    self._renderCache = None
+  def delParams(self):
+    self._checkFrozen()
+    self._params = TrackingDict()
+    self._renderCache = None
+  params = property(getParams, setParams, delParams)
+
+  def getAttachmentList(self):
+    try:
+      return self._attachments
+    except AttributeError:
+      self._attachments = TrackingList(self._copyDefault('attachments') or [])
+    return self._attachments
+  def setAttachmentList(self, val):
+    self._checkFrozen()
+    self._attachments = TrackingList(val or [])
+    self._renderCache = None
+  def delAttachmentList(self):
+    self._checkFrozen()
+    self._attachments = TrackingList()
+    self._renderCache = None
+  attachments = property(getAttachmentList, setAttachmentList, delAttachmentList)
+
+  #----------------------------------------------------------------------------
+  def _getRenderCache(self):
+    '''
+    Returns the dictionary used to memoize template renderings and
+    derived values (parsed trees, styles, etc) for the current state
+    of this Email. The cache is automatically reset whenever the
+    `params`, `headers` or `attachments` are modified; note that
+    in-place changes to objects *referenced* by `params` cannot be
+    detected -- call :meth:`resetRenderCache` in that case.
+    '''
+    state = tuple(getattr(getattr(self, slot, None), 'generation', 0)
+                  for slot in ('_params', '_headers', '_attachments'))
+    if self._renderCache is None or self._renderCacheState != state:
+      self._renderCache = dict()
+      self._renderCacheState = state
+    return self._renderCache
+
+  #----------------------------------------------------------------------------
+  def _cached(self, key, factory):
+    cache = self._getRenderCache()
+    if key not in cache:
+      cache[key] = factory()
+    return cache[key]
+
+  #----------------------------------------------------------------------------
+  def resetRenderCache(self):
+    '''
+    Discards all memoized template renderings, forcing the template to
+    be re-evaluated on the next call to, for example, :meth:`getHtml`
+    or :meth:`send`.
+    '''
+    self._renderCache = None
+
+  #----------------------------------------------------------------------------
+  def _render(self, fmt, genemail_format, extraparams=None):
+    '''
+    Renders the template format `fmt` with the current parameters and
+    the `genemail_format` parameter set to `genemail_format`; the
+    result is memoized until the parameters change.
+    '''
+    def render():
+      params = dict(self.params)
+      params.update({'genemail_format': genemail_format})
+      if extraparams:
+        params.update(extraparams)
+      return self.template.render(fmt, params)
+    extrakey = _paramsKey(extraparams)
+    if extrakey is None:
+      return render()
+    return self._cached(('render', fmt, genemail_format, extrakey), render)
+
   #----------------------------------------------------------------------------
   def getSettings(self):
     '''
@@ -169,11 +832,18 @@ class Email(object):
     return self.getSettings().get(key, default)
 
   #----------------------------------------------------------------------------
-  def addAttachment(self, name, value, cid=False, contentType=None):
+  def addAttachment(self, name, value=None, cid=False, contentType=None,
+                    path=None):
     '''
     Add an attachment to the email. The `name` is the default filename that
     will be offered when the recipient tries to "Save..." the attachment. The
-    `value` is the actual content of the attachment. If `cid` is True, then
+    `value` is the actual content of the attachment, either as a string or
+    as an open file or buffer object (e.g. a `bytearray` or `mmap`).
+    Alternatively, the content can be read from the file named by `path`.
+    Content provided by a file or buffer is not read into memory up front;
+    it is memory-mapped (where possible) and base64-encoded in chunks as
+    the message is serialized (see :mod:`genemail.attachment`). If `cid` is
+    True, then
     the attachment will be stored as an embedded object, and will therefore
     not be directly saveable by the recipient and it can be accessed from
     within the HTML, for example, with the `name` set to ``'logo.png'``, the
@@ -183,75 +853,75 @@ class Email(object):
 
     (note the ``cid:`` prefix that must be added in the HTML.)
     '''
+    if path is not None:
+      value = AttachmentContent(path=path)
+    elif value is None:
+      raise ValueError('attachment %r has no content' % (name,))
+    elif hasattr(value, 'read'):
+      value = AttachmentContent(file=value)
+    elif not isinstance(value, (basestring, AttachmentContent)):
+      value = AttachmentContent(buffer=value)
     self.attachments.append(
       adict(name=name, value=value, cid=cid, contentType=contentType))
 
   #----------------------------------------------------------------------------
   def getTemplateXml(self, fallbackToNone=True):
-    params = dict(self.params)
-    params.update({'genemail_format': 'xml'})
+    '''
+    Returns the parsed XML version of the template, or ``None`` if no
+    XML-based format is available. Note that the returned tree is
+    shared between calls and must therefore not be modified.
+    '''
+    return self._cached(('xml', fallbackToNone),
+                        lambda: self._getTemplateXml(fallbackToNone))
+
+  def _getTemplateXml(self, fallbackToNone):
     for fmt in ('xml', 'xhtml', 'html'):
       if fmt in self.template.meta.formats:
-        return util.parseXml(self.template.render(fmt, params))
+        return util.parseXml(self._render(fmt, 'xml'))
     if fallbackToNone:
       try:
-        return util.parseXml(self.template.render(None, params))
+        return util.parseXml(self._render(None, 'xml'))
       except ET.ParseError:
         return None
     return None
 
+  #----------------------------------------------------------------------------
+  def getTemplateManifest(self):
+    '''
+    Returns an :class:`adict` describing the genemail-specific content
+    of the XML version of the template, as collected by a single pass
+    over the document (see :func:`scanTemplateXml`).
+    '''
+    return self._cached(('manifest',),
+                        lambda: scanTemplateXml(self.getTemplateXml()))
+
   #----------------------------------------------------------------------------
   def getTemplateHeaders(self):
-    ret = idict()
     # todo: this requires that headers be defined as separate elements, eg:
     #         <email:header name="..." value="...">...</email:header>
     #       rather than being able to tag an existing node, such as:
     #         <p>This email was sent to <span email:header="To">...</span>.</p>
-    xdoc = self.getTemplateXml()
-    if xdoc is None:
-      return ret
-    etag = '{%s}header' % (xmlns,)
-    for node in xdoc.iter():
-      if node.tag == etag:
-        ret[node.get('name')] = node.get('value') or node.text
-        continue
-      if node.get(etag) is not None:
-        ret[node.get(etag)] = node.text
-    return ret
+    return idict(self.getTemplateManifest().headers)
 
   #----------------------------------------------------------------------------
   def getTemplateAttachments(self):
     atts = {}
     for att in self.template.meta.attachments or []:
       atts[att.name] = att
-    xdoc = self.getTemplateXml()
-    if xdoc is None:
-      return atts.values()
-    for node in xdoc.iter('{%s}attachment' % (xmlns,)):
-      att = adict(
-        name        = node.get('name'),
-        contentType = node.get('content-type', None),
-        value       = node.get('value', None) or node.text,
-        cid         = node.get('cid', 'false').lower() == 'true',
-      )
-      if node.get('encoding', None) == 'base64':
-        att.value = base64.b64decode(att.value)
-      atts[att.name] = att
+    for att in self.getTemplateManifest().attachments:
+      atts[att.name] = adict(att)
     return atts.values()
 
   #----------------------------------------------------------------------------
   def getTemplateStyle(self):
+    return self._cached(('style',), self._getTemplateStyle)
+
+  def _getTemplateStyle(self):
     ret  = []
     if 'css' in self.template.meta.formats:
-      params = dict(self.params)
-      params.update({'genemail_format': 'css'})
-      ret.append(self.template.render('css', params))
-    xdoc = self.getTemplateXml()
-    if xdoc is None:
-      return ' '.join(ret)
+      ret.append(self._render('css', 'css'))
     # todo: what if the node has a "src" attribute...
-    for node in xdoc.findall('{%s}head/{%s}style[@type="text/css"]' % (htmlns, htmlns)):
-      ret.append(node.text)
+    ret.extend(self.getTemplateManifest().styles)
     return ' '.join(ret)
 
   #----------------------------------------------------------------------------
@@ -268,25 +938,30 @@ class Email(object):
       ret = self.getHtml(extraparams=extraparams)
       return self.inlineCidAttachments(ret)
 
-    params = dict(self.params)
-    params.update({'genemail_format': 'html'})
-    if extraparams:
-      params.update(extraparams)
+    extrakey = _paramsKey(extraparams)
+    if extrakey is None:
+      return self._getHtml(extraparams)
+    return self._cached(('html', extrakey), lambda: self._getHtml(extraparams))
 
-    # todo: try alternative formats if 'html' isn't available? eg xhtml...
-    html = self.template.render('html', params)
+  def _getHtml(self, extraparams):
 
-    # todo: this double roundtrip of parse/serialize html is ridiculous
+    # todo: try alternative formats if 'html' isn't available? eg xhtml...
+    html = self._render('html', 'html', extraparams)
 
     # remove all genemail xmlns elements and attributes and non-inline css
     # note: using list() so that i can mutate the underlying object
+    # note: `email:cache` regions are collected (and unwrapped below)
+    #       instead of being removed
     html = util.parseXml(html)
+    regions = []
     def stripSpecial(el):
       for attr in list(el.keys()):
         if attr.startswith('{%s}' % (xmlns,)):
           del el.attrib[attr]
       for node in list(el.getchildren()):
-        if node.tag.startswith('{%s}' % (xmlns,)):
+        if node.tag == '{%s}cache' % (xmlns,):
+          regions.append((el, node))
+        elif node.tag.startswith('{%s}' % (xmlns,)):
           el.remove(node)
           continue
         stripSpecial(node)
@@ -298,8 +973,17 @@ class Email(object):
             topnode.remove(node)
 
     style = (self.getTemplateStyle() or '').strip()
-    if len(style) > 0:
-      html = util.inlineHtmlStyling(html, style)
+    if len(style) <= 0:
+      for parent, node in reversed(regions):
+        _unwrap(parent, node)
+      return util.serializeHtml(html)
+
+    fmt = (extraparams or {}).get('genemail_format', 'html')
+    fragments = _FragmentRegions(self.template.source.uri, fmt, style)
+    for parent, node in regions:
+      fragments.add(parent, node)
+    html = util.inlineHtmlStyling(html, style, exclude=fragments.apply())
+    fragments.store()
 
     return util.serializeHtml(html)
 
@@ -309,7 +993,10 @@ class Email(object):
       if not att.cid:
         continue
       ct = att.contentType or 'application/octet-stream'
-      value = 'data:' + ct + ';base64,' + base64.b64encode(att['value'])
+      value = att['value']
+      if isinstance(value, AttachmentContent):
+        value = value.read()
+      value = 'data:' + ct + ';base64,' + base64.b64encode(value)
       # todo: this is a "brute-force" approach... i should replace only
       #       attributes that have this exact value...
       html = html.replace('cid:' + att.name, value)
@@ -323,14 +1010,15 @@ class Email(object):
     :meth:`send` to actually send the email.
     '''
     # todo: what if 'text' is not in `includeComponents`?
-    params = dict(self.params)
-    params.update({'genemail_format': 'text'})
+    return self._cached(('text',), self._getText)
+
+  def _getText(self):
     if 'text' in self.template.meta.formats:
-      return self.template.render('text', params)
+      return self._render('text', 'text')
     try:
       html = self.getHtml(extraparams={'genemail_format': 'text'})
     except Exception:
-      return self.template.render(None, params)
+      return self._render(None, 'text')
     # todo: it would be interesting to be able to configure html2text to only
     #       put it footnotes for IMG tags that had non-"cid:" image references...
     text = html2text.html2text(html)
@@ -364,22 +1052,15 @@ class Email(object):
     if 'subject' in self.headers:
       return self.headers['subject']
     if 'subject' in self.template.meta.formats:
-      params = dict(self.params)
-      params.update({'genemail_format': 'subject'})
       # todo: check subject encoding?...
-      return self.template.render('subject', self.params)
+      return self._render('subject', 'subject')
     # todo: what if there is no XML format?...
     # note: purposefully NOT using encoding=self.encoding so that i can
     #       then more cleanly replace HTML entity characters...
     # todo: clean up this entity-replacement strategy
-    xdoc = self.getTemplateXml()
-    if xdoc is None:
+    ret = self.getTemplateManifest().subject
+    if not ret:
       return self._cleanSubject(self.getText())
-    etag = '{%s}subject' % (xmlns,)
-    ret = []
-    for node in xdoc.iter():
-      if node.tag == etag or node.get(etag) == 'content':
-        ret.append(node.text)
     ret = ' '.join(ret).encode('us-ascii', 'genemail_unicode2ascii')
     ret = self._cleanSubject(ret)
     if ret:
@@ -461,158 +1142,12 @@ class Email(object):
     # TODO: address the other self.encoding uses and see if the default
     #       should really be us-ascii instead of None...
 
-    funcs = adict()
-
-    def make_email_text():
-      if self.includeComponents and 'text' not in self.includeComponents:
-        return None
-      txtenc  = self.textEncoding or self.transferEncoding or self.encoding
-      if txtenc is not None:
-        return email.MIMEText.MIMEText(self.getText(), 'plain', txtenc)
-      # do several encoding round trips until one is found that does not
-      # degrade the content
-      for txtenc in [ 'ascii', 'iso-8859-1', 'utf-8' ]:
-        src = self.getText()
-        try: txt = email.MIMEText.MIMEText(src, 'plain', txtenc)
-        except UnicodeEncodeError: continue
-        if src == txt.get_payload(decode=True):
-          return txt
-      raise TypeError('could not encode email text component - try setting an encoding')
-    funcs.make_email_text = make_email_text
-
-    def make_email_html():
-      if self.includeComponents and 'html' not in self.includeComponents:
-        return None
-      htmlenc = self.htmlEncoding or self.transferEncoding or self.encoding
-      if htmlenc is not None:
-        return email.MIMEText.MIMEText(self.getHtml(), 'html', htmlenc)
-      # do several encoding round trips until one is found that does not
-      # degrade the content
-      for htmlenc in [ 'ascii', 'iso-8859-1', 'utf-8' ]:
-        src = self.getHtml()
-        try: html = email.MIMEText.MIMEText(src, 'html', htmlenc)
-        except UnicodeEncodeError: continue
-        if src == html.get_payload(decode=True):
-          return html
-      raise TypeError('could not encode email html component - try setting an encoding')
-    funcs.make_email_html = make_email_html
-
-    funcs.atts_cache = None
-    def make_email_attachments(cid=False):
-      if self.includeComponents and 'attachments' not in self.includeComponents:
-        return None
-      if funcs.atts_cache is None:
-        funcs.atts_cache = self.getAttachments()
-      return [att for att in funcs.atts_cache if att.cid == cid]
-    funcs.make_email_attachments = make_email_attachments
-
-    funcs.bndidx = 0
-    def make_boundary(type):
-      if not self.boundary:
-        return None
-      funcs.bndidx += 1
-      return '==%s-%s-%i==' % (self.boundary, type, funcs.bndidx)
-    funcs.make_boundary = make_boundary
-
-    def comp_extend(comp, spec):
-      if isinstance(spec, basestring):
-        spec = [spec]
-      for item in ( spec or [] ):
-        item = funcs.make_component(item)
-        if not item:
-          continue
-        if isinstance(comp, list):
-          if isinstance(item, list):
-            comp.extend(item)
-          else:
-            comp.append(item)
-        else:
-          if isinstance(item, list):
-            for cur in item:
-              comp.attach(cur)
-          else:
-            comp.attach(item)
-      return comp
-    funcs.comp_extend = comp_extend
-
-    def checkMinimalMime(comp, optimize=None):
-      if optimize is True or self.minimalMime:
-        load = comp.get_payload()
-        if not isinstance(load, basestring) \
-            and len(load) == 1:
-          return load[0]
-      return comp
-
-    def make_mime_mixed(spec, optimize=None):
-      comp = email.MIMEMultipart.MIMEMultipart(
-        'mixed', boundary=make_boundary('mix'))
-      return checkMinimalMime(funcs.comp_extend(comp, spec))
-    funcs.make_mime_mixed = make_mime_mixed
-
-    def make_mime_alternative(spec, optimize=None):
-      comp = email.MIMEMultipart.MIMEMultipart(
-        'alternative', boundary=make_boundary('alt'))
-      return checkMinimalMime(funcs.comp_extend(comp, spec))
-    funcs.make_mime_alternative = make_mime_alternative
-
-    def make_mime_related(spec, type=None, optimize=None):
-      # TODO: do something with `type`...
-      comp = email.MIMEMultipart.MIMEMultipart(
-        'related', boundary=make_boundary('rel'))
-      return checkMinimalMime(funcs.comp_extend(comp, spec))
-    funcs.make_mime_related = make_mime_related
-
-    def make_mime_attachments(spec):
-      if self.includeComponents and 'attachments' not in self.includeComponents:
-        return None
-      atts = funcs.comp_extend([], spec)
-      if not atts:
-        return None
-      ret = []
-      for att in atts:
-        maintype, subtype = (att.contentType or 'application/octet-stream').split('/', 1)
-        if maintype == 'text':
-          # note: we should handle calculating the charset
-          matt = email.MIMEText.MIMEText(att.value, _subtype=subtype)
-        elif maintype == 'image':
-          matt = email.MIMEImage.MIMEImage(att.value, _subtype=subtype, name=att.name)
-        elif maintype == 'audio':
-          matt = email.MIMEAudio.MIMEAudio(att.value, _subtype=subtype)
-        else:
-          matt = email.MIMEBase.MIMEBase(maintype, subtype)
-          matt.set_payload(att.value)
-          email.Encoders.encode_base64(matt)
-        if att.cid:
-          matt.add_header('Content-Disposition', 'attachment')
-          matt.add_header('Content-ID', '<' + att.name + '>')
-        else:
-          matt.add_header('Content-Disposition', 'attachment', filename=att.name)
-        ret.append(matt)
-      return ret
-    funcs.make_mime_attachments = make_mime_attachments
-
-    def make_component(spec):
-      kls, comp, kw = spec, None, dict()
-      if isinstance(spec, dict) and len(spec) == 1:
-        kls = spec.keys()[0]
-      if isinstance(kls, basestring) and ':' in kls:
-        kls, comp = kls.split(':', 1)
-        if ';' in comp:
-          comp, kw = comp.split(';', 1)
-          kw = [pairs.strip().split('=', 1)
-                for pairs in kw.strip().split(',')]
-          kw = {k: eval(v) for k, v in kw}
-      if kls == 'email':
-        return funcs['make_email_' + comp](**kw)
-      if kls == 'mime':
-        return funcs['make_mime_' + comp](spec.values()[0], **kw)
-      raise SyntaxError('unsupported email structure component: %r' % (spec,))
-    funcs.make_component = make_component
-
-    if self.includeComponents == ['text']:
-      msg = make_email_text()
+    state = adict(atts=None, bndidx=0,
+                  include=self._peek('includeComponents'))
+    if state.include == ['text']:
+      msg = _make_email_text(self, state, None)
     else:
-      msg = make_component(self.structure)
+      msg = compileStructure(self._peek('structure')).build(self, state)
 
     for k,v in curheaders.items():
       msg[util.smtpHeaderFormat(k)] = v
@@ -646,7 +1181,62 @@ class Email(object):
       level. Note that this will NOT set or override the active ``To``
       header. If not specified, the addresses will be extracted from
       the ``To``, ``CC``, and ``BCC`` headers.
+
+    Returns whatever the manager's sender returns (e.g. a future for
+    a :class:`genemail.sender.QueuedSender`).
+    '''
+    mailfrom, recipients, data = self._prepare(mailfrom, recipients)
+    if not isinstance(data, basestring):
+      if getattr(self.manager.sender, 'streaming', False):
+        data = streamSmtpData(data)
+      else:
+        data = _smtpString(data)
+    return self.manager.sender.send(mailfrom, recipients, data)
+
+  #----------------------------------------------------------------------------
+  def sendAsync(self, mailfrom=None, recipients=None):
+    '''
+    Asynchronous version of :meth:`send`: the email is rendered by the
+    manager's `executor` and then handed to the manager's sender --
+    via its `sendAsync` method, if it has one (e.g.
+    :class:`genemail.sender.AsyncSmtpSender`), otherwise by calling
+    `send` in the executor thread. Returns a
+    :class:`genemail.future.Future` that resolves to the sender's
+    return value (e.g. the dictionary of refused recipients) or to the
+    exception raised while rendering or sending. The email must not be
+    modified until the future completes. See :meth:`send` for the
+    parameters.
+    '''
+    ret = Future()
+    def _send():
+      msg = self.getSmtpMessage(mailfrom, recipients)
+      sender = self.manager.sender
+      if hasattr(sender, 'sendAsync'):
+        ret.chain(sender.sendAsync(msg.mailfrom, msg.recipients, msg.message))
+      else:
+        ret.set_result(sender.send(msg.mailfrom, msg.recipients, msg.message))
+    def _failed(future):
+      if future.exception() is not None:
+        ret.set_exception(future.exception())
+    self.manager.executor.submit(_send).add_done_callback(_failed)
+    return ret
+
+  #----------------------------------------------------------------------------
+  def getSmtpMessage(self, mailfrom=None, recipients=None):
+    '''
+    Returns exactly what :meth:`send` would pass to the manager's
+    sender as an adict with the attributes `mailfrom`, `recipients`
+    and `message` (the SMTP data, as a string), i.e. after the
+    addresses have been resolved and the manager's modifier has been
+    applied. See :meth:`send` for the parameters.
     '''
+    mailfrom, recipients, data = self._prepare(mailfrom, recipients)
+    if not isinstance(data, basestring):
+      data = _smtpString(data)
+    return adict(mailfrom=mailfrom, recipients=recipients, message=data)
+
+  #----------------------------------------------------------------------------
+  def _prepare(self, mailfrom, recipients):
     hdrs = self.getOutputHeaders()
     if mailfrom is None:
       mailfrom = util.extractEmails(hdrs.get('from'))
@@ -667,11 +1257,7 @@ class Email(object):
     if self.manager.modifier:
       mailfrom, recipients, data = self.manager.modifier.modify(
         mailfrom, recipients, data)
-    if not isinstance(data, basestring):
-      data = data.as_string()
-      if not data.endswith('\n'):
-        data += '\n'
-    self.manager.sender.send(mailfrom, recipients, data)
+    return (mailfrom, recipients, data)
 
 #------------------------------------------------------------------------------
 # end of $Id$
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# lib:  genemail.future
+# auth: Philip J Grabner <grabner@cadit.com>
+# date: 2013/12/02
+# copy: (C) Copyright 2013 Cadit Health Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+'''
+Minimal thread-based futures and executor used by the asynchronous
+sending APIs (modeled after, but not depending on, the
+:mod:`concurrent.futures` package).
+'''
+
+from __future__ import absolute_import
+
+__all__ = ('Future', 'ThreadExecutor', 'Scheduler')
+
+import sys
+import time
+import heapq
+import itertools
+import threading
+import collections
+
+#------------------------------------------------------------------------------
+class Future(object):
+  '''
+  The eventual result of an asynchronous operation. Other threads
+  wait for it with :meth:`result` or :meth:`exception`, or register a
+  callback with :meth:`add_done_callback`; the producing side calls
+  exactly one of :meth:`set_result` or :meth:`set_exception`.
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self):
+    self._cond      = threading.Condition()
+    self._done      = False
+    self._result    = None
+    self._exception = None
+    self._callbacks = []
+
+  #----------------------------------------------------------------------------
+  def done(self):
+    return self._done
+
+  #----------------------------------------------------------------------------
+  def _wait(self, timeout):
+    with self._cond:
+      if not self._done:
+        self._cond.wait(timeout)
+      if not self._done:
+        raise RuntimeError('timed out waiting for result')
+
+  #----------------------------------------------------------------------------
+  def result(self, timeout=None):
+    '''
+    Returns the result, waiting at most `timeout` seconds (or forever,
+    if ``None``) for it. Raises the operation's exception if it
+    failed, or :class:`RuntimeError` if the timeout expired.
+    '''
+    self._wait(timeout)
+    if self._exception is not None:
+      raise self._exception
+    return self._result
+
+  #----------------------------------------------------------------------------
+  def exception(self, timeout=None):
+    'Same as :meth:`result`, but returns the exception (or ``None``).'
+    self._wait(timeout)
+    return self._exception
+
+  #----------------------------------------------------------------------------
+  def add_done_callback(self, callback):
+    '''
+    Calls `callback` with this future as the only argument when it
+    completes (immediately, if it already has). Callbacks run in the
+    thread that completes the future and must not raise.
+    '''
+    with self._cond:
+      if not self._done:
+        self._callbacks.append(callback)
+        return
+    callback(self)
+
+  #----------------------------------------------------------------------------
+  def set_result(self, result):
+    self._complete(result, None)
+
+  def set_exception(self, exception):
+    self._complete(None, exception)
+
+  def _complete(self, result, exception):
+    with self._cond:
+      if self._done:
+        raise RuntimeError('future already completed')
+      self._result    = result
+      self._exception = exception
+      self._done      = True
+      self._cond.notify_all()
+      callbacks, self._callbacks = self._callbacks, []
+    for callback in callbacks:
+      callback(self)
+
+  #----------------------------------------------------------------------------
+  def chain(self, other):
+    'Completes this future with the outcome of the future `other`.'
+    def _done(other):
+      if other.exception() is not None:
+        self.set_exception(other.exception())
+      else:
+        self.set_result(other.result())
+    other.add_done_callback(_done)
+    return self
+
+#------------------------------------------------------------------------------
+class ThreadExecutor(object):
+  '''
+  A pool of (daemon) worker threads that execute submitted calls in
+  FIFO order. Threads are started on demand, up to `workers`.
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self, workers=4):
+    self.workers  = workers
+    self._queue   = collections.deque()
+    self._cond    = threading.Condition()
+    self._threads = []
+    self._idle    = 0
+
+  #----------------------------------------------------------------------------
+  def submit(self, func, *args, **kwargs):
+    '''
+    Schedules ``func(*args, **kwargs)`` to be called in a worker thread
+    and returns a :class:`Future` for its return value.
+    '''
+    future = Future()
+    with self._cond:
+      self._queue.append((future, func, args, kwargs))
+      self._cond.notify()
+      if len(self._queue) > self._idle and len(self._threads) < self.workers:
+        thread = threading.Thread(target=self._run, name='genemail-worker')
+        thread.daemon = True
+        self._threads.append(thread)
+        thread.start()
+    return future
+
+  #----------------------------------------------------------------------------
+  def _run(self):
+    while True:
+      with self._cond:
+        while not self._queue:
+          self._idle += 1
+          self._cond.wait()
+          self._idle -= 1
+        future, func, args, kwargs = self._queue.popleft()
+      try:
+        result = func(*args, **kwargs)
+      except Exception:
+        future.set_exception(sys.exc_info()[1])
+      else:
+        future.set_result(result)
+
+#------------------------------------------------------------------------------
+class Scheduler(object):
+  '''
+  Calls functions after a delay in a single background (daemon)
+  thread, which is started on demand. Scheduled functions should be
+  short or hand their work off to an executor, since they delay all
+  subsequently due calls; any exception they raise is ignored.
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self):
+    self._heap   = []
+    self._cond   = threading.Condition()
+    self._seq    = itertools.count()
+    self._thread = None
+
+  #----------------------------------------------------------------------------
+  def __len__(self):
+    'The number of scheduled calls that have not been made yet.'
+    return len(self._heap)
+
+  #----------------------------------------------------------------------------
+  def schedule(self, delay, func, *args, **kwargs):
+    'Calls ``func(*args, **kwargs)`` in `delay` seconds.'
+    with self._cond:
+      heapq.heappush(self._heap, (
+        time.time() + delay, next(self._seq), func, args, kwargs))
+      if self._thread is None:
+        self._thread = threading.Thread(
+          target=self._run, name='genemail-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+      self._cond.notify()
+
+  #----------------------------------------------------------------------------
+  def _run(self):
+    while True:
+      with self._cond:
+        if not self._heap:
+          self._cond.wait()
+          continue
+        wait = self._heap[0][0] - time.time()
+        if wait > 0:
+          self._cond.wait(wait)
+          continue
+        when, seq, func, args, kwargs = heapq.heappop(self._heap)
+      try:
+        func(*args, **kwargs)
+      except Exception:
+        pass
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
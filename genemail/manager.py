@@ -11,16 +11,84 @@ from __future__ import absolute_import
 
 __all__ = ('Manager',)
 
+import os, time, itertools
+import multiprocessing
+import pkg_resources
 import templatealchemy as TA
 from templatealchemy.util import adict, callingPkgName
+from templatealchemy_driver.file import FileSource
+from templatealchemy_driver.pkg import PkgSource
 from . import sender as sendermod
 from . import email
+from .cache import LruCache, resetAfterFork
+from .future import ThreadExecutor
+
+#------------------------------------------------------------------------------
+def templateSignature(template):
+  '''
+  Returns a value that changes whenever any of the files backing the
+  TemplateAlchemy `template` change (based on their names,
+  modification times and sizes), or ``None`` if the template is not
+  backed by files (e.g. "string:" templates) and therefore cannot
+  change.
+  '''
+  source = template.source
+  try:
+    if isinstance(source, FileSource):
+      path = source.spec
+    elif isinstance(source, PkgSource):
+      path = pkg_resources.resource_filename(source.module, source.path)
+    else:
+      return None
+    dirname, base = os.path.split(path)
+    ret = []
+    for name in sorted(os.listdir(dirname or '.')):
+      if name.startswith(base + '.'):
+        stat = os.stat(os.path.join(dirname, name))
+        ret.append((name, stat.st_mtime, stat.st_size))
+    return tuple(ret)
+  except (OSError, IOError, ImportError, NotImplementedError):
+    return None
+
+#------------------------------------------------------------------------------
+# note: Managers hold locks and other state that cannot be pickled, so
+#       the worker processes of :meth:`Manager.renderMany` instead find
+#       their Manager in this registry, which they inherit via fork().
+_poolManagers = dict()
+_poolCounter  = itertools.count()
+_worker       = adict()
+
+def _renderInit(key, name):
+  # note: other threads of the parent (e.g. sender or executor workers)
+  #       may have held a cache lock at the time of the fork
+  resetAfterFork()
+  _worker.manager   = _poolManagers[key]
+  _worker.name      = name
+  _worker.prototype = None
+
+def _renderOne(item):
+  # the prototype (and with it the template, stylesheet and fragment
+  # caches) stays warm for all of the items rendered by a worker
+  if _worker.prototype is None:
+    _worker.prototype = _worker.manager.compile(_worker.name)
+  # note: adicts cannot be pickled, hence the conversion to a dict
+  return dict(_render(_worker.prototype, item))
+
+def _render(prototype, item):
+  index, params = item
+  eml = prototype.clone()
+  eml.params.update(params)
+  ret = eml.getSmtpMessage()
+  ret.index = index
+  return ret
 
 #------------------------------------------------------------------------------
 class Manager(object):
 
   #----------------------------------------------------------------------------
-  def __init__(self, provider=None, modifier=None, sender=None, default=None):
+  def __init__(self, provider=None, modifier=None, sender=None, default=None,
+               templateCacheSize=128, templateCheckInterval=2,
+               sharedCache=None, executor=None):
     '''
     A ``genemail.manager.Manager`` object is the main clearinghouse
     for generating templatized emails. The main objective is that it
@@ -43,13 +111,44 @@ class Manager(object):
       SmtpSender with default parameters.
 
     default : { dict, :class:`genemail.email.Email` }, optional
-      sets the default Email object whose attributes are deep-copied
-      into a new Email object (created with :meth:`newEmail`).
+      sets the default Email object whose attributes are inherited,
+      copy-on-write, by new Email objects (created with
+      :meth:`newEmail`). Note that this means that the default should
+      not be modified after Email objects have been created from it.
+
+    templateCacheSize : int, optional, default: 128
+      the maximum number of loaded templates to cache (see
+      :meth:`getTemplate`); if ``0``, templates are not cached.
+
+    templateCheckInterval : float, optional, default: 2
+      the minimum number of seconds between checks of whether a cached
+      template's files have changed; if ``None``, the files are never
+      checked and :meth:`invalidate` must be used instead.
+
+    sharedCache : :class:`genemail.cache.LruCache`, optional
+      the cache made available to templates as the ``sharedCache``
+      parameter, which, unlike the per-email ``cache`` parameter, is
+      shared by all emails generated by this Manager (and therefore
+      by all threads using it). Defaults to an LruCache holding at
+      most 1024 entries without expiration.
+
+    executor : object, optional
+      the executor that renders emails sent with
+      :meth:`genemail.email.Email.sendAsync`; it must have a `submit`
+      method that returns a future (e.g. a
+      :class:`concurrent.futures.ThreadPoolExecutor`). Defaults to a
+      :class:`genemail.future.ThreadExecutor` with four threads.
     '''
     self.provider = provider
     if not self.provider:
       self.provider = TA.Template(
         source='pkg:%s:' % (callingPkgName(ignore='genemail'),))
+    self.templates = LruCache(maxsize=templateCacheSize) \
+      if templateCacheSize else None
+    self.templateCheckInterval = templateCheckInterval
+    self.sharedCache = sharedCache if sharedCache is not None \
+      else LruCache(maxsize=1024)
+    self.executor = executor or ThreadExecutor()
     self.modifier = modifier or None
     self.sender   = sender or sendermod.SmtpSender()
     self.default  = default
@@ -59,10 +158,205 @@ class Manager(object):
         if attr in email.Email.DEFAULTS:
           setattr(self.default, attr, val)
 
+  #----------------------------------------------------------------------------
+  def getTemplate(self, name, provider=None):
+    '''
+    Returns the TemplateAlchemy template `name` loaded from `provider`
+    (which defaults to this Manager's provider). Loaded templates (and
+    with them their parsed spec) are cached, keyed by (provider, name),
+    in the thread-safe LRU :attr:`templates`. A cached template is
+    reloaded when the files backing it change, which is checked at
+    most every `templateCheckInterval` seconds (see
+    :func:`templateSignature`), or after a call to :meth:`invalidate`.
+    '''
+    provider = provider or self.provider
+    if self.templates is None:
+      return provider.getTemplate(name)
+    key   = (provider, name)
+    entry = self.templates.get(key, lambda: self._loadTemplate(provider, name))
+    if self.templateCheckInterval is not None \
+        and time.time() - entry.checked >= self.templateCheckInterval:
+      entry.checked = time.time()
+      if templateSignature(entry.template) != entry.signature:
+        entry = self.templates[key] = self._loadTemplate(provider, name)
+    return entry.template
+
+  def _loadTemplate(self, provider, name):
+    template = provider.getTemplate(name)
+    return adict(
+      template=template, signature=templateSignature(template),
+      checked=time.time())
+
+  #----------------------------------------------------------------------------
+  def invalidate(self, name=None):
+    '''
+    Discards the cached template `name` (as loaded from any provider)
+    so that it is reloaded the next time it is used. If `name` is
+    ``None``, all cached templates are discarded.
+    '''
+    if self.templates is None:
+      return
+    for key in self.templates.keys():
+      if name is None or key[1] == name:
+        try:
+          del self.templates[key]
+        except KeyError:
+          pass
+
   #----------------------------------------------------------------------------
   def newEmail(self, name=None, provider=None, default=None):
     return email.Email(
-      self, name, provider=provider, default=default or self.default)
+      self, name, provider=provider, default=default or self.default,
+      template=self.getTemplate(name, provider))
+
+  #----------------------------------------------------------------------------
+  def compile(self, name, **params):
+    '''
+    Returns a frozen prototype :class:`genemail.email.Email` for the
+    template `name`, with the template parameters common to all
+    recipients set to `params`. Per-recipient emails are then created
+    with ``prototype.clone(**recipientParams)``, which shares the
+    prototype's template, structure, headers, attachments and
+    parameters by reference and is therefore nearly free. For
+    example::
+
+      welcome = manager.compile('welcome', site='Example')
+      for user in users:
+        welcome.clone(name=user.name, email=user.email).send()
+
+    See :meth:`genemail.email.Email.freeze` and
+    :meth:`genemail.email.Email.clone` for details.
+    '''
+    ret = self.newEmail(name)
+    ret.params.update(params)
+    return ret.freeze()
+
+  #----------------------------------------------------------------------------
+  def iterBatch(self, name, paramsIterable, provider=None, default=None):
+    '''
+    Generates one :class:`genemail.email.Email` object for each dict
+    of template parameters in `paramsIterable`. This is the
+    mail-merge equivalent of calling :meth:`newEmail` for each
+    recipient, except that the template named `name` is only looked up
+    once and then shared by all of the generated emails -- this
+    includes the template's spec, and with it any attachments declared
+    there. Parsed and compiled stylesheets are shared as well (see
+    :func:`genemail.util.compileStylesheet`), so that only the
+    parameter-dependent parts are rendered per recipient.
+
+    Note that `paramsIterable` is consumed lazily, i.e. it can be a
+    generator of arbitrary length.
+    '''
+    provider = provider or self.provider
+    template = self.getTemplate(name, provider)
+    for params in paramsIterable:
+      eml = email.Email(
+        self, name, provider=provider, default=default or self.default,
+        template=template)
+      eml.params.update(params)
+      yield eml
+
+  #----------------------------------------------------------------------------
+  def sendBatch(self, name, paramsIterable, provider=None, default=None):
+    '''
+    Sends one email generated from template `name` for each dict of
+    template parameters in `paramsIterable`; see :meth:`iterBatch`
+    for details. Returns the number of emails sent.
+    '''
+    count = 0
+    for eml in self.iterBatch(name, paramsIterable,
+                              provider=provider, default=default):
+      eml.send()
+      count += 1
+    return count
+
+  #----------------------------------------------------------------------------
+  def sendAsync(self, name, params=None):
+    '''
+    Renders and sends an email generated from template `name` with
+    the template parameters dict `params` asynchronously, and returns a
+    :class:`genemail.future.Future` of the result. See
+    :meth:`genemail.email.Email.sendAsync` for details.
+    '''
+    eml = self.newEmail(name)
+    eml.params.update(params or {})
+    return eml.sendAsync()
+
+  #----------------------------------------------------------------------------
+  def sendBatchAsync(self, name, paramsIterable, provider=None, default=None):
+    '''
+    Asynchronous version of :meth:`sendBatch`: returns a list of
+    :class:`genemail.future.Future` objects, one for each dict of
+    template parameters in `paramsIterable`, in the same order.
+    '''
+    return [eml.sendAsync()
+            for eml in self.iterBatch(name, paramsIterable,
+                                      provider=provider, default=default)]
+
+  #----------------------------------------------------------------------------
+  def renderMany(self, name, paramsIterable, processes=None, ordered=True,
+                 send=False, chunksize=1):
+    '''
+    Renders one email from template `name` for each dict of template
+    parameters in `paramsIterable` using a pool of `processes` worker
+    processes (by default, one per CPU), since rendering is CPU-bound
+    and therefore does not benefit from threads. Each worker compiles
+    the template once (see :meth:`compile`) and keeps its caches warm
+    for all of the emails it renders.
+
+    Returns an iterator of adicts, one per email, with the attributes
+    `index` (the position of the parameters in `paramsIterable`),
+    `mailfrom`, `recipients` and `message` (the SMTP data), i.e. the
+    same as :meth:`genemail.email.Email.getSmtpMessage`. If `ordered`
+    is false, the results are returned as they are completed instead
+    of in the order of `paramsIterable`. If `send` is true, the
+    emails are instead sent by this Manager's sender (in the calling
+    process) as they are completed and the number of emails sent is
+    returned.
+
+    The worker processes inherit this Manager via ``fork()``, which
+    is therefore required; on platforms without it (or if
+    `processes` is ``1``), the emails are rendered in the calling
+    process. Since a forked process only inherits the calling thread,
+    the workers start with fresh (empty) caches (see
+    :func:`genemail.cache.resetAfterFork`), including the
+    `sharedCache`. Other locks that another thread holds at the time
+    of the fork, e.g. in a template engine, are still inherited as
+    held; if in doubt, call this before starting any threads (such
+    as those of a :class:`genemail.sender.QueuedSender` or
+    :class:`genemail.sender.AsyncSmtpSender`).
+    '''
+    results = self._renderMany(
+      name, paramsIterable, processes, ordered, chunksize)
+    if not send:
+      return results
+    count = 0
+    for result in results:
+      self.sender.send(result.mailfrom, result.recipients, result.message)
+      count += 1
+    return count
+
+  def _renderMany(self, name, paramsIterable, processes, ordered, chunksize):
+    items = enumerate(paramsIterable)
+    if processes == 1 or not hasattr(os, 'fork'):
+      prototype = self.compile(name)
+      for item in items:
+        yield _render(prototype, item)
+      return
+    key = next(_poolCounter)
+    _poolManagers[key] = self
+    try:
+      pool = multiprocessing.Pool(processes, _renderInit, (key, name))
+      try:
+        mapper = pool.imap if ordered else pool.imap_unordered
+        for result in mapper(_renderOne, items, chunksize):
+          yield adict(result)
+        pool.close()
+      finally:
+        pool.terminate()
+        pool.join()
+    finally:
+      del _poolManagers[key]
 
 #------------------------------------------------------------------------------
 # end of $Id$
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# lib:  genemail.outbox
+# auth: Philip J Grabner <grabner@cadit.com>
+# date: 2013/12/02
+# copy: (C) Copyright 2013 Cadit Health Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+'''
+A durable outbox of messages stored in a local SQLite database (in
+WAL mode, so that readers never block the writer). Any number of
+processes on the same host can add messages and, concurrently, claim
+batches of them for delivery: a claim is a single ``BEGIN IMMEDIATE``
+transaction that flips the claimed rows from ``pending`` to
+``sending``, so no message is ever claimed twice. Failed deliveries
+are rescheduled with exponential backoff until `maxAttempts` is
+reached. When a message is delivered but some of its recipients are
+refused permanently, a ``failed`` copy of it is added with just those
+recipients.
+'''
+
+from __future__ import absolute_import
+
+__all__ = ('Outbox', 'OutboxSender')
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+
+from templatealchemy.util import adict
+
+from .sender import Sender, messageString, isPermanentError, \
+    isConnectionError, splitRefused
+
+#------------------------------------------------------------------------------
+class Outbox(object):
+  '''
+  The outbox stored in the SQLite database file `path` (which is
+  created if it does not exist).
+
+  :Parameters:
+
+  path : str
+    the database file name.
+
+  timeout : float, optional, default: 30
+    the number of seconds to wait for another process' write
+    transaction to complete.
+
+  maxAttempts : int, optional, default: 5
+    the number of delivery attempts after which a transiently failing
+    message is marked as failed.
+
+  backoff : float, optional, default: 60
+    the delay, in seconds, before the first retry; it doubles with
+    each subsequent attempt.
+  '''
+
+  schema = \
+    'CREATE TABLE IF NOT EXISTS outbox (' \
+    ' id INTEGER PRIMARY KEY AUTOINCREMENT,' \
+    ' mailfrom TEXT NOT NULL,' \
+    ' recipients TEXT NOT NULL,' \
+    ' message BLOB NOT NULL,' \
+    ' status TEXT NOT NULL DEFAULT \'pending\',' \
+    ' attempts INTEGER NOT NULL DEFAULT 0,' \
+    ' created REAL NOT NULL,' \
+    ' nextAttempt REAL NOT NULL,' \
+    ' claimedAt REAL,' \
+    ' claimedBy TEXT,' \
+    ' error TEXT);' \
+    'CREATE INDEX IF NOT EXISTS outbox_status' \
+    ' ON outbox (status, nextAttempt);'
+
+  #----------------------------------------------------------------------------
+  def __init__(self, path, timeout=30, maxAttempts=5, backoff=60):
+    self.path        = path
+    self.timeout     = timeout
+    self.maxAttempts = maxAttempts
+    self.backoff     = backoff
+    self._local      = threading.local()
+    self.db.executescript(self.schema)
+
+  #----------------------------------------------------------------------------
+  @property
+  def db(self):
+    '''
+    The SQLite connection of the current thread (connections are
+    neither shared between threads nor inherited by forked processes).
+    '''
+    if getattr(self._local, 'pid', None) != os.getpid():
+      self._local.db = sqlite3.connect(
+        self.path, timeout=self.timeout, isolation_level=None)
+      self._local.db.execute('PRAGMA journal_mode=WAL')
+      self._local.pid = os.getpid()
+    return self._local.db
+
+  #----------------------------------------------------------------------------
+  def put(self, mailfrom, recipients, message):
+    'Adds a message to the outbox and returns its ID.'
+    if isinstance(recipients, basestring):
+      recipients = [recipients]
+    now = time.time()
+    return self.db.execute(
+      'INSERT INTO outbox (mailfrom, recipients, message, created, nextAttempt)'
+      ' VALUES (?, ?, ?, ?, ?)',
+      (mailfrom, json.dumps(recipients), sqlite3.Binary(message), now, now)
+    ).lastrowid
+
+  #----------------------------------------------------------------------------
+  def claim(self, limit=100, worker=None):
+    '''
+    Claims (at most `limit`) pending messages that are due, oldest
+    first, on behalf of `worker` (which defaults to "HOST:PID"), and
+    returns a list of adicts with the attributes `id`, `mailfrom`,
+    `recipients`, `message` and `attempts`. Each claimed message must
+    eventually be passed to :meth:`ack` or :meth:`retry` (or
+    :meth:`fail`).
+    '''
+    worker = worker or '%s:%d' % (socket.gethostname(), os.getpid())
+    now = time.time()
+    db  = self.db
+    db.execute('BEGIN IMMEDIATE')
+    try:
+      rows = db.execute(
+        'SELECT id, mailfrom, recipients, message, attempts FROM outbox'
+        ' WHERE status = \'pending\' AND nextAttempt <= ?'
+        ' ORDER BY nextAttempt, id LIMIT ?', (now, limit)).fetchall()
+      db.executemany(
+        'UPDATE outbox SET status = \'sending\', claimedAt = ?, claimedBy = ?'
+        ' WHERE id = ?', [(now, worker, row[0]) for row in rows])
+    except Exception:
+      db.execute('ROLLBACK')
+      raise
+    db.execute('COMMIT')
+    return [
+      adict(id=row[0], mailfrom=row[1], recipients=json.loads(row[2]),
+            message=str(row[3]), attempts=row[4])
+      for row in rows]
+
+  #----------------------------------------------------------------------------
+  def ack(self, entry):
+    'Marks the claimed message `entry` as sent.'
+    self.db.execute(
+      'UPDATE outbox SET status = \'sent\', attempts = attempts + 1,'
+      ' error = NULL WHERE id = ?', (entry.id,))
+
+  #----------------------------------------------------------------------------
+  def fail(self, entry, error=None):
+    'Marks the claimed message `entry` as permanently failed.'
+    self.db.execute(
+      'UPDATE outbox SET status = \'failed\', attempts = attempts + 1,'
+      ' error = ? WHERE id = ?', (None if error is None else str(error), entry.id))
+
+  #----------------------------------------------------------------------------
+  def release(self, entry):
+    '''
+    Returns the claimed message `entry` to the pending state, without
+    counting a delivery attempt (e.g. because the connection failed
+    before it could be attempted).
+    '''
+    self.db.execute(
+      'UPDATE outbox SET status = \'pending\' WHERE id = ?', (entry.id,))
+
+  #----------------------------------------------------------------------------
+  def refuse(self, entry, refused):
+    '''
+    Records that the claimed message `entry` was permanently refused
+    for the recipients in the dictionary `refused` (e.g. as returned
+    by :meth:`genemail.sender.SmtpSender.send`) by adding a failed copy
+    of it with just these recipients (and `refused`, JSON-encoded, as
+    the error). The claimed message itself is not affected.
+    '''
+    now = time.time()
+    self.db.execute(
+      'INSERT INTO outbox (mailfrom, recipients, message, status, attempts,'
+      ' created, nextAttempt, error) VALUES (?, ?, ?, \'failed\', ?, ?, ?, ?)',
+      (entry.mailfrom,
+       json.dumps([rcpt for rcpt in entry.recipients if rcpt in refused]),
+       sqlite3.Binary(entry.message), entry.attempts + 1, now, now,
+       json.dumps(refused)))
+
+  #----------------------------------------------------------------------------
+  def retry(self, entry, error=None, recipients=None):
+    '''
+    Reschedules the claimed message `entry` after a transient failure
+    (with exponential backoff), or marks it as failed if it has
+    reached `maxAttempts`. If `recipients` is specified, the message's
+    recipients are first replaced by it (e.g. because it was delivered
+    to the others). Returns true if it was rescheduled.
+    '''
+    if recipients is not None:
+      entry.recipients = list(recipients)
+      self.db.execute(
+        'UPDATE outbox SET recipients = ? WHERE id = ?',
+        (json.dumps(entry.recipients), entry.id))
+    attempts = entry.attempts + 1
+    if attempts >= self.maxAttempts:
+      self.fail(entry, error)
+      return False
+    self.db.execute(
+      'UPDATE outbox SET status = \'pending\', attempts = ?,'
+      ' nextAttempt = ?, error = ? WHERE id = ?',
+      (attempts, time.time() + self.backoff * 2 ** (attempts - 1),
+       None if error is None else str(error), entry.id))
+    return True
+
+  #----------------------------------------------------------------------------
+  def recover(self, age):
+    '''
+    Returns messages that were claimed more than `age` seconds ago but
+    never acknowledged (e.g. because the worker died) to the pending
+    state. Returns the number of messages recovered.
+    '''
+    return self.db.execute(
+      'UPDATE outbox SET status = \'pending\''
+      ' WHERE status = \'sending\' AND claimedAt < ?',
+      (time.time() - age,)).rowcount
+
+  #----------------------------------------------------------------------------
+  def purge(self, age=0):
+    '''
+    Deletes sent messages that were created more than `age` seconds
+    ago. Returns the number of messages deleted.
+    '''
+    return self.db.execute(
+      'DELETE FROM outbox WHERE status = \'sent\' AND created <= ?',
+      (time.time() - age,)).rowcount
+
+  #----------------------------------------------------------------------------
+  def stats(self):
+    '''
+    Returns an adict with the number of messages in each state
+    (`pending`, `sending`, `sent` and `failed`), the queue `depth`
+    (pending plus sending) and the age, in seconds, of the `oldest`
+    undelivered message (or ``None`` if there is none).
+    '''
+    ret = adict(pending=0, sending=0, sent=0, failed=0)
+    for status, count in self.db.execute(
+        'SELECT status, COUNT(*) FROM outbox GROUP BY status'):
+      ret[status] = count
+    ret.depth = ret.pending + ret.sending
+    oldest = self.db.execute(
+      'SELECT MIN(created) FROM outbox'
+      ' WHERE status IN (\'pending\', \'sending\')').fetchone()[0]
+    ret.oldest = None if oldest is None else time.time() - oldest
+    return ret
+
+  #----------------------------------------------------------------------------
+  def drain(self, sender, batch=100, worker=None):
+    '''
+    Claims and delivers all messages that are currently due via
+    `sender`, on behalf of `worker` (see :meth:`claim`). Delivered
+    messages are acknowledged, messages that fail with a permanent
+    error (see :func:`isPermanentError`) are marked as failed and all
+    others are rescheduled individually (see :meth:`retry`). If the
+    connection to the server fails (see :func:`isConnectionError`),
+    the remaining messages are released without counting an attempt
+    and the drain stops. If `sender` reports refused recipients (see
+    :func:`genemail.sender.splitRefused`), the message is retried for
+    the transiently refused ones and recorded as failed for the
+    permanently refused ones (see :meth:`refuse`). Returns an adict
+    with the number of messages `sent`, `failed` and `deferred`; a
+    partially delivered message counts towards each of the outcomes
+    of its recipients.
+    '''
+    ret = adict(sent=0, failed=0, deferred=0)
+    while True:
+      entries = self.claim(batch, worker)
+      if not entries:
+        return ret
+      for idx, entry in enumerate(entries):
+        try:
+          refused = sender.send(entry.mailfrom, entry.recipients, entry.message)
+        except Exception as exc:
+          if isPermanentError(exc):
+            self.fail(entry, exc)
+            ret.failed += 1
+          elif isConnectionError(exc):
+            # note: the failure is not the message's fault, so leave it
+            #       (and the rest of this batch) for the next drain
+            for entry in entries[idx:]:
+              self.release(entry)
+            ret.deferred += len(entries) - idx
+            return ret
+          elif self.retry(entry, exc):
+            ret.deferred += 1
+          else:
+            ret.failed += 1
+          continue
+        transient, permanent = splitRefused(refused)
+        if len(transient) + len(permanent) < len(entry.recipients):
+          ret.sent += 1
+        if permanent:
+          self.refuse(entry, permanent)
+          ret.failed += 1
+        if not transient:
+          self.ack(entry)
+        elif self.retry(entry, json.dumps(transient), [
+            rcpt for rcpt in entry.recipients if rcpt in transient]):
+          ret.deferred += 1
+        else:
+          ret.failed += 1
+
+#------------------------------------------------------------------------------
+class OutboxSender(Sender):
+  '''
+  A :class:`genemail.sender.Sender` that adds each message to the
+  :class:`Outbox` stored in the SQLite database `path` and returns its
+  ID immediately. The messages are then delivered separately, e.g. by
+  one or more ``genemail drain --outbox`` processes. Any additional
+  keyword arguments are passed to the :class:`Outbox`.
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self, path, *args, **kwargs):
+    outbox = dict((key, kwargs.pop(key))
+                  for key in ('timeout', 'maxAttempts', 'backoff')
+                  if key in kwargs)
+    super(OutboxSender, self).__init__(*args, **kwargs)
+    self.outbox = Outbox(path, **outbox)
+
+  #----------------------------------------------------------------------------
+  def send(self, mailfrom, recipients, message):
+    return self.outbox.put(mailfrom, recipients, messageString(message))
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
@@ -18,20 +18,150 @@ comparison.
 
 from __future__ import absolute_import
 
-__all__ = ('Sender', 'StoredSender', 'SmtpSender', 'DebugSender')
+__all__ = ('Sender', 'StoredSender', 'SmtpSender', 'PooledSmtpSender',
+           'AsyncSmtpSender', 'QueuedSender', 'RetryingSender', 'DebugSender',
+           'isPermanentError', 'isTransientError', 'isConnectionError',
+           'splitRefused')
 
+import os
+import re
+import sys
+import time
+import Queue
+import random
+import base64
+import socket
 import smtplib
+import asyncore
+import asynchat
+import threading
+import collections
 import email.parser
 
 from templatealchemy.util import adict
 
+from .future import Future, Scheduler
+
+#------------------------------------------------------------------------------
+def iterMessage(message, chunksize=65536):
+  '''
+  Returns an iterator over the string chunks of `message`, which can
+  be a string, an iterable of strings, or a file-like object (i.e. an
+  object with a `read` method), in which case it is read `chunksize`
+  bytes at a time.
+  '''
+  if isinstance(message, basestring):
+    return iter([message])
+  if hasattr(message, 'read'):
+    return iter(lambda: message.read(chunksize), '')
+  return iter(message)
+
+#------------------------------------------------------------------------------
+def messageString(message):
+  '''
+  Returns `message` (any of the types supported by :func:`iterMessage`)
+  as a single string.
+  '''
+  if isinstance(message, basestring):
+    return message
+  return ''.join(iterMessage(message))
+
+#------------------------------------------------------------------------------
+def isPermanentError(exc):
+  '''
+  Returns true if the sending exception `exc` indicates that retrying
+  the delivery would fail again, i.e. the server responded with a 5xx
+  code (for all recipients).
+  '''
+  if isinstance(exc, smtplib.SMTPRecipientsRefused):
+    return all(code >= 500 for code, resp in exc.recipients.values())
+  if isinstance(exc, smtplib.SMTPResponseException):
+    return exc.smtp_code >= 500
+  return False
+
+#------------------------------------------------------------------------------
+def isTransientError(exc):
+  '''
+  Returns true if the sending exception `exc` indicates a temporary
+  condition, i.e. the server responded with a 4xx code (for at least
+  one recipient) or the connection failed; a later retry may succeed.
+  '''
+  if isinstance(exc, smtplib.SMTPRecipientsRefused):
+    return any(400 <= code < 500 for code, resp in exc.recipients.values())
+  if isinstance(exc, smtplib.SMTPResponseException):
+    return 400 <= exc.smtp_code < 500
+  return isinstance(exc, (smtplib.SMTPException, socket.error))
+
+#------------------------------------------------------------------------------
+def isConnectionError(exc):
+  '''
+  Returns true if the sending exception `exc` indicates that the
+  connection to the server failed or was closed (or is about to be
+  closed, i.e. the server responded with a 421 code), rather than a
+  problem with the message being sent.
+  '''
+  if isinstance(exc, smtplib.SMTPRecipientsRefused):
+    return any(code == 421 for code, resp in exc.recipients.values())
+  if isinstance(exc, smtplib.SMTPConnectError):
+    return True
+  if isinstance(exc, smtplib.SMTPResponseException):
+    return exc.smtp_code == 421
+  return isinstance(exc, (smtplib.SMTPServerDisconnected, socket.error))
+
+#------------------------------------------------------------------------------
+def splitRefused(refused):
+  '''
+  Splits the dictionary of refused recipients `refused` (as returned
+  by, e.g., :meth:`SmtpSender.send`) into the tuple (transient,
+  permanent) of dictionaries of the recipients that were refused with
+  a 4xx code and with any other code. Any other value (e.g. the
+  ``None`` returned by senders that do not report refused recipients)
+  is treated as an empty dictionary.
+  '''
+  transient = {}
+  permanent = {}
+  if isinstance(refused, dict):
+    for rcpt, (code, resp) in refused.items():
+      if 400 <= code < 500:
+        transient[rcpt] = (code, resp)
+      else:
+        permanent[rcpt] = (code, resp)
+  return (transient, permanent)
+
+#------------------------------------------------------------------------------
+def iterEnvelopes(messages):
+  '''
+  Generates ``(mailfrom, recipients, message)`` tuples from the
+  messages passed to :meth:`Sender.sendMany`.
+  '''
+  for item in messages:
+    if isinstance(item, tuple):
+      yield item
+    else:
+      yield (item.mailfrom, item.recipients, item.message)
+
+#------------------------------------------------------------------------------
+def sendResult(mailfrom, recipients, result=None, error=None):
+  'Returns a :meth:`Sender.sendMany` result entry.'
+  return adict(mailfrom=mailfrom, recipients=recipients,
+               result=result, error=error)
+
 #------------------------------------------------------------------------------
 class Sender(object):
   '''
   Abstract interface for an object capable of sending a genemail email
   out, usually to an SMTP MTA.
+
+  Senders that set the :attr:`streaming` attribute to true indicate
+  that they can accept the message as an iterable of string chunks or
+  a file-like object, in which case :meth:`genemail.email.Email.send`
+  will pass the message in that form and avoid building the entire
+  serialized message as one string. Otherwise, the message is always
+  passed as a string.
   '''
 
+  streaming = False
+
   #----------------------------------------------------------------------------
   def send(self, mailfrom, recipients, message):
     '''
@@ -46,12 +176,44 @@ class Sender(object):
     recipients : list(str)
       equivalent to the SMTP ``RCPT TO`` command.
 
-    message : str
+    message : { str, iterable(str), file }
       the actuall message to be transferred, equivalent to the payload of
-      the SMTP ``DATA`` command.
+      the SMTP ``DATA`` command. Only senders that have the
+      :attr:`streaming` attribute set are passed anything but a `str`,
+      but all of the senders in this module accept all three forms
+      (see :func:`iterMessage`).
     '''
     raise NotImplementedError()
 
+  #----------------------------------------------------------------------------
+  def sendMany(self, messages):
+    '''
+    Sends each message in the iterable `messages`, where each message
+    is either a ``(mailfrom, recipients, message)`` tuple or an object
+    with those attributes (e.g. as returned by
+    :meth:`genemail.email.Email.getSmtpMessage` or
+    :meth:`genemail.manager.Manager.renderMany`); see :meth:`send` for
+    the parameters. A failure to send one message does not prevent
+    the others from being sent.
+
+    Returns a list with one adict per message, in the same order, with
+    the attributes `mailfrom`, `recipients`, `result` (the return
+    value of :meth:`send`, e.g. the dictionary of refused recipients)
+    and `error` (the exception raised while sending it, or ``None``).
+
+    The default implementation simply calls :meth:`send` for each
+    message; subclasses override it to amortize setup costs over the
+    whole batch (e.g. to use a single SMTP connection).
+    '''
+    ret = []
+    for mailfrom, recipients, message in iterEnvelopes(messages):
+      try:
+        ret.append(sendResult(
+          mailfrom, recipients, self.send(mailfrom, recipients, message)))
+      except Exception as exc:
+        ret.append(sendResult(mailfrom, recipients, error=exc))
+    return ret
+
 #------------------------------------------------------------------------------
 class SmtpSender(Sender):
   '''
@@ -78,12 +240,26 @@ class SmtpSender(Sender):
 
   password : str, optional
     set the password for the `username`.
+
+  maxRecipients : int, optional, default: 100
+    the maximum number of recipients per SMTP transaction; messages
+    with more recipients are sent in several transactions over the
+    same connection (see :meth:`sendmail`). If ``None``, all
+    recipients are sent in a single transaction.
+
+  The message is written to the server incrementally (with the
+  necessary line ending normalization and dot-stuffing applied
+  per chunk), so a streamed message is never assembled into a single
+  string.
   '''
 
+  streaming = True
+
   #----------------------------------------------------------------------------
   def __init__(self,
                host='localhost', port=25, ssl=False, starttls=False,
-               username=None, password=None, *args, **kwargs):
+               username=None, password=None, maxRecipients=100,
+               *args, **kwargs):
     super(SmtpSender, self).__init__(*args, **kwargs)
     self.smtpHost = host or 'localhost'
     self.smtpPort = port or 25
@@ -91,17 +267,955 @@ class SmtpSender(Sender):
     self.password = password
     self.starttls = starttls
     self.ssl      = ssl
+    self.maxRecipients = maxRecipients
 
   #----------------------------------------------------------------------------
   def send(self, mailfrom, recipients, message):
+    '''
+    Sends the message over a new connection and returns the
+    dictionary of refused recipients (see :meth:`sendmail`).
+    '''
+    smtp = self.connect()
+    try:
+      return self.sendmail(smtp, mailfrom, recipients, message)
+    finally:
+      self._quit(smtp)
+
+  #----------------------------------------------------------------------------
+  def sendMany(self, messages):
+    '''
+    Sends all `messages` over a single connection (see
+    :meth:`Sender.sendMany`). Messages rejected by the server do not
+    affect the connection; if the connection itself fails or the
+    server closes it (see :func:`isConnectionError`), a new one is
+    established for the next message.
+    '''
+    ret  = []
+    smtp = None
+    try:
+      for mailfrom, recipients, message in iterEnvelopes(messages):
+        try:
+          if smtp is None:
+            smtp = self.connect()
+          result = self.sendmail(smtp, mailfrom, recipients, message)
+          ret.append(sendResult(mailfrom, recipients, result))
+          # note: a 421 means that the server is closing the connection
+          closing = any(code == 421 for code, resp in result.values())
+        except Exception as exc:
+          ret.append(sendResult(mailfrom, recipients, error=exc))
+          closing = isConnectionError(exc) or not isinstance(
+            exc, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused))
+        if closing and smtp is not None:
+          smtp.close()
+          smtp = None
+    finally:
+      if smtp is not None:
+        self._quit(smtp)
+    return ret
+
+  #----------------------------------------------------------------------------
+  def _quit(self, smtp):
+    # note: the messages have already been sent at this point, so a
+    #       failing QUIT (e.g. after a 421) must not mask the result
+    try:
+      smtp.quit()
+    except (smtplib.SMTPException, socket.error):
+      smtp.close()
+
+  #----------------------------------------------------------------------------
+  def connect(self):
+    '''
+    Returns a new :class:`smtplib.SMTP` connection to the configured
+    server, with STARTTLS and authentication already performed (if
+    configured).
+    '''
     smtp = smtplib.SMTP_SSL() if self.ssl else smtplib.SMTP()
     smtp.connect(self.smtpHost, self.smtpPort)
     if self.starttls:
       smtp.starttls()
     if self.username is not None:
       smtp.login(self.username, self.password)
-    smtp.sendmail(mailfrom, recipients, message)
-    smtp.quit()
+    return smtp
+
+  #----------------------------------------------------------------------------
+  def sendmail(self, smtp, mailfrom, recipients, message):
+    '''
+    Equivalent to :meth:`smtplib.SMTP.sendmail`, but `message` can be
+    any of the types supported by :func:`iterMessage`, and is written
+    to the connection `smtp` chunk by chunk. Note that the ESMTP
+    ``SIZE`` parameter is not sent, since the message size is not
+    known in advance. Returns the dictionary of refused recipients.
+
+    If there are more than `maxRecipients` recipients, the message is
+    sent in several transactions of at most `maxRecipients` each
+    (which requires the message to be held in memory). Recipients
+    that are refused with a transient (4xx) code, e.g. because the
+    server limits the number of recipients per transaction, are then
+    retried in further transactions for as long as each round
+    delivers the message to at least one recipient. In this mode,
+    an exception is only raised if the message was not delivered to
+    any recipient; otherwise, the recipients of failed transactions
+    are returned as refused (with the failure's code and response).
+    If the connection fails (see :func:`isConnectionError`) after
+    the message was delivered, the recipients of the failed and of
+    all unsent transactions are returned as refused with a transient
+    code (the failure's code or, if there is none, 421).
+    '''
+    if isinstance(recipients, basestring):
+      recipients = [recipients]
+    limit = self.maxRecipients
+    if not limit or len(recipients) <= limit:
+      return self._transaction(smtp, mailfrom, recipients, message)
+    message   = messageString(message)
+    refused   = {}
+    delivered = False
+    pending   = list(collections.OrderedDict.fromkeys(recipients))
+    while pending:
+      retry    = {}
+      progress = False
+      for idx in range(0, len(pending), limit):
+        chunk = pending[idx:idx + limit]
+        try:
+          result = self._transaction(smtp, mailfrom, chunk, message)
+        except smtplib.SMTPRecipientsRefused as exc:
+          result = exc.recipients
+        except Exception as exc:
+          if not delivered:
+            raise
+          if not isConnectionError(exc) \
+              and isinstance(exc, smtplib.SMTPResponseException):
+            result = dict.fromkeys(chunk, (exc.smtp_code, exc.smtp_error))
+          else:
+            # note: the connection is unusable, so the recipients of
+            #       this and all unsent transactions are deferred
+            error = (getattr(exc, 'smtp_code', 421),
+                     getattr(exc, 'smtp_error', str(exc)))
+            refused.update(retry)
+            refused.update(dict.fromkeys(pending[idx:], error))
+            return refused
+        if len(result) < len(chunk):
+          delivered = progress = True
+        for rcpt, (code, resp) in result.items():
+          if 400 <= code < 500:
+            retry[rcpt] = (code, resp)
+          else:
+            refused[rcpt] = (code, resp)
+      if not progress:
+        refused.update(retry)
+        break
+      pending = [rcpt for rcpt in pending if rcpt in retry]
+    if not delivered:
+      raise smtplib.SMTPRecipientsRefused(refused)
+    return refused
+
+  #----------------------------------------------------------------------------
+  def _transaction(self, smtp, mailfrom, recipients, message):
+    self._mail(smtp, mailfrom)
+    refused = {}
+    for rcpt in recipients:
+      code, resp = smtp.rcpt(rcpt)
+      if code not in (250, 251):
+        refused[rcpt] = (code, resp)
+    if len(refused) == len(recipients):
+      smtp.rset()
+      raise smtplib.SMTPRecipientsRefused(refused)
+    smtp.putcmd('data')
+    code, resp = smtp.getreply()
+    if code != 354:
+      smtp.rset()
+      raise smtplib.SMTPDataError(code, resp)
+    encoder = DataEncoder()
+    try:
+      for chunk in iterMessage(message):
+        data = encoder.encode(chunk)
+        if data:
+          smtp.send(data)
+      smtp.send(encoder.close())
+    except Exception:
+      # note: the server is still reading the DATA, so the transaction
+      #       cannot be aborted (and a QUIT would never be answered);
+      #       the only option is to drop the connection
+      smtp.close()
+      raise
+    code, resp = smtp.getreply()
+    if code != 250:
+      smtp.rset()
+      raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+  #----------------------------------------------------------------------------
+  def _mail(self, smtp, mailfrom):
+    smtp.ehlo_or_helo_if_needed()
+    code, resp = smtp.mail(mailfrom)
+    if code != 250:
+      smtp.rset()
+      raise smtplib.SMTPSenderRefused(code, resp, mailfrom)
+
+#------------------------------------------------------------------------------
+class PooledSmtpSender(SmtpSender):
+  '''
+  A :class:`SmtpSender` that keeps a bounded pool of connected (and
+  authenticated) SMTP connections alive and reuses them for
+  subsequent messages, avoiding the connection, TLS and login
+  overhead per message. It is safe to use from multiple threads. In
+  addition to the :class:`SmtpSender` parameters:
+
+  :Parameters:
+
+  poolSize : int, optional, default: 4
+    the maximum number of concurrent connections; when all are in
+    use, :meth:`send` blocks until one is released.
+
+  maxMessages : int, optional, default: 100
+    the number of messages after which a connection is closed and
+    replaced by a new one; if ``None``, connections are reused
+    indefinitely.
+
+  idleTimeout : float, optional, default: 60
+    the number of seconds after which an unused connection is closed
+    (instead of being reused).
+
+  checkInterval : float, optional, default: 5
+    the number of seconds of inactivity after which a connection is
+    checked with a ``NOOP`` command before being reused; connections
+    that fail the check are transparently replaced.
+
+  Transactions that the server rejects are aborted with ``RSET`` (see
+  :meth:`SmtpSender.sendmail`) and the connection is reused; a 421
+  reply or any other error (e.g. a dropped connection) discards it.
+  If a reused connection fails before the server accepted the
+  ``MAIL FROM`` command (e.g. because the server closed it while it
+  was idle), the message is retried once on a new connection. Call
+  :meth:`close` to close all idle connections (e.g. on shutdown).
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self, poolSize=4, maxMessages=100, idleTimeout=60,
+               checkInterval=5, *args, **kwargs):
+    super(PooledSmtpSender, self).__init__(*args, **kwargs)
+    self.poolSize      = poolSize
+    self.maxMessages   = maxMessages
+    self.idleTimeout   = idleTimeout
+    self.checkInterval = checkInterval
+    self._idle  = []
+    self._lock  = threading.Lock()
+    self._slots = threading.BoundedSemaphore(poolSize)
+    self._local = threading.local()
+
+  #----------------------------------------------------------------------------
+  def send(self, mailfrom, recipients, message):
+    if isinstance(recipients, basestring):
+      recipients = [recipients]
+    if self.maxRecipients and len(recipients) > self.maxRecipients:
+      # note: :meth:`sendmail` would consume the message up front, so
+      #       that it could not be retried
+      message = messageString(message)
+    conn = self.acquire()
+    while True:
+      self._local.mailAccepted = False
+      try:
+        ret = self.sendmail(conn.smtp, mailfrom, recipients, message)
+        break
+      except Exception as exc:
+        # note: if the server rejected the transaction (and
+        #       :meth:`sendmail` has already reset it), the connection
+        #       is still usable -- unless the server is closing it
+        usable = not isConnectionError(exc) and isinstance(
+          exc, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused))
+        self.release(conn, discard=not usable)
+        if usable or not conn.reused or self._local.mailAccepted:
+          raise
+      conn = self.acquire(reuse=False)
+    conn.count += 1
+    self.release(conn, discard=any(code == 421 for code, resp in ret.values()))
+    return ret
+
+  #----------------------------------------------------------------------------
+  def _mail(self, smtp, mailfrom):
+    super(PooledSmtpSender, self)._mail(smtp, mailfrom)
+    self._local.mailAccepted = True
+
+  #----------------------------------------------------------------------------
+  def sendMany(self, messages):
+    # note: the default implementation, which uses pooled connections
+    return Sender.sendMany(self, messages)
+
+  #----------------------------------------------------------------------------
+  def acquire(self, reuse=True):
+    '''
+    Returns a pooled connection (an adict with the attributes `smtp`,
+    `count`, `lastUsed` and `reused`), reusing a healthy idle one if
+    possible (and `reuse` is true). Must be paired with a call to
+    :meth:`release`.
+    '''
+    self._slots.acquire()
+    try:
+      while True:
+        with self._lock:
+          conn = self._idle.pop() if reuse and self._idle else None
+        if conn is None:
+          return adict(smtp=self.connect(), count=0, lastUsed=time.time(),
+                       reused=False)
+        if self._check(conn):
+          conn.reused = True
+          return conn
+        self._close(conn)
+    except Exception:
+      self._slots.release()
+      raise
+
+  #----------------------------------------------------------------------------
+  def _check(self, conn):
+    idle = time.time() - conn.lastUsed
+    if self.idleTimeout is not None and idle >= self.idleTimeout:
+      return False
+    try:
+      if self.checkInterval is not None and idle >= self.checkInterval:
+        if conn.smtp.noop()[0] != 250:
+          return False
+    except (smtplib.SMTPException, socket.error):
+      return False
+    return True
+
+  #----------------------------------------------------------------------------
+  def release(self, conn, discard=False):
+    '''
+    Returns the connection `conn` (as returned by :meth:`acquire`) to
+    the pool, or closes it if `discard` is true or it has reached
+    `maxMessages`.
+    '''
+    try:
+      if discard or ( self.maxMessages is not None
+                      and conn.count >= self.maxMessages ):
+        self._close(conn)
+      else:
+        conn.lastUsed = time.time()
+        with self._lock:
+          self._idle.append(conn)
+    finally:
+      self._slots.release()
+
+  #----------------------------------------------------------------------------
+  def _close(self, conn):
+    self._quit(conn.smtp)
+
+  #----------------------------------------------------------------------------
+  def close(self):
+    'Closes all idle connections.'
+    with self._lock:
+      idle, self._idle = self._idle, []
+    for conn in idle:
+      self._close(conn)
+
+#------------------------------------------------------------------------------
+class AsyncSmtpSender(SmtpSender):
+  '''
+  A :class:`SmtpSender` that performs the SMTP transactions
+  asynchronously: :meth:`sendAsync` queues the message and returns a
+  :class:`genemail.future.Future` immediately, while a single
+  background thread drives all queued transactions concurrently with
+  non-blocking sockets (via :mod:`asyncore`), so that one process can
+  keep many transactions in flight to a relay. :meth:`send` is the
+  blocking equivalent. The background thread is started on demand and
+  exits when there is nothing left to send. In addition to the
+  :class:`SmtpSender` parameters:
+
+  :Parameters:
+
+  concurrency : int, optional, default: 100
+    the maximum number of simultaneous transactions (and therefore
+    connections); further messages wait in the queue.
+
+  timeout : float, optional, default: 60
+    the number of seconds without any activity on a connection after
+    which its transaction is aborted.
+
+  Each transaction uses its own connection. The `ssl` and `starttls`
+  options are not supported; `username` and `password` are sent with
+  ``AUTH PLAIN``.
+  '''
+
+  pollInterval = 0.05
+
+  #----------------------------------------------------------------------------
+  def __init__(self, concurrency=100, timeout=60, *args, **kwargs):
+    super(AsyncSmtpSender, self).__init__(*args, **kwargs)
+    if self.ssl or self.starttls:
+      raise ValueError('AsyncSmtpSender does not support SSL or STARTTLS')
+    self.concurrency = concurrency
+    self.timeout     = timeout
+    self.fqdn        = None
+    self._map        = {}
+    self._jobs       = collections.deque()
+    self._lock       = threading.Lock()
+    self._running    = False
+
+  #----------------------------------------------------------------------------
+  def send(self, mailfrom, recipients, message):
+    return self.sendAsync(mailfrom, recipients, message).result()
+
+  #----------------------------------------------------------------------------
+  def sendMany(self, messages):
+    'Sends all `messages` concurrently (see :meth:`Sender.sendMany`).'
+    futures = [(mailfrom, recipients,
+                self.sendAsync(mailfrom, recipients, message))
+               for mailfrom, recipients, message in iterEnvelopes(messages)]
+    return [sendResult(mailfrom, recipients, error=future.exception())
+            if future.exception() is not None
+            else sendResult(mailfrom, recipients, future.result())
+            for mailfrom, recipients, future in futures]
+
+  #----------------------------------------------------------------------------
+  def sendAsync(self, mailfrom, recipients, message):
+    '''
+    Queues the message for sending and returns a
+    :class:`genemail.future.Future` that resolves to the dictionary of
+    refused recipients (see :meth:`SmtpSender.sendmail`), or to the
+    exception that aborted the transaction. See :meth:`Sender.send`
+    for the parameters; note that if `message` is an iterable or a
+    file, it is consumed in the background thread.
+    '''
+    if isinstance(recipients, basestring):
+      recipients = [recipients]
+    limit = self.maxRecipients
+    if limit and len(recipients) > limit:
+      return self._sendChunks(mailfrom, recipients, messageString(message))
+    ret = Future()
+    with self._lock:
+      self._jobs.append((ret, mailfrom, recipients, message))
+      if not self._running:
+        self._running = True
+        thread = threading.Thread(target=self._loop, name='genemail-smtp')
+        thread.daemon = True
+        thread.start()
+    return ret
+
+  #----------------------------------------------------------------------------
+  def _sendChunks(self, mailfrom, recipients, message):
+    # sends the message in concurrent transactions of at most
+    # `maxRecipients` recipients each, with the same semantics as
+    # SmtpSender.sendmail: recipients refused with a transient code
+    # (or whose transaction failed) are retried in further rounds for
+    # as long as each round delivers the message to at least one
+    # recipient
+    ret   = Future()
+    state = adict(refused={}, errors=[], delivered=False)
+    def _round(pending):
+      chunks = [pending[idx:idx + self.maxRecipients]
+                for idx in range(0, len(pending), self.maxRecipients)]
+      futures  = [self.sendAsync(mailfrom, chunk, message) for chunk in chunks]
+      lock     = threading.Lock()
+      finished = []
+      def _done(future):
+        if not all(future.done() for future in futures):
+          return
+        with lock:
+          if finished:
+            return
+          finished.append(True)
+        retry    = {}
+        progress = False
+        for chunk, future in zip(chunks, futures):
+          exc = future.exception()
+          if exc is None:
+            result = future.result()
+          elif isinstance(exc, smtplib.SMTPRecipientsRefused):
+            result = exc.recipients
+          else:
+            state.errors.append(exc)
+            result = dict.fromkeys(chunk, (
+              getattr(exc, 'smtp_code', 421),
+              getattr(exc, 'smtp_error', str(exc))))
+          if len(result) < len(chunk):
+            state.delivered = progress = True
+          for rcpt, (code, resp) in result.items():
+            if 400 <= code < 500:
+              retry[rcpt] = (code, resp)
+            else:
+              state.refused[rcpt] = (code, resp)
+        if progress and retry:
+          return _round([rcpt for rcpt in pending if rcpt in retry])
+        state.refused.update(retry)
+        if state.delivered:
+          return ret.set_result(state.refused)
+        if state.errors:
+          return ret.set_exception(state.errors[0])
+        ret.set_exception(smtplib.SMTPRecipientsRefused(state.refused))
+      for future in futures:
+        future.add_done_callback(_done)
+    _round(list(collections.OrderedDict.fromkeys(recipients)))
+    return ret
+
+  #----------------------------------------------------------------------------
+  def _loop(self):
+    if self.fqdn is None:
+      self.fqdn = socket.getfqdn()
+    while True:
+      with self._lock:
+        jobs = []
+        while self._jobs and len(self._map) + len(jobs) < self.concurrency:
+          jobs.append(self._jobs.popleft())
+      # note: the transactions are created (which connects to the
+      #       server, including any DNS lookup) and failed futures are
+      #       completed outside of the lock, so that neither blocks
+      #       :meth:`sendAsync` callers (and the futures' callbacks
+      #       may queue further transactions)
+      for future, mailfrom, recipients, message in jobs:
+        try:
+          _SmtpTransaction(self, future, mailfrom, recipients, message)
+        except Exception as exc:
+          future.set_exception(exc)
+      with self._lock:
+        idle = not self._map and not self._jobs
+        if idle:
+          self._running = False
+      if idle:
+        return
+      asyncore.loop(
+        timeout=self.pollInterval, use_poll=True, map=self._map, count=1)
+      now = time.time()
+      for channel in self._map.values():
+        if now >= channel.deadline:
+          channel.abort(smtplib.SMTPServerDisconnected(
+            'SMTP transaction timed out'))
+
+#------------------------------------------------------------------------------
+class _DataProducer(object):
+  # an asynchat producer of the encoded SMTP DATA of a message
+  def __init__(self, message):
+    self.chunks  = iterMessage(message)
+    self.encoder = DataEncoder()
+    self.closed  = False
+  def more(self):
+    for chunk in self.chunks:
+      data = self.encoder.encode(chunk)
+      if data:
+        return data
+    if self.closed:
+      return ''
+    self.closed = True
+    return self.encoder.close()
+
+#------------------------------------------------------------------------------
+class _SmtpTransaction(asynchat.async_chat):
+  '''
+  A single asynchronous SMTP transaction (greeting, EHLO/HELO, AUTH,
+  MAIL, RCPT, DATA and QUIT) of an :class:`AsyncSmtpSender`. Each
+  complete server reply is dispatched to the current `state` method,
+  which sends the next command and sets the next state.
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self, sender, future, mailfrom, recipients, message):
+    asynchat.async_chat.__init__(self, map=sender._map)
+    self.set_terminator(smtplib.CRLF)
+    self.sender     = sender
+    self.future     = future
+    self.mailfrom   = mailfrom
+    self.recipients = recipients
+    self.message    = message
+    self.pending    = list(recipients)
+    self.refused    = {}
+    self.incoming   = []
+    self.lines      = []
+    self.state      = self._greeting
+    self.touch()
+    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.connect((sender.smtpHost, int(sender.smtpPort)))
+
+  #----------------------------------------------------------------------------
+  def touch(self):
+    self.deadline = time.time() + self.sender.timeout
+
+  #----------------------------------------------------------------------------
+  def command(self, cmd, state):
+    self.state = state
+    self.push(cmd + smtplib.CRLF)
+
+  #----------------------------------------------------------------------------
+  def collect_incoming_data(self, data):
+    self.incoming.append(data)
+
+  #----------------------------------------------------------------------------
+  def found_terminator(self):
+    self.touch()
+    line = ''.join(self.incoming)
+    self.incoming = []
+    self.lines.append(line[4:].strip())
+    if line[3:4] == '-':
+      return
+    resp, self.lines = '\n'.join(self.lines), []
+    try:
+      code = int(line[:3])
+    except ValueError:
+      return self.abort(smtplib.SMTPResponseException(-1, resp))
+    self.state(code, resp)
+
+  #----------------------------------------------------------------------------
+  def _greeting(self, code, resp):
+    if code != 220:
+      return self.abort(smtplib.SMTPConnectError(code, resp))
+    self.command('ehlo ' + self.sender.fqdn, self._ehlo)
+
+  def _ehlo(self, code, resp):
+    if code != 250:
+      return self.command('helo ' + self.sender.fqdn, self._helo)
+    self._login()
+
+  def _helo(self, code, resp):
+    if code != 250:
+      return self.abort(smtplib.SMTPHeloError(code, resp))
+    self._login()
+
+  def _login(self):
+    if self.sender.username is None:
+      return self._mail()
+    auth = '\0%s\0%s' % (self.sender.username, self.sender.password)
+    self.command(
+      'AUTH PLAIN ' + base64.b64encode(auth), self._auth)
+
+  def _auth(self, code, resp):
+    if code not in (235, 503):
+      return self.abort(smtplib.SMTPAuthenticationError(code, resp))
+    self._mail()
+
+  def _mail(self):
+    self.command('mail FROM:%s' % smtplib.quoteaddr(self.mailfrom),
+                 self._mailed)
+
+  def _mailed(self, code, resp):
+    if code != 250:
+      return self.abort(
+        smtplib.SMTPSenderRefused(code, resp, self.mailfrom))
+    self._rcpt()
+
+  def _rcpt(self):
+    self.command('rcpt TO:%s' % smtplib.quoteaddr(self.pending[0]),
+                 self._rcpted)
+
+  def _rcpted(self, code, resp):
+    rcpt = self.pending.pop(0)
+    if code not in (250, 251):
+      self.refused[rcpt] = (code, resp)
+    if self.pending:
+      return self._rcpt()
+    if len(self.refused) == len(self.recipients):
+      return self.abort(smtplib.SMTPRecipientsRefused(self.refused))
+    self.command('data', self._data)
+
+  def _data(self, code, resp):
+    if code != 354:
+      return self.abort(smtplib.SMTPDataError(code, resp))
+    self.state = self._sent
+    self.push_with_producer(_DataProducer(self.message))
+
+  def _sent(self, code, resp):
+    if code != 250:
+      return self.abort(smtplib.SMTPDataError(code, resp))
+    self.future.set_result(self.refused)
+    self._quit()
+
+  def _quit(self):
+    self.command('quit', self._closing)
+    self.close_when_done()
+
+  def _closing(self, code, resp):
+    pass
+
+  #----------------------------------------------------------------------------
+  def abort(self, exc):
+    '''
+    Fails the transaction with the exception `exc` and ends the
+    session (politely, if the connection is still usable).
+    '''
+    if not self.future.done():
+      self.future.set_exception(exc)
+    # note: once DATA has started, the session can only be aborted by
+    #       closing the connection
+    if self.connected and self.state != self._sent and not isinstance(
+        exc, (smtplib.SMTPServerDisconnected, socket.error)):
+      return self._quit()
+    self.close()
+
+  #----------------------------------------------------------------------------
+  def handle_write(self):
+    self.touch()
+    asynchat.async_chat.handle_write(self)
+
+  def handle_close(self):
+    err = 0 if self.connected else \
+      self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err:
+      return self.abort(socket.error(err, os.strerror(err)))
+    self.abort(smtplib.SMTPServerDisconnected(
+      'Connection unexpectedly closed'))
+
+  def handle_error(self):
+    self.abort(sys.exc_info()[1])
+
+#------------------------------------------------------------------------------
+class DataEncoder(object):
+  '''
+  Incrementally converts message chunks into the SMTP ``DATA``
+  transfer format: all line endings are converted to CRLF and lines
+  starting with a period are dot-stuffed, exactly as done by
+  :func:`smtplib.quotedata` for a complete message, but correctly
+  handling line endings and periods that straddle chunk
+  boundaries. :meth:`close` returns the final data, including the
+  terminating ``CRLF.CRLF`` sequence.
+  '''
+
+  eol_cre = re.compile(r'(?:\r\n|\n|\r(?!\n))')
+
+  #----------------------------------------------------------------------------
+  def __init__(self):
+    self.pending = ''
+    self.bol     = True
+    self.empty   = True
+
+  #----------------------------------------------------------------------------
+  def encode(self, chunk):
+    data = self.pending + chunk
+    self.pending = ''
+    # a trailing CR may be the first half of a CRLF split across chunks
+    if data.endswith('\r'):
+      self.pending = '\r'
+      data = data[:-1]
+    if not data:
+      return data
+    data = self.eol_cre.sub(smtplib.CRLF, data)
+    if self.bol and data.startswith('.'):
+      data = '.' + data
+    data = data.replace('\n.', '\n..')
+    self.bol   = data.endswith('\n')
+    self.empty = False
+    return data
+
+  #----------------------------------------------------------------------------
+  def close(self):
+    # note: a dangling CR is a line ending by itself, and an empty
+    #       message still gets an (empty) line, as in smtplib
+    if self.pending or not self.bol or self.empty:
+      self.pending = ''
+      return smtplib.CRLF + '.' + smtplib.CRLF
+    return '.' + smtplib.CRLF
+
+#------------------------------------------------------------------------------
+class QueuedSender(Sender):
+  '''
+  A :class:`Sender` wrapper that decouples sending from the caller:
+  :meth:`send` places the (fully serialized) message in a bounded
+  queue and returns immediately, while a pool of background worker
+  threads delivers the queued messages via the wrapped `sender`.
+
+  :Parameters:
+
+  sender : :class:`Sender`
+    the sender that actually delivers the messages.
+
+  maxsize : int, optional, default: 1000
+    the maximum number of queued (i.e. not yet delivering) messages;
+    if ``0``, the queue is unbounded.
+
+  workers : int, optional, default: 1
+    the number of worker threads calling `sender`; note that the
+    wrapped sender must be thread-safe if this is greater than 1.
+
+  block : bool, optional, default: true
+    the backpressure policy applied when the queue is full: if true,
+    :meth:`send` waits (for at most `timeout` seconds, if specified)
+    for space in the queue, otherwise it fails immediately. In both
+    cases, :class:`Queue.Full` is raised if the message could not be
+    queued.
+
+  timeout : float, optional
+    see `block`.
+
+  :meth:`send` returns a :class:`genemail.future.Future` that
+  resolves to the wrapped sender's return value, or to the exception
+  it raised; :meth:`genemail.email.Email.send` returns it as well.
+  Use :meth:`flush` to wait for all queued messages to be delivered,
+  and :meth:`close` to shut down the workers.
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self, sender, maxsize=1000, workers=1, block=True,
+               timeout=None, *args, **kwargs):
+    super(QueuedSender, self).__init__(*args, **kwargs)
+    self.sender  = sender
+    self.block   = block
+    self.timeout = timeout
+    self.closed  = False
+    self.queue   = Queue.Queue(maxsize)
+    self.threads = []
+    # note: serializes enqueuing with :meth:`close`, so that no message
+    #       is ever queued behind the workers' shutdown sentinels
+    self._lock   = threading.Lock()
+    for idx in range(workers):
+      thread = threading.Thread(target=self._run, name='genemail-queue')
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  #----------------------------------------------------------------------------
+  def send(self, mailfrom, recipients, message):
+    ret  = Future()
+    item = (ret, mailfrom, recipients, messageString(message))
+    with self._lock:
+      if self.closed:
+        raise RuntimeError('the QueuedSender has been closed')
+      self.queue.put(item, self.block, self.timeout)
+    return ret
+
+  sendAsync = send
+
+  #----------------------------------------------------------------------------
+  def _run(self):
+    while True:
+      item = self.queue.get()
+      try:
+        if item is None:
+          return
+        future, mailfrom, recipients, message = item
+        try:
+          result = self.sender.send(mailfrom, recipients, message)
+        except Exception as exc:
+          future.set_exception(exc)
+        else:
+          future.set_result(result)
+      finally:
+        self.queue.task_done()
+
+  #----------------------------------------------------------------------------
+  def flush(self):
+    'Waits until all queued messages have been delivered (or failed).'
+    self.queue.join()
+
+  #----------------------------------------------------------------------------
+  def close(self):
+    '''
+    Stops accepting new messages, waits for the queued ones to be
+    delivered and then stops the worker threads.
+    '''
+    with self._lock:
+      self.closed = True
+      for thread in self.threads:
+        self.queue.put(None)
+    for thread in self.threads:
+      thread.join()
+    self.threads = []
+
+#------------------------------------------------------------------------------
+class RetryingSender(Sender):
+  '''
+  A :class:`Sender` wrapper that retries transient delivery failures
+  (see :func:`isTransientError`) with jittered exponential backoff,
+  re-attempting only the recipients that failed. The first attempt is
+  made by :meth:`send` itself; if it fails permanently for all
+  recipients, the exception is raised as usual. Otherwise, :meth:`send`
+  returns a :class:`genemail.future.Future` immediately and any
+  retries are made in the background by the `scheduler`; the future
+  resolves to the dictionary of recipients that were ultimately
+  refused (mapped to the last ``(code, response)``, with a code of -1
+  for connection failures), or to the last exception if no recipient
+  could be delivered to.
+
+  :Parameters:
+
+  sender : :class:`Sender`
+    the (synchronous) sender that delivers the messages, e.g. a
+    :class:`SmtpSender`; it must return the dictionary of refused
+    recipients or ``None``.
+
+  maxAttempts : int, optional, default: 5
+    the maximum number of delivery attempts per recipient.
+
+  backoff : float, optional, default: 30
+    the delay, in seconds, before the first retry; it doubles with
+    each subsequent attempt, up to `maxBackoff`.
+
+  maxBackoff : float, optional, default: 3600
+    the maximum delay between attempts.
+
+  jitter : float, optional, default: 0.5
+    the fraction by which each delay is randomly reduced, so that
+    messages deferred together do not all retry at the same time.
+
+  scheduler : :class:`genemail.future.Scheduler`, optional
+    the scheduler that runs the retries; defaults to a new one.
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self, sender, maxAttempts=5, backoff=30, maxBackoff=3600,
+               jitter=0.5, scheduler=None, *args, **kwargs):
+    super(RetryingSender, self).__init__(*args, **kwargs)
+    self.sender      = sender
+    self.maxAttempts = maxAttempts
+    self.backoff     = backoff
+    self.maxBackoff  = maxBackoff
+    self.jitter      = jitter
+    self.scheduler   = scheduler or Scheduler()
+
+  #----------------------------------------------------------------------------
+  def send(self, mailfrom, recipients, message):
+    if isinstance(recipients, basestring):
+      recipients = [recipients]
+    state = adict(
+      future=Future(), mailfrom=mailfrom, message=messageString(message),
+      pending=list(recipients), refused={}, attempt=0, delivered=False,
+      error=None)
+    self._attempt(state)
+    if state.future.done() and state.future.exception() is not None:
+      raise state.future.exception()
+    return state.future
+
+  #----------------------------------------------------------------------------
+  def getDelay(self, attempt):
+    'Returns the (jittered) delay before retry number `attempt`.'
+    delay = min(self.maxBackoff, self.backoff * 2 ** (attempt - 1))
+    return delay * (1 - self.jitter * random.random())
+
+  #----------------------------------------------------------------------------
+  def _attempt(self, state):
+    state.attempt += 1
+    retry = {}
+    try:
+      result = self.sender.send(
+        state.mailfrom, state.pending, state.message) or {}
+    except smtplib.SMTPRecipientsRefused as exc:
+      state.error = exc
+      result = exc.recipients
+    except Exception as exc:
+      if not state.delivered and not isTransientError(exc):
+        state.future.set_exception(exc)
+        return
+      state.error = exc
+      result = dict.fromkeys(state.pending, (
+        getattr(exc, 'smtp_code', -1), getattr(exc, 'smtp_error', str(exc))))
+      if isTransientError(exc):
+        retry, result = result, {}
+    else:
+      if len(result) < len(state.pending):
+        state.delivered = True
+    for rcpt, (code, resp) in result.items():
+      if 400 <= code < 500:
+        retry[rcpt] = (code, resp)
+      else:
+        state.refused[rcpt] = (code, resp)
+    if retry and state.attempt < self.maxAttempts:
+      state.pending = [rcpt for rcpt in state.pending if rcpt in retry]
+      self.scheduler.schedule(
+        self.getDelay(state.attempt), self._attempt, state)
+      return
+    state.refused.update(retry)
+    if state.delivered:
+      state.future.set_result(state.refused)
+    elif state.error is None \
+        or isinstance(state.error, smtplib.SMTPRecipientsRefused):
+      state.future.set_exception(
+        smtplib.SMTPRecipientsRefused(state.refused))
+    else:
+      state.future.set_exception(state.error)
 
 #------------------------------------------------------------------------------
 class StoredSender(Sender):
@@ -119,8 +1233,26 @@ class StoredSender(Sender):
 
   #----------------------------------------------------------------------------
   def send(self, mailfrom, recipients, message):
-    self.emails.append(
-      adict(mailfrom=mailfrom, recipients=recipients, message=message))
+    self.emails.append(self._store(mailfrom, recipients, message))
+
+  #----------------------------------------------------------------------------
+  def sendMany(self, messages):
+    ret    = []
+    emails = []
+    for mailfrom, recipients, message in iterEnvelopes(messages):
+      try:
+        emails.append(self._store(mailfrom, recipients, message))
+        ret.append(sendResult(mailfrom, recipients))
+      except Exception as exc:
+        ret.append(sendResult(mailfrom, recipients, error=exc))
+    self.emails.extend(emails)
+    return ret
+
+  #----------------------------------------------------------------------------
+  def _store(self, mailfrom, recipients, message):
+    return adict(
+      mailfrom=mailfrom, recipients=recipients,
+      message=messageString(message))
 
 #------------------------------------------------------------------------------
 class DebugSender(StoredSender):
@@ -143,10 +1275,13 @@ class DebugSender(StoredSender):
   * `calendar`:   text/calendar attachment of the email (or None)
   '''
 
+  parser = email.parser.Parser()
+
   #----------------------------------------------------------------------------
-  def send(self, mailfrom, recipients, message):
+  def _store(self, mailfrom, recipients, message):
+    message = messageString(message)
     eml = adict(mailfrom=mailfrom, recipients=recipients, message=message)
-    mime = email.parser.Parser().parsestr(message)
+    mime = self.parser.parsestr(message)
     eml['mime']        = mime
     eml['from']        = mime.get('from')
     eml['to']          = mime.get('to')
@@ -164,7 +1299,7 @@ class DebugSender(StoredSender):
         eml[ct].append(part.get_payload())
       else:
         eml[ct] = [eml[ct], part.get_payload()]
-    self.emails.append(eml)
+    return eml
 
 #------------------------------------------------------------------------------
 # end of $Id$
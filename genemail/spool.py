@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# lib:  genemail.spool
+# auth: Philip J Grabner <grabner@cadit.com>
+# date: 2013/12/02
+# copy: (C) Copyright 2013 Cadit Health Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+'''
+A durable, maildir-style on-disk spool of outbound messages. Messages
+are written to the ``tmp`` subdirectory and then atomically renamed
+into ``new``, so a message is either fully spooled or not at all.
+Delivery agents claim a message by atomically renaming it into
+``cur`` (only one agent can succeed), and acknowledge it by deleting
+it once it has been delivered. Claimed messages that are never
+acknowledged (e.g. because the agent died) are returned to ``new`` by
+:meth:`Spool.recover`; messages that fail permanently are moved to
+``failed``.
+
+Messages that fail transiently are returned to ``new`` with their
+number of delivery attempts and the time of the next attempt appended
+to the file name (as ``:ATTEMPTS,NEXTATTEMPT``), and are not claimed
+again until then. Once a message reaches `maxAttempts`, it is moved
+to ``failed`` as well.
+
+Each spool file contains a JSON-encoded envelope (the `mailfrom` and
+`recipients`) on the first line, followed by the SMTP message. When
+a message is delivered but some of its recipients are refused
+permanently, a copy of it is stored in ``failed`` with just those
+recipients and an additional `refused` envelope attribute (mapping
+each recipient to the server's code and response).
+'''
+
+from __future__ import absolute_import
+
+__all__ = ('Spool', 'SpoolSender')
+
+import os
+import time
+import json
+import errno
+import socket
+import itertools
+import threading
+
+from templatealchemy.util import adict
+
+from .sender import Sender, iterMessage, isPermanentError, \
+    isConnectionError, splitRefused
+
+#------------------------------------------------------------------------------
+class Spool(object):
+  '''
+  A spool directory located at `path`; the ``tmp``, ``new``, ``cur``
+  and ``failed`` subdirectories are created as needed.
+
+  :Parameters:
+
+  path : str
+    the spool directory.
+
+  maxAttempts : int, optional, default: 5
+    the number of delivery attempts after which a transiently failing
+    message is moved to ``failed``.
+
+  backoff : float, optional, default: 60
+    the delay, in seconds, before the first retry of a message; it
+    doubles with each subsequent attempt.
+  '''
+
+  _counter = itertools.count()
+  _lock    = threading.Lock()
+
+  #----------------------------------------------------------------------------
+  def __init__(self, path, maxAttempts=5, backoff=60):
+    self.path        = path
+    self.maxAttempts = maxAttempts
+    self.backoff     = backoff
+    for sub in ('tmp', 'new', 'cur', 'failed'):
+      try:
+        os.makedirs(os.path.join(path, sub))
+      except OSError as err:
+        if err.errno != errno.EEXIST:
+          raise
+
+  #----------------------------------------------------------------------------
+  def _newName(self):
+    with self._lock:
+      count = next(self._counter)
+    now = time.time()
+    return '%d.M%06dP%dQ%d.%s' % (
+      int(now), int((now % 1) * 1000000), os.getpid(), count,
+      socket.gethostname().replace('/', '\\057').replace(':', '\\072'))
+
+  #----------------------------------------------------------------------------
+  @staticmethod
+  def _parseName(name):
+    'Returns the tuple (basename, attempts, nextAttempt) of spool file `name`.'
+    base, sep, info = name.partition(':')
+    if not sep:
+      return (base, 0, 0)
+    attempts, nextAttempt = info.split(',')
+    return (base, int(attempts), int(nextAttempt))
+
+  #----------------------------------------------------------------------------
+  def put(self, mailfrom, recipients, message):
+    '''
+    Atomically adds a message to the spool and returns its name.
+    `message` can be any of the types supported by
+    :func:`genemail.sender.iterMessage`.
+    '''
+    if isinstance(recipients, basestring):
+      recipients = [recipients]
+    name = self._newName()
+    self._write('new', name, dict(mailfrom=mailfrom, recipients=recipients),
+                message)
+    return name
+
+  #----------------------------------------------------------------------------
+  def _write(self, sub, name, envelope, message):
+    # note: written to ``tmp`` first, so that the file appears (or is
+    #       replaced) in `sub` atomically
+    tmp = os.path.join(self.path, 'tmp', name)
+    with open(tmp, 'wb') as fp:
+      fp.write(json.dumps(envelope))
+      fp.write('\n')
+      for chunk in iterMessage(message):
+        fp.write(chunk)
+      fp.flush()
+      os.fsync(fp.fileno())
+    os.rename(tmp, os.path.join(self.path, sub, name))
+
+  #----------------------------------------------------------------------------
+  def claim(self, limit=None):
+    '''
+    Claims (at most `limit`) spooled messages that are due, oldest
+    first, and returns a list of adicts with the attributes `name`,
+    `mailfrom`, `recipients`, `message` and `attempts`. Each claimed
+    message must eventually be passed to :meth:`ack`, :meth:`retry`,
+    :meth:`release` or :meth:`fail`. Messages concurrently claimed by
+    other processes are skipped.
+    '''
+    ret = []
+    now = time.time()
+    for name in sorted(os.listdir(os.path.join(self.path, 'new'))):
+      if limit is not None and len(ret) >= limit:
+        break
+      base, attempts, nextAttempt = self._parseName(name)
+      if nextAttempt > now:
+        continue
+      cur = os.path.join(self.path, 'cur', name)
+      try:
+        os.rename(os.path.join(self.path, 'new', name), cur)
+      except OSError as err:
+        if err.errno == errno.ENOENT:
+          continue
+        raise
+      # note: the claim time is recorded as the mtime for `recover`
+      os.utime(cur, None)
+      with open(cur, 'rb') as fp:
+        envelope = json.loads(fp.readline())
+        message  = fp.read()
+      ret.append(adict(
+        name=name, mailfrom=envelope['mailfrom'],
+        recipients=envelope['recipients'], message=message,
+        attempts=attempts))
+    return ret
+
+  #----------------------------------------------------------------------------
+  def ack(self, entry):
+    'Removes the delivered (claimed) message `entry` from the spool.'
+    os.unlink(os.path.join(self.path, 'cur', entry.name))
+
+  #----------------------------------------------------------------------------
+  def release(self, entry):
+    '''
+    Returns the claimed message `entry` to the spool, without counting
+    a delivery attempt (e.g. because the connection failed before it
+    could be attempted).
+    '''
+    os.rename(os.path.join(self.path, 'cur', entry.name),
+              os.path.join(self.path, 'new', entry.name))
+
+  #----------------------------------------------------------------------------
+  def fail(self, entry):
+    'Moves the claimed message `entry` to the ``failed`` subdirectory.'
+    os.rename(os.path.join(self.path, 'cur', entry.name),
+              os.path.join(self.path, 'failed', entry.name))
+
+  #----------------------------------------------------------------------------
+  def refuse(self, entry, refused):
+    '''
+    Records that the claimed message `entry` was permanently refused
+    for the recipients in the dictionary `refused` (e.g. as returned
+    by :meth:`genemail.sender.SmtpSender.send`) by storing a copy of
+    it, with just these recipients, in ``failed``. The claimed message
+    itself is not affected.
+    '''
+    self._write('failed', self._newName(), dict(
+      mailfrom=entry.mailfrom,
+      recipients=[rcpt for rcpt in entry.recipients if rcpt in refused],
+      refused=refused), entry.message)
+
+  #----------------------------------------------------------------------------
+  def retry(self, entry, recipients=None):
+    '''
+    Returns the claimed message `entry` to the spool after a transient
+    failure, to be retried after an exponential backoff, or moves it
+    to ``failed`` if it has reached `maxAttempts`. If `recipients` is
+    specified, the message's recipients are first replaced by it
+    (e.g. because it was delivered to the others). Returns true if it
+    was returned to the spool.
+    '''
+    if recipients is not None:
+      entry.recipients = list(recipients)
+      self._write('cur', entry.name, dict(
+        mailfrom=entry.mailfrom, recipients=entry.recipients), entry.message)
+    attempts = entry.attempts + 1
+    if attempts >= self.maxAttempts:
+      self.fail(entry)
+      return False
+    name = '%s:%d,%d' % (
+      self._parseName(entry.name)[0], attempts,
+      int(time.time() + self.backoff * 2 ** (attempts - 1)))
+    os.rename(os.path.join(self.path, 'cur', entry.name),
+              os.path.join(self.path, 'new', name))
+    return True
+
+  #----------------------------------------------------------------------------
+  def recover(self, age):
+    '''
+    Returns messages that were claimed more than `age` seconds ago
+    (and never acknowledged) to the spool, and removes partially
+    written messages older than that. Returns the number of messages
+    recovered.
+    '''
+    count  = 0
+    cutoff = time.time() - age
+    for sub in ('cur', 'tmp'):
+      for name in os.listdir(os.path.join(self.path, sub)):
+        path = os.path.join(self.path, sub, name)
+        try:
+          if os.stat(path).st_mtime > cutoff:
+            continue
+          if sub == 'tmp':
+            os.unlink(path)
+          else:
+            os.rename(path, os.path.join(self.path, 'new', name))
+            count += 1
+        except OSError as err:
+          if err.errno != errno.ENOENT:
+            raise
+    return count
+
+  #----------------------------------------------------------------------------
+  def drain(self, sender, batch=100):
+    '''
+    Claims and delivers all spooled messages that are currently due
+    via `sender`. Delivered messages are acknowledged, messages that
+    fail with a permanent error (see :func:`isPermanentError`) are
+    moved to ``failed`` and all others are rescheduled individually
+    (see :meth:`retry`). If the connection to the server fails (see
+    :func:`isConnectionError`), the remaining messages are released
+    and the drain stops. If `sender` reports refused recipients (see
+    :func:`genemail.sender.splitRefused`), the message is retried for
+    the transiently refused ones and recorded as failed for the
+    permanently refused ones (see :meth:`refuse`). Returns an adict
+    with the number of messages `sent`, `failed` and `deferred`; a
+    partially delivered message counts towards each of the outcomes
+    of its recipients.
+    '''
+    ret = adict(sent=0, failed=0, deferred=0)
+    while True:
+      entries = self.claim(batch)
+      if not entries:
+        return ret
+      for idx, entry in enumerate(entries):
+        try:
+          refused = sender.send(entry.mailfrom, entry.recipients, entry.message)
+        except Exception as exc:
+          if isPermanentError(exc):
+            self.fail(entry)
+            ret.failed += 1
+          elif isConnectionError(exc):
+            # note: the failure is not the message's fault, so leave it
+            #       (and the rest of this batch) for the next drain
+            for entry in entries[idx:]:
+              self.release(entry)
+            ret.deferred += len(entries) - idx
+            return ret
+          elif self.retry(entry):
+            ret.deferred += 1
+          else:
+            ret.failed += 1
+          continue
+        transient, permanent = splitRefused(refused)
+        if len(transient) + len(permanent) < len(entry.recipients):
+          ret.sent += 1
+        if permanent:
+          self.refuse(entry, permanent)
+          ret.failed += 1
+        if not transient:
+          self.ack(entry)
+        elif self.retry(entry, [rcpt for rcpt in entry.recipients
+                                if rcpt in transient]):
+          ret.deferred += 1
+        else:
+          ret.failed += 1
+
+#------------------------------------------------------------------------------
+class SpoolSender(Sender):
+  '''
+  A :class:`genemail.sender.Sender` that writes each message (and its
+  envelope) to the :class:`Spool` at `path` and returns its spool name
+  immediately. The messages are then delivered separately, e.g. by
+  the ``genemail drain`` command or :meth:`Spool.drain`. Any
+  additional keyword arguments are passed to the :class:`Spool`.
+  '''
+
+  streaming = True
+
+  #----------------------------------------------------------------------------
+  def __init__(self, path, *args, **kwargs):
+    spool = dict((key, kwargs.pop(key))
+                 for key in ('maxAttempts', 'backoff')
+                 if key in kwargs)
+    super(SpoolSender, self).__init__(*args, **kwargs)
+    self.spool = Spool(path, **spool)
+
+  #----------------------------------------------------------------------------
+  def send(self, mailfrom, recipients, message):
+    return self.spool.put(mailfrom, recipients, message)
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
@@ -6,11 +6,14 @@
 # copy: (C) Copyright 2013 Cadit Inc., All Rights Reserved.
 #------------------------------------------------------------------------------
 
-import sys, unittest, re, time, pkg_resources
+from __future__ import absolute_import
+
+import sys, unittest, re, time, copy, threading, pkg_resources
 import templatealchemy as ta
 
 from .manager import Manager
 from .sender import Sender, StoredSender
+from .email import MissingHeader
 from . import util
 
 #------------------------------------------------------------------------------
@@ -98,6 +101,27 @@ class TestEmail(unittest.TestCase):
     out  = util.serializeHtml(xdoc)
     self.assertXmlEqual(out, chk)
 
+  #----------------------------------------------------------------------------
+  def test_inlineHtmlStyling_functions(self):
+    html = '<html><body><p lang="en">Sale</p><p>Other</p></body></html>'
+    css  = 'p:lang(en){color:red}p:contains(Other){color:blue}'
+    out  = util.serializeHtml(util.inlineHtmlStyling(util.parseXml(html), css))
+    self.assertIn('<p lang="en" style="color: red">Sale</p>', out)
+    self.assertIn('<p style="color: blue">Other</p>', out)
+
+  #----------------------------------------------------------------------------
+  def test_stylesheetCache(self):
+    html = '<html><body><div>foo</div></body></html>'
+    css  = 'body{color:red} /* test_stylesheetCache */'
+    hits, misses = util.stylesheetCache.hits, util.stylesheetCache.misses
+    sheet = util.compileStylesheet(css)
+    for count in range(3):
+      xdoc = util.inlineHtmlStyling(util.parseXml(html), css)
+      self.assertIn('style="color: red"', util.serializeHtml(xdoc))
+    self.assertIs(util.compileStylesheet(css), sheet)
+    self.assertEqual(util.stylesheetCache.misses - misses, 1)
+    self.assertEqual(util.stylesheetCache.hits - hits, 4)
+
   #----------------------------------------------------------------------------
   def test_deprecationwarning_workaround(self):
     html = '<html><body><p class="f">first</p><p>second</p></body></html>'
@@ -122,6 +146,58 @@ class TestEmail(unittest.TestCase):
 </html>
 ''')
 
+  #----------------------------------------------------------------------------
+  def test_scanTemplateXml(self):
+    from .email import scanTemplateXml
+    xdoc = util.parseXml('''\
+<html
+ xmlns="http://www.w3.org/1999/xhtml"
+ xmlns:email="http://pythonhosted.org/genemail/xmlns/1.0"
+ >
+ <head>
+  <title email:subject="content">The Subject</title>
+  <email:header name="To">test@example.com</email:header>
+  <email:header name="From" value="noreply@example.com">bogus</email:header>
+  <email:attachment name="foo.txt" encoding="base64">Rk9P</email:attachment>
+  <style type="text/css">p{color:red}</style>
+ </head>
+ <body>
+  <p>CC: <span email:header="CC">cc@example.com</span>.</p>
+  <div><style type="text/css">p{color:blue}</style></div>
+ </body>
+</html>
+''')
+    man = scanTemplateXml(xdoc)
+    self.assertEqual(
+      sorted(man.headers.items()),
+      [('CC', 'cc@example.com'), ('From', 'noreply@example.com'),
+       ('To', 'test@example.com')])
+    self.assertEqual(man.subject, ['The Subject'])
+    self.assertEqual(
+      man.attachments,
+      [dict(name='foo.txt', contentType=None, value='FOO', cid=False)])
+    self.assertEqual(man.styles, ['p{color:red}'])
+    self.assertEqual(scanTemplateXml(None).headers.items(), [])
+
+  #----------------------------------------------------------------------------
+  def test_selectCharset(self):
+    import email.MIMEText
+    for src, chk in (
+      ('',                'ascii'),
+      ('plain text',      'ascii'),
+      (u'plain text',     'ascii'),
+      (u'caf\xe9',        'iso-8859-1'),
+      (u'this \u21d2 that', 'utf-8'),
+      ('caf\xc3\xa9',     'utf-8'),
+      ('caf\xe9',         'iso-8859-1'),
+      ):
+      self.assertEqual(util.selectCharset(src), chk)
+      part = email.MIMEText.MIMEText(src, 'plain', chk)
+      out  = part.get_payload(decode=True)
+      if isinstance(src, unicode):
+        out = out.decode(part.get_content_charset())
+      self.assertEqual(out, src)
+
   #----------------------------------------------------------------------------
   def test_reduce2ascii_is_needed(self):
     from .util import reduce2ascii as r2a
@@ -1093,8 +1169,8 @@ END:VCALENDAR
     eml.boundary = 'genemail.test'
     eml.send(mailfrom='mailfrom@example.com', recipients='rcpt@example.com')
     self.assertEqual(len(manager.sender.emails), 1)
-    # TODO: reduce this by caching by "template/genemail_format" ...!!!...
-    self.assertEqual(counter.count, 9)
+    # note: one evaluation each for the "xml", "text" and "html" formats
+    self.assertEqual(counter.count, 3)
     out = manager.sender.emails[0]
 
     chk = '''\
@@ -1102,21 +1178,21 @@ Content-Type: multipart/alternative; boundary="==genemail.test-alt-2=="
 MIME-Version: 1.0
 Date: Fri, 13 Feb 2009 23:31:30 -0000
 Message-ID: <1234567890@@genemail.example.com>
-Subject: The count is: 3
+Subject: The count is: 2
 
 --==genemail.test-alt-2==
 MIME-Version: 1.0
 Content-Type: text/plain; charset="us-ascii"
 Content-Transfer-Encoding: 7bit
 
-The count is: 5
+The count is: 2
 
 --==genemail.test-alt-2==
 MIME-Version: 1.0
 Content-Type: text/html; charset="us-ascii"
 Content-Transfer-Encoding: 7bit
 
-<html xmlns="http://www.w3.org/1999/xhtml"><body>The count is: 7</body></html>
+<html xmlns="http://www.w3.org/1999/xhtml"><body>The count is: 3</body></html>
 --==genemail.test-alt-2==--
 '''
 
@@ -1167,6 +1243,396 @@ Content-Transfer-Encoding: 7bit
 '''
     self.assertMimeXmlEqual(out['message'], chk)
 
+  #----------------------------------------------------------------------------
+  def test_renderCache_invalidation(self):
+    tpl = '<html><body>${message} ${getCount()}</body></html>'
+    manager = Manager(sender=StoredSender(), provider=template(tpl))
+    eml = manager.newEmail()
+    class Counter():
+      def __init__(self): self.count = 0
+      def inc(self):
+        self.count += 1
+        return self.count
+    counter = Counter()
+    eml['getCount'] = counter.inc
+    eml['message'] = 'first'
+    # note: each pass renders the "html" and the "xml" formats
+    self.assertEqual(eml.getHtml(), eml.getHtml())
+    self.assertEqual(counter.count, 2)
+    eml['message'] = 'second'
+    self.assertIn('second 3', eml.getHtml())
+    eml.setHeader('to', 'rcpt@example.com')
+    self.assertIn('second 5', eml.getHtml())
+    eml.addAttachment('foo.txt', 'foo')
+    self.assertIn('second 7', eml.getHtml())
+    eml.resetRenderCache()
+    self.assertIn('second 9', eml.getHtml())
+    self.assertEqual(counter.count, 10)
+
+  #----------------------------------------------------------------------------
+  def test_sendBatch(self):
+    tpl = '''\
+<html
+ xmlns="http://www.w3.org/1999/xhtml"
+ xmlns:email="http://pythonhosted.org/genemail/xmlns/1.0"
+ >
+ <head>
+  <title email:subject="content">Hello ${name}</title>
+  <email:header name="To">${email}</email:header>
+  <email:header name="From">noreply@example.com</email:header>
+ </head>
+ <body><p>Hello, ${name}!</p></body>
+</html>
+'''
+    provider = template(tpl)
+    loads = []
+    getTemplate = provider.getTemplate
+    def countingGetTemplate(name):
+      loads.append(name)
+      return getTemplate(name)
+    provider.getTemplate = countingGetTemplate
+    manager = Manager(sender=StoredSender(), provider=provider)
+    recipients = (dict(name='User %d' % (idx,), email='u%d@example.com' % (idx,))
+                  for idx in range(3))
+    self.assertEqual(manager.sendBatch(None, recipients), 3)
+    # note: one load for the manager's default email, one for the batch
+    self.assertEqual(len(loads), 2)
+    # note: the greeting is in both the text/plain and text/html parts
+    self.assertEqual(
+      [(eml.recipients, eml.message.count('Hello, User %d!' % (idx,)))
+       for idx, eml in enumerate(manager.sender.emails)],
+      [(['u0@example.com'], 2), (['u1@example.com'], 2), (['u2@example.com'], 2)])
+
+  #----------------------------------------------------------------------------
+  def test_attachmentCache(self):
+    from .email import attachmentCache
+    tpl = '<html><body><p>Hello, ${name}!</p></body></html>'
+    manager = Manager(sender=StoredSender(), provider=template(tpl))
+    hits, misses = attachmentCache.hits, attachmentCache.misses
+    for name in ('Joe', 'Jane'):
+      eml = manager.newEmail()
+      eml['name'] = name
+      eml.addAttachment('report.bin', 'test_attachmentCache\x00\xff' * 100)
+      eml.setHeader('message-id', '<1234567890@@genemail.example.com>')
+      eml.boundary = 'genemail.test'
+      eml.send(mailfrom='mailfrom@example.com', recipients='rcpt@example.com')
+    self.assertEqual(attachmentCache.misses - misses, 1)
+    self.assertEqual(attachmentCache.hits - hits, 1)
+    out = [eml.message.replace('Jane', 'Joe') for eml in manager.sender.emails]
+    self.assertMultiLineEqual(out[0], out[1])
+    self.assertIn('Content-Disposition: attachment; filename="report.bin"', out[1])
+
+  #----------------------------------------------------------------------------
+  def test_streamMessage(self):
+    class StreamingSender(StoredSender):
+      streaming = True
+      def send(self, mailfrom, recipients, message):
+        self.chunks = list(message)
+        super(StreamingSender, self).send(mailfrom, recipients, self.chunks)
+    tpl = '<html><body><p>Hello, ${name}!</p></body></html>'
+    stored = StoredSender()
+    streamed = StreamingSender()
+    for sender in (stored, streamed):
+      manager = Manager(sender=sender, provider=template(tpl))
+      eml = manager.newEmail()
+      eml['name'] = 'Joe'
+      eml.addAttachment('report.bin', 'test_streamMessage\x00' * 100)
+      eml.setHeader('message-id', '<1234567890@@genemail.example.com>')
+      eml.boundary = 'genemail.test'
+      msg = eml._getMimeMessage(eml.getOutputHeaders())
+      self.assertEqual(''.join(util.streamMessage(msg)), msg.as_string())
+      eml.send(mailfrom='mailfrom@example.com', recipients='rcpt@example.com')
+    self.assertGreater(len(streamed.chunks), 3)
+    self.assertMultiLineEqual(
+      streamed.emails[0].message, stored.emails[0].message)
+
+  #----------------------------------------------------------------------------
+  def test_fileAttachment(self):
+    import tempfile, os
+    class StreamingSender(StoredSender):
+      streaming = True
+      def send(self, mailfrom, recipients, message):
+        self.chunks = list(message)
+        super(StreamingSender, self).send(mailfrom, recipients, self.chunks)
+    data = 'test_fileAttachment\x00\xff' * 20000
+    fd, path = tempfile.mkstemp()
+    try:
+      os.write(fd, data)
+      os.close(fd)
+      tpl = '<html><body><p>Hello, world!</p></body></html>'
+      out = []
+      for sender, value in ((StoredSender(), dict(value=data)),
+                            (StoredSender(), dict(path=path)),
+                            (StreamingSender(), dict(path=path)),
+                            (StreamingSender(), dict(value=open(path, 'rb')))):
+        manager = Manager(sender=sender, provider=template(tpl))
+        eml = manager.newEmail()
+        eml.addAttachment('report.bin', **value)
+        eml.setHeader('message-id', '<1234567890@@genemail.example.com>')
+        eml.boundary = 'genemail.test'
+        eml.send(mailfrom='mailfrom@example.com', recipients='rcpt@example.com')
+        out.append(sender.emails[0].message)
+      for msg in out[1:]:
+        self.assertMultiLineEqual(msg, out[0])
+      # the message (including the 420KB payload) is streamed in chunks
+      self.assertGreater(len(sender.chunks), 3)
+    finally:
+      os.unlink(path)
+
+  #----------------------------------------------------------------------------
+  def test_standaloneHtml_lazyCid(self):
+    import tempfile, os
+    from StringIO import StringIO
+    fd, path = tempfile.mkstemp()
+    try:
+      os.write(fd, 'ALL YOUR BASE ARE BELONG TO US')
+      os.close(fd)
+      tpl = '<html><body><p><img src="cid:slogan.txt"/></p></body></html>'
+      manager = Manager(sender=StoredSender(), provider=template(tpl))
+      for value in (dict(path=path),
+                    dict(value=StringIO('ALL YOUR BASE ARE BELONG TO US')),
+                    dict(value=bytearray('ALL YOUR BASE ARE BELONG TO US'))):
+        eml = manager.newEmail()
+        eml.addAttachment('slogan.txt', cid=True, contentType='text/plain',
+                          **value)
+        self.assertIn(
+          '<img src="data:text/plain;base64,'
+          'QUxMIFlPVVIgQkFTRSBBUkUgQkVMT05HIFRPIFVT" />',
+          eml.getHtml(standalone=True))
+    finally:
+      os.unlink(path)
+
+  #----------------------------------------------------------------------------
+  def test_compileStructure(self):
+    from .email import Email, compileStructure
+    struct = Email.DEFAULTS['structure']
+    self.assertIs(compileStructure(struct),
+                  compileStructure(copy.deepcopy(struct)))
+    with self.assertRaises(ValueError):
+      compileStructure({'mime:mixed; optimize=bool(1)': ['email:text']})
+    with self.assertRaises(SyntaxError):
+      compileStructure('email:unknown')
+    tpl = '<html><body><p>Hello, ${name}!</p></body></html>'
+    manager = Manager(sender=StoredSender(), provider=template(tpl))
+    eml = manager.newEmail()
+    eml['name'] = 'Joe'
+    eml.structure = {'mime:mixed': ['email:html', 'email:text']}
+    eml.minimalMime = False
+    eml.setHeader('message-id', '<1234567890@@genemail.example.com>')
+    eml.boundary = 'genemail.test'
+    eml.send(mailfrom='mailfrom@example.com', recipients='rcpt@example.com')
+    out = manager.sender.emails[0].message
+    self.assertIn('boundary="==genemail.test-mix-1=="', out)
+    self.assertLess(out.index('text/html'), out.index('text/plain'))
+
+  #----------------------------------------------------------------------------
+  def test_copyOnWriteDefaults(self):
+    from .email import Email
+    manager = Manager(sender=StoredSender(), provider=template('<html/>'),
+                      default=dict(includeComponents=['text']))
+    eml = manager.newEmail()
+    self.assertFalse(hasattr(eml, '__dict__'))
+    self.assertFalse(hasattr(eml, '_structure'))
+    self.assertFalse(hasattr(eml, '_includeComponents'))
+    self.assertEqual(eml.includeComponents, ['text'])
+    eml.includeComponents.append('html')
+    eml.structure['mime:other'] = []
+    self.assertEqual(manager.newEmail().includeComponents, ['text'])
+    self.assertEqual(manager.default.includeComponents, ['text'])
+    self.assertNotIn('mime:other', manager.newEmail().structure)
+    self.assertNotIn('mime:other', Email.DEFAULTS['structure'])
+    eml.boundary = 'genemail.test'
+    self.assertEqual(eml.boundary, 'genemail.test')
+    del eml.boundary
+    self.assertIsNone(eml.boundary)
+    self.assertIn('cache', eml.params)
+
+  #----------------------------------------------------------------------------
+  def test_templateCache(self):
+    import tempfile, shutil, os
+    tmpdir = tempfile.mkdtemp()
+    try:
+      def write(name, content):
+        with open(os.path.join(tmpdir, name), 'wb') as fp:
+          fp.write(content)
+      write('greeting.html', '<html><body><p>Hello!</p></body></html>')
+      provider = ta.Template(source='file:' + tmpdir, renderer='mako')
+      polling = Manager(sender=StoredSender(), provider=provider,
+                        templateCheckInterval=0)
+      manual  = Manager(sender=StoredSender(), provider=provider,
+                        templateCheckInterval=None)
+      for manager in (polling, manual):
+        self.assertIs(manager.getTemplate('greeting'),
+                      manager.getTemplate('greeting'))
+        self.assertEqual(manager.getTemplate('greeting').meta.formats, ['html'])
+      write('greeting.text', 'Hello!')
+      self.assertEqual(
+        polling.newEmail('greeting').template.meta.formats, ['html', 'text'])
+      self.assertEqual(
+        manual.newEmail('greeting').template.meta.formats, ['html'])
+      manual.invalidate('greeting')
+      self.assertEqual(
+        manual.newEmail('greeting').template.meta.formats, ['html', 'text'])
+    finally:
+      shutil.rmtree(tmpdir)
+
+  #----------------------------------------------------------------------------
+  def test_prototype(self):
+    tpl = '<html><body><p>${greeting}, ${name}!</p></body></html>'
+    manager = Manager(sender=StoredSender(), provider=template(tpl))
+    items = ['a', 'b']
+    proto = manager.compile('welcome', greeting='Hello', items=items)
+    self.assertEqual(proto['greeting'], 'Hello')
+    with self.assertRaises(TypeError):
+      proto['name'] = 'Joe'
+    with self.assertRaises(TypeError):
+      proto.setHeader('to', 'rcpt@example.com')
+    with self.assertRaises(TypeError):
+      proto.addAttachment('file.txt', 'data')
+    with self.assertRaises(TypeError):
+      proto.boundary = 'genemail.test'
+    joe  = proto.clone(name='Joe')
+    jane = proto.clone(name='Jane')
+    self.assertIs(joe.template, proto.template)
+    self.assertIs(joe['items'], items)
+    self.assertIsNot(joe['cache'], proto['cache'])
+    jane.setHeader('to', 'jane@example.com')
+    self.assertNotIn('to', proto.headers)
+    self.assertNotIn('to', joe.headers)
+    self.assertIn('Hello, Joe!', joe.getHtml())
+    self.assertIn('Hello, Jane!', jane.getHtml())
+    self.assertNotIn('name', proto.params)
+
+  #----------------------------------------------------------------------------
+  def test_fragmentCache(self):
+    from .email import fragmentCache
+    tpl = '''\
+<html
+ xmlns="http://www.w3.org/1999/xhtml"
+ xmlns:email="http://pythonhosted.org/genemail/xmlns/1.0"
+ ><head>
+  <style type="text/css">
+   td.logo{width:100px}
+   p{margin:0}
+   p + p{color:red}
+  </style>
+ </head><body>
+  <p>Hello, ${name}!</p>
+  %s
+  <p>Bye.</p>
+ </body></html>
+'''
+    region = '<table><tr><td class="logo">Logo</td></tr></table>text<p>Footer</p>'
+    cached = Manager(sender=StoredSender(), provider=template(
+      tpl % ('<email:cache key="footer">' + region + '</email:cache>',)))
+    plain = Manager(sender=StoredSender(), provider=template(tpl % (region,)))
+    hits = fragmentCache.hits
+    for name in ('Joe', 'Jane', 'Jim'):
+      html = cached.newEmail().clone(name=name).getHtml()
+      self.assertMultiLineEqual(html, plain.newEmail().clone(name=name).getHtml())
+      self.assertIn('<td class="logo" style="width: 100px">Logo</td>', html)
+      self.assertIn('text<p style="margin: 0">Footer</p>', html)
+      # the region is unwrapped before inlining, so sibling selectors work
+      self.assertIn('<p style="margin: 0;color: red">Bye.</p>', html)
+      self.assertNotIn('cache', html)
+    self.assertEqual(fragmentCache.hits - hits, 2)
+
+  #----------------------------------------------------------------------------
+  def test_sharedCache(self):
+    calls = []
+    def lookup():
+      calls.append(1)
+      return 'Special offer'
+    tpl = '<html><body><p>${sharedCache.get("promo", lookup)}</p></body></html>'
+    manager = Manager(sender=StoredSender(), provider=template(tpl))
+    for idx in range(3):
+      eml = manager.newEmail()
+      eml['lookup'] = lookup
+      self.assertIn('Special offer', eml.getHtml())
+    self.assertEqual(len(calls), 1)
+    self.assertIs(manager.newEmail()['sharedCache'], manager.sharedCache)
+
+  #----------------------------------------------------------------------------
+  def test_sharedCache_copy(self):
+    tpl = '<html><body><p>${x}</p></body></html>'
+    manager = Manager(sender=StoredSender(), provider=template(tpl))
+    manager.default['x'] = 5
+    eml = manager.newEmail()
+    self.assertIn('<p>5</p>', eml.getHtml())
+    self.assertIs(eml['sharedCache'], manager.sharedCache)
+    self.assertIsNot(eml['cache'], manager.default['cache'])
+    eml['x'] = 6
+    clone = eml.clone()
+    self.assertIn('<p>6</p>', clone.getHtml())
+    self.assertIs(clone['sharedCache'], manager.sharedCache)
+    self.assertIsNot(clone['cache'], eml['cache'])
+
+  #----------------------------------------------------------------------------
+  def test_renderMany(self):
+    tpl = '''\
+<html
+ xmlns="http://www.w3.org/1999/xhtml"
+ xmlns:email="http://pythonhosted.org/genemail/xmlns/1.0"
+ ><head><email:header name="To">${email}</email:header></head>
+ <body><p>Hello, ${name}!</p></body></html>
+'''
+    manager = Manager(sender=StoredSender(), provider=template(tpl),
+                      default=dict(headers={'from': 'noreply@example.com'}))
+    names  = ['Joe', 'Jane', 'Jim', 'Jill', 'Jack']
+    params = [dict(name=name, email=name.lower() + '@example.com')
+              for name in names]
+    for processes in (1, 2):
+      results = list(manager.renderMany('welcome', iter(params),
+                                        processes=processes))
+      self.assertEqual([res.index for res in results], range(len(names)))
+      for name, res in zip(names, results):
+        self.assertIn('Hello, ' + name + '!', res.message)
+        self.assertEqual(res.mailfrom, 'noreply@example.com')
+    results = manager.renderMany('welcome', params, processes=2, ordered=False)
+    self.assertEqual(sorted(res.index for res in results), range(len(names)))
+    self.assertEqual(
+      manager.renderMany('welcome', params, processes=2, send=True), 5)
+    self.assertEqual(len(manager.sender.emails), 5)
+    # the workers do not inherit cache locks held by other threads
+    locked  = threading.Event()
+    release = threading.Event()
+    def hold():
+      with manager.templates._lock:
+        locked.set()
+        release.wait(30)
+    thread = threading.Thread(target=hold)
+    thread.start()
+    try:
+      locked.wait(10)
+      results = list(manager.renderMany('welcome', params, processes=2))
+      self.assertEqual(len(results), 5)
+    finally:
+      release.set()
+      thread.join()
+
+  #----------------------------------------------------------------------------
+  def test_sendAsync(self):
+    tpl = '''\
+<html
+ xmlns="http://www.w3.org/1999/xhtml"
+ xmlns:email="http://pythonhosted.org/genemail/xmlns/1.0"
+ ><head><email:header name="To">${email}</email:header></head>
+ <body><p>Hello, ${name}!</p></body></html>
+'''
+    manager = Manager(sender=StoredSender(), provider=template(tpl),
+                      default=dict(headers={'from': 'noreply@example.com'}))
+    futures = manager.sendBatchAsync(
+      'welcome', [dict(name=name, email=name.lower() + '@example.com')
+                  for name in ('Joe', 'Jane', 'Jim')])
+    for future in futures:
+      self.assertIsNone(future.result(timeout=10))
+    self.assertEqual(
+      sorted(eml.recipients[0] for eml in manager.sender.emails),
+      ['jane@example.com', 'jim@example.com', 'joe@example.com'])
+    future = manager.sendAsync('welcome', dict(name='Nobody', email=''))
+    self.assertIsInstance(future.exception(timeout=10), MissingHeader)
+    self.assertEqual(len(manager.sender.emails), 3)
+
 #------------------------------------------------------------------------------
 # end of $Id$
 #------------------------------------------------------------------------------
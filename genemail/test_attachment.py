@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: Philip J Grabner <grabner@cadit.com>
+# date: 2013/12/02
+# copy: (C) Copyright 2013 Cadit Health Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+
+import unittest, tempfile, os
+import email.encoders, email.mime.base
+from StringIO import StringIO
+
+from .attachment import AttachmentContent, LazyMimePart
+
+#------------------------------------------------------------------------------
+def encode_base64(data):
+  part = email.mime.base.MIMEBase('application', 'octet-stream')
+  part.set_payload(data)
+  email.encoders.encode_base64(part)
+  return part.get_payload()
+
+#------------------------------------------------------------------------------
+class TestAttachmentContent(unittest.TestCase):
+
+  #----------------------------------------------------------------------------
+  def setUp(self):
+    fd, self.path = tempfile.mkstemp()
+    os.close(fd)
+
+  def tearDown(self):
+    os.unlink(self.path)
+
+  #----------------------------------------------------------------------------
+  def sources(self, data):
+    with open(self.path, 'wb') as fp:
+      fp.write(data)
+    yield AttachmentContent(path=self.path)
+    yield AttachmentContent(file=StringIO(data))
+    yield AttachmentContent(buffer=bytearray(data))
+    with open(self.path, 'rb') as fp:
+      yield AttachmentContent(file=fp)
+
+  #----------------------------------------------------------------------------
+  def test_base64(self):
+    for data in ('', 'x', 'abc\n', 'test_base64\x00\xff' * 100,
+                 'line\n' * 57):
+      for content in self.sources(data):
+        content.chunksize = 57
+        self.assertEqual(content.read(), data)
+        self.assertEqual(''.join(content.iterBase64()), encode_base64(data))
+
+  #----------------------------------------------------------------------------
+  def test_chunked(self):
+    content = AttachmentContent(buffer='0123456789' * 57)
+    content.chunksize = 57 * 2
+    self.assertEqual(len(list(content.iterChunks())), 5)
+    self.assertEqual(len(list(content.iterBase64())), 5)
+
+  #----------------------------------------------------------------------------
+  def test_sources(self):
+    with self.assertRaises(ValueError):
+      AttachmentContent()
+    with self.assertRaises(ValueError):
+      AttachmentContent(path=self.path, buffer='data')
+
+  #----------------------------------------------------------------------------
+  def test_lazyMimePart(self):
+    part = LazyMimePart(AttachmentContent(buffer='data\x00'), 'image', 'png')
+    self.assertEqual(part['content-transfer-encoding'], 'base64')
+    self.assertFalse(part.is_multipart())
+    self.assertEqual(part.get_payload(), 'ZGF0YQA=')
+    self.assertEqual(part.get_payload(decode=True), 'data\x00')
+    self.assertTrue(part.as_string().endswith('\n\nZGF0YQA='))
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: Philip J Grabner <grabner@cadit.com>
+# date: 2013/12/02
+# copy: (C) Copyright 2013 Cadit Health Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+import unittest, time, threading
+
+from .cache import LruCache, resetAfterFork
+
+#------------------------------------------------------------------------------
+class TestLruCache(unittest.TestCase):
+
+  #----------------------------------------------------------------------------
+  def test_autocaching(self):
+    cache = LruCache()
+    calls = []
+    def factory():
+      calls.append(1)
+      return 'value'
+    self.assertEqual(cache.get('key', factory), 'value')
+    self.assertEqual(cache.get('key', factory), 'value')
+    self.assertEqual(len(calls), 1)
+    self.assertEqual((cache.hits, cache.misses), (1, 1))
+    self.assertEqual(cache.get('other', 'static'), 'static')
+    self.assertEqual(cache['other'], 'static')
+
+  #----------------------------------------------------------------------------
+  def test_eviction(self):
+    cache = LruCache(maxsize=2)
+    cache['a'] = 1
+    cache['b'] = 2
+    cache.get('a')
+    cache['c'] = 3
+    self.assertEqual(sorted(cache.keys()), ['a', 'c'])
+    self.assertNotIn('b', cache)
+    cache.clear()
+    self.assertEqual(len(cache), 0)
+    self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+  #----------------------------------------------------------------------------
+  def test_maxbytes(self):
+    cache = LruCache(maxsize=None, maxbytes=10)
+    cache['a'] = 'x' * 4
+    cache['b'] = 'x' * 4
+    self.assertEqual(cache.bytes, 8)
+    cache['c'] = 'x' * 4
+    self.assertEqual(sorted(cache.keys()), ['b', 'c'])
+    self.assertEqual(cache.bytes, 8)
+    cache['d'] = 'x' * 20
+    self.assertEqual(cache.keys(), [])
+    self.assertEqual(cache.bytes, 0)
+
+  #----------------------------------------------------------------------------
+  def test_ttl(self):
+    now = [1000.0]
+    origtime, time.time = time.time, lambda: now[0]
+    try:
+      cache = LruCache(ttl=10)
+      cache['a'] = 'A'
+      self.assertEqual(cache.get('b', 'B', ttl=20), 'B')
+      cache.set('c', 'C', ttl=30)
+      now[0] += 15
+      self.assertNotIn('a', cache)
+      self.assertEqual(cache.get('a', lambda: 'A2'), 'A2')
+      self.assertEqual(cache['b'], 'B')
+      now[0] += 5
+      with self.assertRaises(KeyError):
+        cache['b']
+      self.assertEqual(cache['a'], 'A2')
+      self.assertEqual(cache['c'], 'C')
+      now[0] += 10
+      self.assertEqual(sorted(k for k in cache.keys() if k in cache), [])
+    finally:
+      time.time = origtime
+
+  #----------------------------------------------------------------------------
+  def test_resetAfterFork(self):
+    cache = LruCache()
+    cache['a'] = 'A'
+    locked  = threading.Event()
+    release = threading.Event()
+    def hold():
+      with cache._lock:
+        locked.set()
+        release.wait(10)
+    thread = threading.Thread(target=hold)
+    thread.start()
+    try:
+      locked.wait(10)
+      resetAfterFork()
+      # note: would block if the lock held by `thread` were kept
+      self.assertEqual(cache.get('a', 'A2'), 'A2')
+    finally:
+      release.set()
+      thread.join()
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
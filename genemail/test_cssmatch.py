@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: Philip J Grabner <grabner@cadit.com>
+# date: 2013/12/02
+# copy: (C) Copyright 2013 Cadit Health Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+import unittest
+import cssselect
+
+from . import util, cssmatch
+
+#------------------------------------------------------------------------------
+class TestCssMatch(unittest.TestCase):
+
+  html = '''\
+<html xmlns="http://www.w3.org/1999/xhtml">
+ <body>
+  <div id="main" class="box wide">
+   <p class="first">one</p>
+   <p lang="en-US">two</p>
+   <span>three</span>
+   <p class="last"></p>
+  </div>
+  <p>four</p>
+ </body>
+</html>
+'''
+
+  #----------------------------------------------------------------------------
+  def select(self, css):
+    doc = cssmatch.DocumentIndex(util.parseXml(self.html))
+    ret = []
+    for el in doc.select(cssmatch.compileSelector(css)):
+      ret.append(cssmatch.localName(el.tag)
+                 + ('#' + el.get('id') if el.get('id') else '')
+                 + ':' + (el.text or '').strip())
+    return ret
+
+  #----------------------------------------------------------------------------
+  def test_simple(self):
+    self.assertEqual(self.select('span'), ['span:three'])
+    self.assertEqual(self.select('#main'), ['div#main:'])
+    self.assertEqual(self.select('.wide'), ['div#main:'])
+    self.assertEqual(self.select('div.box.wide'), ['div#main:'])
+    self.assertEqual(self.select('p.first, p.last'), ['p:one', 'p:'])
+    self.assertEqual(len(self.select('*')), 8)
+
+  #----------------------------------------------------------------------------
+  def test_attributes(self):
+    self.assertEqual(self.select('[lang]'), ['p:two'])
+    self.assertEqual(self.select('[lang|=en]'), ['p:two'])
+    self.assertEqual(self.select('[lang^=en]'), ['p:two'])
+    self.assertEqual(self.select('[lang$=US]'), ['p:two'])
+    self.assertEqual(self.select('[class~=box]'), ['div#main:'])
+    self.assertEqual(self.select('[class=box]'), [])
+
+  #----------------------------------------------------------------------------
+  def test_combinators(self):
+    self.assertEqual(self.select('body p'), ['p:one', 'p:two', 'p:', 'p:four'])
+    self.assertEqual(self.select('body > p'), ['p:four'])
+    self.assertEqual(self.select('p.first + p'), ['p:two'])
+    self.assertEqual(self.select('p.first ~ p'), ['p:two', 'p:'])
+    self.assertEqual(self.select('span + p'), ['p:'])
+
+  #----------------------------------------------------------------------------
+  def test_pseudo(self):
+    self.assertEqual(self.select('div > p:first-child'), ['p:one'])
+    self.assertEqual(self.select('div > :last-child'), ['p:'])
+    self.assertEqual(self.select('div > p:last-of-type'), ['p:'])
+    self.assertEqual(self.select('span:only-of-type'), ['span:three'])
+    self.assertEqual(self.select('p:empty'), ['p:'])
+    self.assertEqual(self.select(':root'), ['html:'])
+    self.assertEqual(self.select('div > :nth-child(2n+1)'), ['p:one', 'span:three'])
+    self.assertEqual(self.select('div > p:nth-last-of-type(2)'), ['p:two'])
+    self.assertEqual(self.select('div > p:not(.first)'), ['p:two', 'p:'])
+    self.assertEqual(self.select('p:hover'), [])
+    self.assertEqual(self.select('div > p:first-of-type'), ['p:one'])
+    self.assertEqual(self.select('p:only-of-type'), ['p:four'])
+    self.assertEqual(self.select('div > :nth-last-child(2)'), ['span:three'])
+    self.assertEqual(self.select('div > p:nth-of-type(3)'), ['p:'])
+    self.assertEqual(self.select('span ~ :last-of-type'), ['p:'])
+
+  #----------------------------------------------------------------------------
+  def test_functions(self):
+    self.assertEqual(self.select('p:contains(two)'), ['p:two'])
+    self.assertEqual(self.select('div :contains("hre")'), ['span:three'])
+    self.assertEqual(
+      self.select(':contains(four)'), ['html:', 'body:', 'p:four'])
+    self.assertEqual(self.select('p:lang(en)'), ['p:two'])
+    self.assertEqual(self.select('p:lang(en-US)'), ['p:two'])
+    self.assertEqual(self.select('p:lang(e)'), [])
+    self.assertRaises(cssselect.ExpressionError, self.select, 'p:contains(1)')
+    self.assertRaises(cssselect.ExpressionError, self.select, 'p:bogus(1)')
+    html = '<html xml:lang="fr"><body>' \
+      '<p>un</p><p lang="de">zwei</p></body></html>'
+    doc  = cssmatch.DocumentIndex(util.parseXml(html))
+    self.assertEqual(
+      [el.text for el in doc.select(cssmatch.compileSelector('p:lang(fr)'))],
+      ['un'])
+
+  #----------------------------------------------------------------------------
+  def test_siblingIndex(self):
+    doc  = cssmatch.DocumentIndex(util.parseXml(self.html))
+    root = doc.root
+    div  = doc.buckets['id']['main'][0]
+    self.assertEqual(doc.siblingIndex(root), 0)
+    self.assertEqual(doc.typeIndex(root), (0, 1))
+    self.assertEqual([doc.siblingIndex(el) for el in doc.children[div]],
+                     [0, 1, 2, 3])
+    self.assertEqual([doc.typeIndex(el) for el in doc.children[div]],
+                     [(0, 3), (1, 3), (0, 1), (2, 3)])
+
+  #----------------------------------------------------------------------------
+  def test_buckets(self):
+    doc = cssmatch.DocumentIndex(util.parseXml(self.html))
+    def candidates(css):
+      return len(doc.candidates(cssmatch.compileSelector(css)))
+    self.assertEqual(candidates('body div#main.box'), 1)
+    self.assertEqual(candidates('div > p.first'), 1)
+    self.assertEqual(candidates('div > p'), 4)
+    self.assertEqual(candidates('p:not(.first)'), 4)
+    self.assertEqual(candidates('span, .last'), 2)
+    self.assertEqual(candidates('p *'), 8)
+    self.assertEqual(candidates('[lang], p'), 8)
+    self.assertEqual(candidates('.bogus'), 0)
+
+  #----------------------------------------------------------------------------
+  def test_unsupported(self):
+    self.assertRaises(cssselect.ExpressionError, self.select, 'p::first-line')
+    self.assertRaises(cssselect.ExpressionError, self.select, 'p:bogus')
+    self.assertRaises(cssselect.SelectorSyntaxError, self.select, 'p[')
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
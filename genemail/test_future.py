@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: Philip J Grabner <grabner@cadit.com>
+# date: 2013/12/02
+# copy: (C) Copyright 2013 Cadit Health Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+
+import unittest, threading
+
+from .future import Future, ThreadExecutor, Scheduler
+
+#------------------------------------------------------------------------------
+class TestFuture(unittest.TestCase):
+
+  #----------------------------------------------------------------------------
+  def test_future(self):
+    future = Future()
+    done   = []
+    future.add_done_callback(done.append)
+    self.assertFalse(future.done())
+    with self.assertRaises(RuntimeError):
+      future.result(timeout=0.01)
+    future.set_result(42)
+    self.assertEqual(future.result(), 42)
+    self.assertIsNone(future.exception())
+    self.assertEqual(done, [future])
+    with self.assertRaises(RuntimeError):
+      future.set_result(43)
+    future.add_done_callback(done.append)
+    self.assertEqual(len(done), 2)
+
+  #----------------------------------------------------------------------------
+  def test_chain(self):
+    source = Future()
+    target = Future().chain(source)
+    source.set_exception(ValueError('boom'))
+    with self.assertRaises(ValueError):
+      target.result()
+
+  #----------------------------------------------------------------------------
+  def test_executor(self):
+    executor = ThreadExecutor(workers=3)
+    gate     = threading.Event()
+    blocked  = [executor.submit(gate.wait, 10) for idx in range(3)]
+    future   = executor.submit(lambda x: x * 2, 21)
+    self.assertFalse(future.done())
+    gate.set()
+    self.assertEqual(future.result(timeout=10), 42)
+    self.assertTrue(all(item.result(timeout=10) for item in blocked))
+    self.assertEqual(len(executor._threads), 3)
+    self.assertIsInstance(
+      executor.submit(int, 'x').exception(timeout=10), ValueError)
+
+  #----------------------------------------------------------------------------
+  def test_scheduler(self):
+    scheduler = Scheduler()
+    calls     = []
+    done      = threading.Event()
+    scheduler.schedule(0.05, done.set)
+    scheduler.schedule(0.02, calls.append, 'second')
+    scheduler.schedule(0, calls.append, 'first')
+    self.assertTrue(done.wait(10))
+    self.assertEqual(calls, ['first', 'second'])
+    self.assertEqual(len(scheduler), 0)
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
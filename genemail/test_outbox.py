@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: Philip J Grabner <grabner@cadit.com>
+# date: 2013/12/02
+# copy: (C) Copyright 2013 Cadit Health Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+
+import unittest, tempfile, shutil, os, json, smtplib, multiprocessing
+
+from .outbox import Outbox, OutboxSender
+from .test_spool import FlakySender
+
+#------------------------------------------------------------------------------
+def claimAll(path, queue):
+  outbox = Outbox(path)
+  ids = []
+  while True:
+    entries = outbox.claim(limit=3)
+    if not entries:
+      break
+    ids.extend(entry.id for entry in entries)
+  queue.put(ids)
+
+#------------------------------------------------------------------------------
+class TestOutbox(unittest.TestCase):
+
+  #----------------------------------------------------------------------------
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path   = os.path.join(self.tmpdir, 'outbox.db')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  #----------------------------------------------------------------------------
+  def test_outbox(self):
+    sender = OutboxSender(self.path, backoff=0)
+    outbox = sender.outbox
+    self.assertEqual(
+      outbox.db.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+    self.assertIsNone(outbox.stats().oldest)
+    for idx in range(3):
+      sender.send('from%d@example.com' % idx, 'to@example.com',
+                  iter(['msg', '\x00%d\n' % idx]))
+    stats = outbox.stats()
+    self.assertEqual((stats.depth, stats.pending, stats.sent), (3, 3, 0))
+    self.assertGreaterEqual(stats.oldest, 0)
+    flaky = FlakySender({
+      'from1@example.com': smtplib.SMTPSenderRefused(550, 'no', 'from1'),
+      'from2@example.com': smtplib.SMTPSenderRefused(451, 'later', 'from2'),
+    })
+    res = outbox.drain(flaky, batch=2)
+    # note: with `backoff` set to 0, the deferred message is retried
+    #       until it reaches `maxAttempts`
+    self.assertEqual((res.sent, res.failed, res.deferred), (1, 2, 4))
+    self.assertEqual(flaky.emails[0].message, 'msg\x000\n')
+    self.assertEqual(flaky.emails[0].recipients, ['to@example.com'])
+    stats = outbox.stats()
+    self.assertEqual(
+      (stats.depth, stats.sent, stats.failed, stats.oldest), (0, 1, 2, None))
+    self.assertEqual(outbox.purge(), 1)
+
+  #----------------------------------------------------------------------------
+  def test_drain_refused(self):
+    outbox = Outbox(self.path)
+    outbox.put('from@example.com',
+               ['to@example.com', 'full@example.com', 'bad@example.com'],
+               'msg\n')
+    sender = FlakySender({}, refused={
+      'full@example.com': (451, 'mailbox full'),
+      'bad@example.com':  (550, 'no such user')})
+    res = outbox.drain(sender)
+    self.assertEqual((res.sent, res.failed, res.deferred), (1, 1, 1))
+    rows = outbox.db.execute(
+      'SELECT recipients, status, attempts, error FROM outbox ORDER BY id'
+    ).fetchall()
+    self.assertEqual(
+      [(json.loads(row[0]), row[1], row[2]) for row in rows],
+      [(['full@example.com'], 'pending', 1),
+       (['bad@example.com'], 'failed', 1)])
+    self.assertEqual(
+      json.loads(rows[1][3]), {'bad@example.com': [550, 'no such user']})
+
+  #----------------------------------------------------------------------------
+  def test_drain_connectionError(self):
+    outbox = Outbox(self.path, maxAttempts=1)
+    for idx in range(3):
+      outbox.put('from%d@example.com' % idx, ['to@example.com'], 'msg\n')
+    sender = FlakySender({
+      'from1@example.com': smtplib.SMTPServerDisconnected('gone')})
+    res = outbox.drain(sender)
+    self.assertEqual((res.sent, res.failed, res.deferred), (1, 0, 2))
+    # no delivery attempt is counted against the released messages
+    stats = outbox.stats()
+    self.assertEqual((stats.pending, stats.sent, stats.failed), (2, 1, 0))
+    self.assertEqual(
+      [entry.attempts for entry in outbox.claim()], [0, 0])
+
+  #----------------------------------------------------------------------------
+  def test_recover(self):
+    outbox = Outbox(self.path)
+    outbox.put('from@example.com', ['to@example.com'], 'msg\n')
+    entries = outbox.claim()
+    self.assertEqual(len(entries), 1)
+    self.assertEqual(outbox.claim(), [])
+    self.assertEqual(outbox.stats().sending, 1)
+    self.assertEqual(outbox.recover(60), 0)
+    self.assertEqual(outbox.recover(-1), 1)
+    self.assertEqual([entry.id for entry in outbox.claim()], [entries[0].id])
+
+  #----------------------------------------------------------------------------
+  def test_concurrentClaims(self):
+    outbox = Outbox(self.path)
+    ids = [outbox.put('from@example.com', ['to@example.com'], 'msg\n')
+           for idx in range(50)]
+    queue = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=claimAll, args=(self.path, queue))
+             for idx in range(4)]
+    for proc in procs:
+      proc.start()
+    claimed = []
+    for proc in procs:
+      claimed.extend(queue.get(timeout=30))
+    for proc in procs:
+      proc.join()
+    self.assertEqual(sorted(claimed), ids)
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
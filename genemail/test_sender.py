@@ -0,0 +1,634 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: Philip J Grabner <grabner@cadit.com>
+# date: 2013/12/02
+# copy: (C) Copyright 2013 Cadit Health Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+
+import unittest, smtplib, socket, smtpd, asyncore, threading, Queue, time
+from StringIO import StringIO
+from templatealchemy.util import adict
+
+from .sender import Sender, SmtpSender, PooledSmtpSender, AsyncSmtpSender, \
+    QueuedSender, RetryingSender, StoredSender, DebugSender, DataEncoder, \
+    iterMessage, isTransientError, isPermanentError
+from .future import Future
+
+#------------------------------------------------------------------------------
+class FakeSmtp(object):
+  def __init__(self, refuse=(), defer=(), maxrcpt=None):
+    self.refuse  = refuse
+    self.defer   = defer
+    self.maxrcpt = maxrcpt
+    self.nrcpt   = 0
+    self.log     = []
+    self.data    = []
+    self.reply   = None
+    self.alive   = True
+    self.closing = ()
+  def ehlo_or_helo_if_needed(self):
+    pass
+  def mail(self, mailfrom):
+    self.log.append(('mail', mailfrom))
+    if not self.alive:
+      raise smtplib.SMTPServerDisconnected('connection closed')
+    self.nrcpt = 0
+    return (250, 'ok')
+  def rcpt(self, rcpt):
+    self.log.append(('rcpt', rcpt))
+    if rcpt in self.refuse:
+      return (550, 'no such user')
+    if rcpt in self.closing:
+      return (421, 'closing connection')
+    if rcpt in self.defer:
+      return (451, 'try again later')
+    if self.maxrcpt is not None and self.nrcpt >= self.maxrcpt:
+      return (452, 'too many recipients')
+    self.nrcpt += 1
+    return (250, 'ok')
+  def rset(self):
+    self.log.append(('rset',))
+  def putcmd(self, cmd):
+    self.log.append((cmd,))
+    self.reply = 354 if cmd == 'data' else 250
+  def getreply(self):
+    reply, self.reply = self.reply, 250
+    return (reply, 'ok')
+  def send(self, data):
+    self.data.append(data)
+  def noop(self):
+    self.log.append(('noop',))
+    if not self.alive:
+      raise smtplib.SMTPServerDisconnected('connection closed')
+    return (250, 'ok')
+  def quit(self):
+    self.log.append(('quit',))
+    if not self.alive:
+      raise smtplib.SMTPServerDisconnected('connection closed')
+  def close(self):
+    self.log.append(('close',))
+    self.alive = False
+
+#------------------------------------------------------------------------------
+class FakePooledSender(PooledSmtpSender):
+  def __init__(self, *args, **kw):
+    super(FakePooledSender, self).__init__(*args, **kw)
+    self.connections = []
+  def connect(self):
+    self.connections.append(FakeSmtp(refuse=('bad@example.com',)))
+    return self.connections[-1]
+
+#------------------------------------------------------------------------------
+class FakeSmtpSender(SmtpSender):
+  def __init__(self, *args, **kw):
+    self.smtpOptions = kw.pop('smtpOptions', dict(refuse=('bad@example.com',)))
+    super(FakeSmtpSender, self).__init__(*args, **kw)
+    self.connections = []
+  def connect(self):
+    self.connections.append(FakeSmtp(**self.smtpOptions))
+    return self.connections[-1]
+
+#------------------------------------------------------------------------------
+class SinkServer(smtpd.SMTPServer):
+  def __init__(self):
+    self.messages = []
+    # note: smtpd.SMTPServer always registers with the global map
+    smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+    self.port = self.socket.getsockname()[1]
+  def process_message(self, peer, mailfrom, rcpttos, data):
+    if mailfrom == 'reject@example.com':
+      return '554 rejected'
+    self.messages.append((mailfrom, rcpttos, data))
+  def start(self):
+    thread = threading.Thread(
+      target=asyncore.loop, kwargs=dict(timeout=0.05))
+    thread.daemon = True
+    thread.start()
+  def stop(self):
+    self.close()
+
+#------------------------------------------------------------------------------
+class TestSender(unittest.TestCase):
+
+  #----------------------------------------------------------------------------
+  def test_iterMessage(self):
+    self.assertEqual(list(iterMessage('abc')), ['abc'])
+    self.assertEqual(list(iterMessage(['a', 'bc'])), ['a', 'bc'])
+    self.assertEqual(list(iterMessage(StringIO('abcde'), chunksize=2)),
+                     ['ab', 'cd', 'e'])
+
+  #----------------------------------------------------------------------------
+  def test_dataEncoder(self):
+    for src in (
+        'a\nb\r\nc\rd\n',
+        '.dot\n..dots\n.\nend',
+        'line\r\n.\r\nmore\r',
+        '',
+      ):
+      expected = smtplib.quotedata(src)
+      if expected[-2:] != smtplib.CRLF:
+        expected += smtplib.CRLF
+      expected += '.' + smtplib.CRLF
+      for size in range(1, max(len(src), 1) + 1):
+        encoder = DataEncoder()
+        chunks  = [src[idx:idx + size] for idx in range(0, len(src), size)]
+        output  = ''.join(encoder.encode(chunk) for chunk in chunks)
+        self.assertEqual(output + encoder.close(), expected,
+                         'chunk size %d of %r' % (size, src))
+
+  #----------------------------------------------------------------------------
+  def test_smtp_streaming(self):
+    smtp = FakeSmtp(refuse=('bad@example.com',))
+    refused = SmtpSender().sendmail(
+      smtp, 'from@example.com', ['to@example.com', 'bad@example.com'],
+      iter(['Subject: test\n\n', '.hidden\n', 'body']))
+    self.assertEqual(refused, {'bad@example.com': (550, 'no such user')})
+    self.assertEqual(smtp.log, [
+      ('mail', 'from@example.com'),
+      ('rcpt', 'to@example.com'),
+      ('rcpt', 'bad@example.com'),
+      ('data',),
+    ])
+    self.assertEqual(len(smtp.data), 4)
+    self.assertEqual(
+      ''.join(smtp.data),
+      'Subject: test\r\n\r\n..hidden\r\nbody\r\n.\r\n')
+
+  #----------------------------------------------------------------------------
+  def test_smtp_allrefused(self):
+    smtp = FakeSmtp(refuse=('bad@example.com',))
+    with self.assertRaises(smtplib.SMTPRecipientsRefused):
+      SmtpSender().sendmail(
+        smtp, 'from@example.com', 'bad@example.com', 'Subject: test\n')
+    self.assertEqual(smtp.log[-1], ('rset',))
+    self.assertEqual(smtp.data, [])
+
+  #----------------------------------------------------------------------------
+  def test_stored_stream(self):
+    sender = StoredSender()
+    sender.send('from@example.com', ['to@example.com'], iter(['a\n', 'b\n']))
+    self.assertEqual(sender.emails[0].message, 'a\nb\n')
+
+  #----------------------------------------------------------------------------
+  def test_pooled(self):
+    sender = FakePooledSender(maxMessages=3)
+    for idx in range(4):
+      sender.send('from@example.com', 'to@example.com', 'Subject: test\n')
+    self.assertEqual(len(sender.connections), 2)
+    self.assertEqual(sender.connections[0].log[-1], ('quit',))
+    self.assertEqual(len(sender._idle), 1)
+    # rejected transactions do not discard the connection
+    with self.assertRaises(smtplib.SMTPRecipientsRefused):
+      sender.send('from@example.com', 'bad@example.com', 'Subject: test\n')
+    self.assertEqual(len(sender.connections), 2)
+    self.assertEqual(len(sender._idle), 1)
+    sender.close()
+    self.assertEqual(sender._idle, [])
+    self.assertEqual(sender.connections[1].log[-1], ('quit',))
+
+  #----------------------------------------------------------------------------
+  def test_pooled_healthcheck(self):
+    sender = FakePooledSender(checkInterval=0)
+    sender.send('from@example.com', 'to@example.com', 'Subject: test\n')
+    sender.send('from@example.com', 'to@example.com', 'Subject: test\n')
+    self.assertEqual(len(sender.connections), 1)
+    self.assertIn(('noop',), sender.connections[0].log)
+    sender.connections[0].alive = False
+    sender.send('from@example.com', 'to@example.com', 'Subject: test\n')
+    self.assertEqual(len(sender.connections), 2)
+    # idle connections are closed, not reused
+    sender.idleTimeout = 0
+    sender.send('from@example.com', 'to@example.com', 'Subject: test\n')
+    self.assertEqual(len(sender.connections), 3)
+    self.assertEqual(sender.connections[1].log[-1], ('quit',))
+
+  #----------------------------------------------------------------------------
+  def test_pooled_failure(self):
+    sender = FakePooledSender()
+    def broken():
+      yield 'Subject: test\n'
+      raise socket.error('broken pipe')
+    with self.assertRaises(socket.error):
+      sender.send('from@example.com', 'to@example.com', broken())
+    self.assertEqual(sender._idle, [])
+    sender.send('from@example.com', 'to@example.com', 'Subject: test\n')
+    self.assertEqual(len(sender.connections), 2)
+
+  #----------------------------------------------------------------------------
+  def test_dataFailure(self):
+    def broken():
+      yield 'Subject: test\n'
+      raise IOError('attachment deleted')
+    sender = FakeSmtpSender()
+    with self.assertRaises(IOError):
+      sender.send('from@example.com', 'to@example.com', broken())
+    # the connection is dropped instead of sending QUIT mid-DATA
+    log = sender.connections[0].log
+    self.assertEqual(log[log.index(('data',)) + 1], ('close',))
+    pooled = FakePooledSender()
+    with self.assertRaises(IOError):
+      pooled.send('from@example.com', 'to@example.com', broken())
+    log = pooled.connections[0].log
+    self.assertEqual(log[log.index(('data',)) + 1], ('close',))
+    self.assertEqual(pooled._idle, [])
+
+  #----------------------------------------------------------------------------
+  def test_pooled_serverClosed(self):
+    sender = FakePooledSender()
+    sender.send('from@example.com', 'to@example.com', 'Subject: test\n')
+    # the server dropped the idle connection (within `checkInterval`)
+    sender.connections[0].alive = False
+    self.assertEqual(
+      sender.send('from@example.com', 'to@example.com', iter(['Subject: x\n'])),
+      {})
+    self.assertEqual(len(sender.connections), 2)
+    self.assertEqual(
+      ''.join(sender.connections[1].data), 'Subject: x\r\n.\r\n')
+    self.assertEqual(sender._idle[0].smtp, sender.connections[1])
+    # a 421 reply discards the connection...
+    sender.connections[1].closing = ('closing@example.com',)
+    self.assertEqual(
+      sender.send('from@example.com', ['to@example.com', 'closing@example.com'],
+                  'Subject: test\n'),
+      {'closing@example.com': (421, 'closing connection')})
+    self.assertEqual(sender._idle, [])
+    self.assertEqual(sender.connections[1].log[-1], ('quit',))
+    # ... and is not retried once MAIL FROM has been accepted
+    sender.send('from@example.com', 'to@example.com', 'Subject: test\n')
+    sender.connections[2].closing = ('closing@example.com',)
+    with self.assertRaises(smtplib.SMTPRecipientsRefused):
+      sender.send('from@example.com', 'closing@example.com', 'Subject: test\n')
+    self.assertEqual(len(sender.connections), 3)
+    self.assertEqual(sender._idle, [])
+
+  #----------------------------------------------------------------------------
+  def test_async(self):
+    sink = SinkServer()
+    sink.start()
+    try:
+      # note: smtpd's listen backlog is 5, so keep concurrency below that
+      sender  = AsyncSmtpSender(host='127.0.0.1', port=sink.port,
+                                concurrency=4, timeout=10)
+      futures = [
+        sender.sendAsync('from@example.com', 'to%d@example.com' % idx,
+                         iter(['Subject: %d\n\n' % idx, '.dot\nbody\n']))
+        for idx in range(10)]
+      for future in futures:
+        self.assertEqual(future.result(timeout=10), {})
+      self.assertEqual(len(sink.messages), 10)
+      self.assertEqual(
+        sorted(sink.messages)[0],
+        ('from@example.com', ['to0@example.com'], 'Subject: 0\n\n.dot\nbody'))
+      with self.assertRaises(smtplib.SMTPDataError):
+        sender.send('reject@example.com', ['to@example.com'], 'Subject: x\n')
+      self.assertEqual(len(sink.messages), 10)
+      res = sender.sendMany([
+        ('reject@example.com', ['to@example.com'], 'Subject: x\n'),
+        ('from@example.com', ['to@example.com'], 'Subject: y\n')])
+      self.assertIsInstance(res[0].error, smtplib.SMTPDataError)
+      self.assertEqual((res[1].result, res[1].error), ({}, None))
+      self.assertEqual(len(sink.messages), 11)
+      sender.maxRecipients = 2
+      rcpts = ['to%d@example.com' % idx for idx in range(5)]
+      self.assertEqual(
+        sender.send('from@example.com', rcpts, 'Subject: z\n'), {})
+      self.assertEqual(len(sink.messages), 14)
+      self.assertEqual(sorted(sum([m[1] for m in sink.messages[-3:]], [])),
+                       rcpts)
+    finally:
+      sink.stop()
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sender.smtpPort = sock.getsockname()[1]
+    sock.close()
+    future = sender.sendAsync('from@example.com', 'to@example.com', 'x')
+    self.assertIsInstance(future.exception(timeout=10), socket.error)
+
+  #----------------------------------------------------------------------------
+  def test_async_slowConnect(self):
+    from . import sender as sendermod
+    started = threading.Event()
+    release = threading.Event()
+    class SlowTransaction(object):
+      # e.g. a slow DNS lookup of the server
+      def __init__(self, *args):
+        started.set()
+        release.wait(10)
+        raise socket.error('unreachable')
+    orig, sendermod._SmtpTransaction = \
+      sendermod._SmtpTransaction, SlowTransaction
+    try:
+      sender = AsyncSmtpSender(concurrency=1)
+      first  = sender.sendAsync('from@example.com', 'to@example.com', 'x')
+      started.wait(10)
+      # the loop does not hold the lock while connecting
+      begin  = time.time()
+      second = sender.sendAsync('from@example.com', 'to@example.com', 'y')
+      self.assertLess(time.time() - begin, 1)
+      release.set()
+      self.assertIsInstance(first.exception(timeout=10), socket.error)
+      self.assertIsInstance(second.exception(timeout=10), socket.error)
+    finally:
+      release.set()
+      sendermod._SmtpTransaction = orig
+
+  #----------------------------------------------------------------------------
+  def test_queued(self):
+    gate   = threading.Event()
+    stored = StoredSender()
+    class GatedSender(object):
+      def send(self, mailfrom, recipients, message):
+        gate.wait(10)
+        if mailfrom == 'bad@example.com':
+          raise smtplib.SMTPSenderRefused(550, 'no', mailfrom)
+        stored.send(mailfrom, recipients, message)
+        return len(stored.emails)
+    sender = QueuedSender(GatedSender(), maxsize=1, block=False)
+    first  = sender.send('from@example.com', ['to@example.com'], 'a\n')
+    # wait for the worker to pick up the first message
+    while not sender.queue.empty():
+      time.sleep(0.01)
+    second = sender.send('bad@example.com', ['to@example.com'], iter(['b']))
+    with self.assertRaises(Queue.Full):
+      sender.send('from@example.com', ['to@example.com'], 'c\n')
+    self.assertFalse(first.done())
+    gate.set()
+    sender.flush()
+    self.assertEqual(first.result(), 1)
+    self.assertIsInstance(second.exception(), smtplib.SMTPSenderRefused)
+    third = sender.send('from@example.com', ['to@example.com'], 'c\n')
+    sender.close()
+    self.assertEqual(third.result(), 2)
+    self.assertEqual([eml.message for eml in stored.emails], ['a\n', 'c\n'])
+    with self.assertRaises(RuntimeError):
+      sender.send('from@example.com', ['to@example.com'], 'd\n')
+
+  #----------------------------------------------------------------------------
+  def test_sendMany_smtp(self):
+    def broken():
+      yield 'Subject: test\n'
+      raise socket.error('broken pipe')
+    sender = FakeSmtpSender()
+    res = sender.sendMany([
+      ('from@example.com', ['to@example.com', 'bad@example.com'], 'a\n'),
+      ('from@example.com', ['bad@example.com'], 'b\n'),
+      ('from@example.com', ['to@example.com'], broken()),
+      adict(mailfrom='from@example.com', recipients=['to@example.com'],
+            message='d\n'),
+    ])
+    self.assertEqual(
+      [(r.result, type(r.error)) for r in res], [
+        ({'bad@example.com': (550, 'no such user')}, type(None)),
+        (None, smtplib.SMTPRecipientsRefused),
+        (None, socket.error),
+        ({}, type(None)),
+      ])
+    # the connection is only replaced after the connection-level failure
+    self.assertEqual(len(sender.connections), 2)
+    self.assertEqual(sender.connections[1].log[-1], ('quit',))
+    self.assertEqual(
+      [log[0] for log in sender.connections[0].log].count('mail'), 3)
+
+  #----------------------------------------------------------------------------
+  def test_sendMany_closing(self):
+    class ClosingSmtp(FakeSmtp):
+      def rcpt(self, rcpt):
+        ret = super(ClosingSmtp, self).rcpt(rcpt)
+        if ret[0] == 421:
+          self.alive = False
+        return ret
+    sender = FakeSmtpSender()
+    def connect():
+      sender.connections.append(ClosingSmtp())
+      sender.connections[-1].closing = ('closing@example.com',)
+      return sender.connections[-1]
+    sender.connect = connect
+    res = sender.sendMany([
+      ('from@example.com', ['closing@example.com'], 'a\n'),
+      ('from@example.com', ['to@example.com'], 'b\n'),
+      ('from@example.com', ['to@example.com', 'closing@example.com'], 'c\n'),
+      ('from@example.com', ['to@example.com'], 'd\n'),
+    ])
+    self.assertIsInstance(res[0].error, smtplib.SMTPRecipientsRefused)
+    self.assertEqual([r.result for r in res[1:]], [
+      {}, {'closing@example.com': (421, 'closing connection')}, {}])
+    self.assertEqual(len(sender.connections), 3)
+
+  #----------------------------------------------------------------------------
+  def test_sendMany_quitError(self):
+    class ClosedSmtp(FakeSmtp):
+      # e.g. the server sent a 421 and closed the connection after the
+      # last message was accepted
+      def quit(self):
+        super(ClosedSmtp, self).quit()
+        raise smtplib.SMTPServerDisconnected('connection closed')
+    sender = FakeSmtpSender()
+    msgs = [('from@example.com', ['to@example.com'], 'a\n')] * 2
+    def connect():
+      sender.connections.append(ClosedSmtp())
+      return sender.connections[-1]
+    sender.connect = connect
+    res = sender.sendMany(msgs)
+    self.assertEqual([(r.result, r.error) for r in res], [({}, None)] * 2)
+    self.assertEqual(sender.connections[0].log[-2:], [('quit',), ('close',)])
+    self.assertEqual(sender.send(*msgs[0]), {})
+
+  #----------------------------------------------------------------------------
+  def test_sendMany(self):
+    class OddSender(Sender):
+      def send(self, mailfrom, recipients, message):
+        if message == 'odd':
+          raise ValueError(message)
+        return message
+    msgs = [('from@example.com', ['to@example.com'], 'odd'),
+            ('from@example.com', ['to@example.com'], 'Subject: even\n\nbody')]
+    res  = OddSender().sendMany(msgs)
+    self.assertIsInstance(res[0].error, ValueError)
+    self.assertEqual((res[1].result, res[1].error), (msgs[1][2], None))
+    for kls in (StoredSender, DebugSender):
+      sender = kls()
+      res = sender.sendMany(iter(msgs))
+      self.assertEqual([r.error for r in res], [None, None])
+      self.assertEqual([r.recipients for r in res], [['to@example.com']] * 2)
+      self.assertEqual([eml.message for eml in sender.emails],
+                       [msg[2] for msg in msgs])
+    self.assertEqual(sender.emails[1].subject, 'even')
+    self.assertEqual(sender.emails[1].plain, 'body')
+
+  #----------------------------------------------------------------------------
+  def test_queued_close(self):
+    # messages sent concurrently with close() are either rejected or
+    # delivered, but never left behind in the queue
+    for attempt in range(20):
+      sender  = QueuedSender(StoredSender(), workers=2)
+      futures = []
+      def produce():
+        for idx in range(50):
+          try:
+            futures.append(sender.send('from@example.com', 'to@example.com',
+                                       'msg\n'))
+          except RuntimeError:
+            return
+      threads = [threading.Thread(target=produce) for idx in range(4)]
+      for thread in threads:
+        thread.start()
+      sender.close()
+      for thread in threads:
+        thread.join()
+      for future in futures:
+        self.assertIsNone(future.exception(timeout=10))
+      self.assertEqual(len(sender.sender.emails), len(futures))
+
+  #----------------------------------------------------------------------------
+  def test_maxRecipients(self):
+    sender = FakeSmtpSender(maxRecipients=3, smtpOptions=dict(
+      refuse=('bad@example.com',), defer=('later@example.com',), maxrcpt=2))
+    rcpts  = ['to%d@example.com' % idx for idx in range(6)]
+    self.assertEqual(
+      sender.send('from@example.com', rcpts + ['bad@example.com'], 'a\n'),
+      {'bad@example.com': (550, 'no such user')})
+    smtp = sender.connections[0]
+    self.assertEqual(smtp.log.count(('data',)), 3)
+    self.assertEqual(
+      sorted(set(log[1] for log in smtp.log if log[0] == 'rcpt')),
+      ['bad@example.com'] + rcpts)
+    self.assertEqual(
+      sender.sendmail(FakeSmtp(
+        refuse=('bad@example.com',), defer=('later@example.com',), maxrcpt=2),
+        'from@example.com',
+        rcpts + ['bad@example.com', 'later@example.com'], 'a\n'),
+      {'bad@example.com': (550, 'no such user'),
+       'later@example.com': (451, 'try again later')})
+    with self.assertRaises(smtplib.SMTPRecipientsRefused):
+      sender.sendmail(
+        FakeSmtp(refuse=('bad@example.com',), defer=('later@example.com',)),
+        'from@example.com',
+        ['bad@example.com', 'later@example.com'] * 2, 'a\n')
+
+  #----------------------------------------------------------------------------
+  def test_maxRecipients_disconnect(self):
+    class DroppingSmtp(FakeSmtp):
+      def mail(self, mailfrom):
+        if self.log.count(('data',)) >= 1:
+          raise smtplib.SMTPServerDisconnected('connection closed')
+        return super(DroppingSmtp, self).mail(mailfrom)
+    sender = FakeSmtpSender(maxRecipients=2)
+    rcpts  = ['to%d@example.com' % idx for idx in range(5)]
+    # once a transaction succeeded, the undelivered recipients are
+    # reported instead of raising
+    self.assertEqual(
+      sender.sendmail(DroppingSmtp(), 'from@example.com', rcpts, 'a\n'),
+      dict.fromkeys(rcpts[2:], (421, 'connection closed')))
+    smtp = DroppingSmtp()
+    smtp.log.append(('data',))
+    with self.assertRaises(smtplib.SMTPServerDisconnected):
+      sender.sendmail(smtp, 'from@example.com', rcpts, 'a\n')
+
+  #----------------------------------------------------------------------------
+  def test_async_maxRecipients(self):
+    class ScriptedAsyncSender(AsyncSmtpSender):
+      calls = []
+      def sendAsync(self, mailfrom, recipients, message):
+        if len(recipients) > self.maxRecipients:
+          return super(ScriptedAsyncSender, self).sendAsync(
+            mailfrom, recipients, message)
+        self.calls.append(list(recipients))
+        ret = Future()
+        if 'gone@example.com' in recipients and len(self.calls) == 2:
+          ret.set_exception(smtplib.SMTPServerDisconnected('gone'))
+          return ret
+        # emulates a server that accepts two recipients per transaction
+        refused = dict((rcpt, (452, 'too many recipients'))
+                       for rcpt in recipients[2:])
+        if 'bad@example.com' in recipients:
+          refused['bad@example.com'] = (550, 'no such user')
+        if len(refused) == len(recipients):
+          ret.set_exception(smtplib.SMTPRecipientsRefused(refused))
+        else:
+          ret.set_result(refused)
+        return ret
+    sender = ScriptedAsyncSender(maxRecipients=3)
+    rcpts  = ['to%d@example.com' % idx for idx in range(4)]
+    self.assertEqual(
+      sender.send('from@example.com',
+                  rcpts + ['gone@example.com', 'bad@example.com'], 'a\n'),
+      {'bad@example.com': (550, 'no such user')})
+    self.assertEqual(sender.calls, [
+      ['to0@example.com', 'to1@example.com', 'to2@example.com'],
+      ['to3@example.com', 'gone@example.com', 'bad@example.com'],
+      ['to2@example.com', 'to3@example.com', 'gone@example.com'],
+      ['bad@example.com'],
+      ['gone@example.com'],
+    ])
+
+  #----------------------------------------------------------------------------
+  def test_errorClassification(self):
+    for exc, transient, permanent in (
+        (smtplib.SMTPServerDisconnected('gone'),          True,  False),
+        (socket.error('refused'),                          True,  False),
+        (smtplib.SMTPSenderRefused(451, 'later', 'f'),     True,  False),
+        (smtplib.SMTPDataError(554, 'rejected'),           False, True),
+        (smtplib.SMTPRecipientsRefused({'a': (550, 'no'),
+                                        'b': (452, 'full')}), True, False),
+        (smtplib.SMTPRecipientsRefused({'a': (550, 'no')}), False, True),
+        (ValueError('bug'),                                False, False),
+      ):
+      self.assertEqual(isTransientError(exc), transient, repr(exc))
+      self.assertEqual(isPermanentError(exc), permanent, repr(exc))
+
+  #----------------------------------------------------------------------------
+  def test_retrying(self):
+    class ScriptedSender(object):
+      def __init__(self, *replies):
+        self.replies = list(replies)
+        self.calls   = []
+      def send(self, mailfrom, recipients, message):
+        self.calls.append(list(recipients))
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+          raise reply
+        return reply
+    msg = ('from@example.com', ['a@example.com', 'b@example.com',
+                                'c@example.com'], iter(['Subject: x\n']))
+    # only the transiently refused recipient is retried
+    script = ScriptedSender(
+      {'b@example.com': (451, 'greylisted'), 'c@example.com': (550, 'no')},
+      {})
+    future = RetryingSender(script, backoff=0.01).send(*msg)
+    self.assertEqual(future.result(timeout=10), {'c@example.com': (550, 'no')})
+    self.assertEqual(script.calls, [msg[1], ['b@example.com']])
+    # connection failures are retried until `maxAttempts`
+    error  = smtplib.SMTPConnectError(421, 'busy')
+    script = ScriptedSender(
+      smtplib.SMTPServerDisconnected('gone'), error, error)
+    future = RetryingSender(script, maxAttempts=3, backoff=0.01).send(
+      'from@example.com', ['a@example.com'], 'Subject: x\n')
+    self.assertIs(future.exception(timeout=10), error)
+    self.assertEqual(len(script.calls), 3)
+    # permanent failures are raised immediately
+    script = ScriptedSender(smtplib.SMTPSenderRefused(550, 'no', 'from'))
+    with self.assertRaises(smtplib.SMTPSenderRefused):
+      RetryingSender(script).send('from@example.com', 'a@example.com', 'x')
+    # ... unless the message was already delivered to some recipients
+    script = ScriptedSender(
+      {'b@example.com': (452, 'full')}, smtplib.SMTPDataError(554, 'spam'))
+    future = RetryingSender(script, backoff=0.01).send(
+      'from@example.com', ['a@example.com', 'b@example.com'], 'x')
+    self.assertEqual(future.result(timeout=10),
+                     {'b@example.com': (554, 'spam')})
+
+  #----------------------------------------------------------------------------
+  def test_retrying_backoff(self):
+    sender = RetryingSender(StoredSender(), backoff=10, maxBackoff=30)
+    for attempt, low, high in ((1, 5, 10), (2, 10, 20), (3, 15, 30),
+                               (10, 15, 30)):
+      for idx in range(20):
+        delay = sender.getDelay(attempt)
+        self.assertTrue(low <= delay <= high, (attempt, delay))
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
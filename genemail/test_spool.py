@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: Philip J Grabner <grabner@cadit.com>
+# date: 2013/12/02
+# copy: (C) Copyright 2013 Cadit Health Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+
+import unittest, tempfile, shutil, os, time, json, smtplib
+from StringIO import StringIO
+
+from .spool import Spool, SpoolSender
+from .sender import StoredSender
+from .test_sender import SinkServer
+from .test import stoptime, unstoptime
+
+try:
+  from . import cli
+except ImportError:
+  # note: `genemail.cli` requires a TemplateAlchemy with stream support
+  cli = None
+
+#------------------------------------------------------------------------------
+class FlakySender(StoredSender):
+  def __init__(self, errors, refused=None):
+    super(FlakySender, self).__init__()
+    self.errors  = errors
+    self.refused = refused or {}
+  def send(self, mailfrom, recipients, message):
+    if mailfrom in self.errors:
+      raise self.errors[mailfrom]
+    super(FlakySender, self).send(mailfrom, recipients, message)
+    return dict((rcpt, self.refused[rcpt])
+                for rcpt in recipients if rcpt in self.refused)
+
+#------------------------------------------------------------------------------
+class TestSpool(unittest.TestCase):
+
+  #----------------------------------------------------------------------------
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  #----------------------------------------------------------------------------
+  def listdir(self, sub):
+    return os.listdir(os.path.join(self.path, sub))
+
+  #----------------------------------------------------------------------------
+  def test_claim(self):
+    sender = SpoolSender(self.path)
+    name = sender.send('from@example.com', 'to@example.com', iter(['a\n', 'b']))
+    self.assertEqual(self.listdir('new'), [name])
+    self.assertEqual(self.listdir('tmp'), [])
+    other   = Spool(self.path)
+    entries = sender.spool.claim()
+    self.assertEqual(other.claim(), [])
+    self.assertEqual(len(entries), 1)
+    self.assertEqual(entries[0].mailfrom, 'from@example.com')
+    self.assertEqual(entries[0].recipients, ['to@example.com'])
+    self.assertEqual(entries[0].message, 'a\nb')
+    self.assertEqual(self.listdir('cur'), [name])
+    # a crashed claimer's messages are recovered once they are stale
+    self.assertEqual(other.recover(60), 0)
+    self.assertEqual(other.recover(-1), 1)
+    entries = other.claim()
+    other.release(entries[0])
+    entries = other.claim()
+    other.ack(entries[0])
+    for sub in ('tmp', 'new', 'cur', 'failed'):
+      self.assertEqual(self.listdir(sub), [])
+
+  #----------------------------------------------------------------------------
+  def test_drain(self):
+    spool = Spool(self.path)
+    for idx in range(4):
+      spool.put('from%d@example.com' % idx, ['to@example.com'], 'msg\n')
+      time.sleep(0.01)
+    sender = FlakySender({
+      'from1@example.com': smtplib.SMTPSenderRefused(550, 'no', 'from1'),
+      'from2@example.com': smtplib.SMTPSenderRefused(452, 'full', 'from2'),
+    })
+    # a deferred message is backed off without holding up the others
+    res = spool.drain(sender, batch=2)
+    self.assertEqual((res.sent, res.failed, res.deferred), (2, 1, 1))
+    self.assertEqual(len(self.listdir('failed')), 1)
+    self.assertEqual(len(self.listdir('new')), 1)
+    self.assertRegexpMatches(self.listdir('new')[0], r':1,\d+$')
+    res = spool.drain(sender)
+    self.assertEqual((res.sent, res.failed, res.deferred), (0, 0, 0))
+    sender.errors = {}
+    stoptime(time.time() + 61)
+    try:
+      res = spool.drain(sender)
+    finally:
+      unstoptime()
+    self.assertEqual((res.sent, res.failed, res.deferred), (1, 0, 0))
+    self.assertEqual(
+      [eml.mailfrom for eml in sender.emails],
+      ['from0@example.com', 'from3@example.com', 'from2@example.com'])
+    for sub in ('tmp', 'new', 'cur'):
+      self.assertEqual(self.listdir(sub), [])
+
+  #----------------------------------------------------------------------------
+  def test_drain_maxAttempts(self):
+    spool = Spool(self.path, maxAttempts=3, backoff=0)
+    spool.put('from@example.com', ['to@example.com'], 'msg\n')
+    sender = FlakySender({
+      'from@example.com': smtplib.SMTPSenderRefused(452, 'full', 'from')})
+    res = spool.drain(sender)
+    self.assertEqual((res.sent, res.failed, res.deferred), (0, 1, 2))
+    self.assertEqual(len(self.listdir('failed')), 1)
+    self.assertEqual(self.listdir('new'), [])
+
+  #----------------------------------------------------------------------------
+  def test_drain_refused(self):
+    spool = Spool(self.path)
+    rcpts = ['to@example.com', 'full@example.com', 'bad@example.com']
+    spool.put('from@example.com', rcpts, 'msg\n')
+    sender = FlakySender({}, refused={
+      'full@example.com': (451, 'mailbox full'),
+      'bad@example.com':  (550, 'no such user')})
+    res = spool.drain(sender)
+    self.assertEqual((res.sent, res.failed, res.deferred), (1, 1, 1))
+    # the permanently refused recipient is recorded...
+    failed = self.listdir('failed')
+    self.assertEqual(len(failed), 1)
+    with open(os.path.join(self.path, 'failed', failed[0]), 'rb') as fp:
+      self.assertEqual(json.loads(fp.readline()), dict(
+        mailfrom='from@example.com', recipients=['bad@example.com'],
+        refused={'bad@example.com': [550, 'no such user']}))
+      self.assertEqual(fp.read(), 'msg\n')
+    # ... and the message is retried for the transiently refused one
+    self.assertEqual(len(self.listdir('new')), 1)
+    sender.refused = {}
+    stoptime(time.time() + 61)
+    try:
+      entries = spool.claim()
+    finally:
+      unstoptime()
+    self.assertEqual(len(entries), 1)
+    self.assertEqual(entries[0].recipients, ['full@example.com'])
+    self.assertEqual(entries[0].attempts, 1)
+    self.assertEqual(entries[0].message, 'msg\n')
+
+  #----------------------------------------------------------------------------
+  def test_drain_connectionError(self):
+    spool = Spool(self.path)
+    names = []
+    for idx in range(3):
+      names.append(
+        spool.put('from%d@example.com' % idx, ['to@example.com'], 'msg\n'))
+      time.sleep(0.01)
+    sender = FlakySender({
+      'from1@example.com': smtplib.SMTPServerDisconnected('gone')})
+    res = spool.drain(sender)
+    self.assertEqual((res.sent, res.failed, res.deferred), (1, 0, 2))
+    # no delivery attempt is counted against the released messages
+    self.assertEqual(sorted(self.listdir('new')), names[1:])
+
+  #----------------------------------------------------------------------------
+  @unittest.skipIf(cli is None, '"genemail.cli" could not be imported')
+  def test_cli(self):
+    Spool(self.path).put('from@example.com', ['to@example.com'], 'msg\n')
+    sink = SinkServer()
+    sink.start()
+    try:
+      output = StringIO()
+      self.assertEqual(
+        cli.main(['drain', '--once', '-v', '--smtp-host', '127.0.0.1',
+                  '--smtp-port', str(sink.port), self.path], output=output),
+        0)
+    finally:
+      sink.stop()
+    self.assertEqual(output.getvalue(), 'sent: 1, failed: 0, deferred: 0\n')
+    self.assertEqual(sink.messages,
+                     [('from@example.com', ['to@example.com'], 'msg')])
+    self.assertEqual(self.listdir('cur'), [])
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
@@ -9,11 +9,15 @@
 
 from __future__ import absolute_import
 
-import re, codecs
+import re, codecs, hashlib
+import email.generator
 from StringIO import StringIO
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
-import cssutils, cssselect, xpath
+import cssutils
+from templatealchemy.util import adict
+
+from . import cssmatch
+from .cache import LruCache
 
 #------------------------------------------------------------------------------
 htmlns = 'http://www.w3.org/1999/xhtml'
@@ -34,12 +38,49 @@ def extractEmails(s):
     return None
   return emailRegex_cre.findall(s)
 
+#------------------------------------------------------------------------------
+stylesheetCache = LruCache(maxsize=64)
+def compileStylesheet(css):
+  '''
+  Parses the CSS stylesheet `css` and compiles all of its selectors,
+  returning an adict with a `rules` attribute, which is a list of
+  adicts with the following attributes:
+
+  * `selectors`:  a list of (specificity, matcher) tuples, where
+                  `matcher` is a :mod:`genemail.cssmatch` function.
+  * `properties`: a list of adicts with `name`, `value`, and
+                  `priority` attributes.
+
+  Compiled stylesheets are cached in the module-level LRU
+  `stylesheetCache` keyed by a hash of the CSS text; its `hits` and
+  `misses` attributes can be used to monitor its effectiveness.
+  '''
+  data = css.encode('utf-8') if isinstance(css, unicode) else css
+  key  = hashlib.sha1(data).hexdigest()
+  return stylesheetCache.get(key, lambda: _compileStylesheet(css))
+
+def _compileStylesheet(css):
+  sheet = cssutils.parseString(css)
+  rules = []
+  # TODO: filter rules simpler?, add @media
+  for rule in sheet:
+    if rule.type != rule.STYLE_RULE:
+      continue
+    rules.append(adict(
+      selectors  = [(selector.specificity,
+                     cssmatch.compileSelector(selector.selectorText))
+                    for selector in rule.selectorList],
+      properties = [adict(name=p.name, value=p.value, priority=p.priority)
+                    for p in rule.style],
+    ))
+  return adict(rules=rules)
+
 #------------------------------------------------------------------------------
 def getHtmlStyleView(document, css, media='all', name=None,
-                     styleCallback=lambda element: None):
+                     styleCallback=lambda element: None, exclude=None):
   """
   :param document:
-    a DOM element (must be minidom-compatible)
+    an ElementTree element (the root of the document)
   :param css:
     a CSS StyleSheet string
   :param media:
@@ -49,29 +90,30 @@ def getHtmlStyleView(document, css, media='all', name=None,
   :param styleCallback:
     [optional] should return css.CSSStyleDeclaration of inline styles,
     for html a style declaration for ``element@style``. Gets one
-    parameter ``element`` which is the relevant DOMElement
+    parameter ``element`` which is the relevant ElementTree element
+  :param exclude:
+    [optional] a set of elements that are not styled (e.g. because
+    they have already been styled)
 
   returns style view
-    a dict of {DOMElement: css.CSSStyleDeclaration} for html
+    a dict of {Element: css.CSSStyleDeclaration} for html
 
   shamelessly scrubbed from:
     http://cssutils.googlecode.com/svn/trunk/examples/style.py (``getView()``)
     ==> with an adjustment to get around a deprecationwarning in
         cssutils/css/cssstyledeclaration.py:598
-    ==> and an adjustment to use "xhtml" translator for the cssselector
+    ==> and an adjustment to match selectors directly against the
+        ElementTree document (see :mod:`genemail.cssmatch`)
     ==> and an adjustment to not use lxml
   """
 
-  sheet = cssutils.parseString(css)
-  css2xpath = cssselect.GenericTranslator()
+  sheet = compileStylesheet(css)
+  index = cssmatch.DocumentIndex(document)
   view = {}
   specificities = {} # needed temporarily
-  # TODO: filter rules simpler?, add @media
-  rules = (rule for rule in sheet if rule.type == rule.STYLE_RULE)
-  for rule in rules:
-    for selector in rule.selectorList:
-      xpe = css2xpath.css_to_xpath(selector.selectorText)
-      for element in xpath.find(xpe, document):
+  for rule in sheet.rules:
+    for specificity, matcher in rule.selectors:
+      for element in index.select(matcher, exclude):
         if element not in view:
           # add initial empty style declatation
           view[element] = cssutils.css.CSSStyleDeclaration()
@@ -83,20 +125,20 @@ def getHtmlStyleView(document, css, media='all', name=None,
               # set inline style specificity
               view[element].setProperty(p)
               specificities[element][p.name] = (1,0,0,0)
-        for p in rule.style:
+        for p in rule.properties:
           # update style declaration
-          if p not in view[element]:
+          if p.name not in view[element]:
             # setProperty needs a new Property object and
             # MUST NOT reuse the existing Property
             # which would be the same for all elements!
             # see Issue #23
             view[element].setProperty(p.name, p.value, p.priority)
-            specificities[element][p.name] = selector.specificity
+            specificities[element][p.name] = specificity
           else:
             sameprio = (p.priority ==
                   view[element].getPropertyPriority(p.name))
             if not sameprio and bool(p.priority) or (
-               sameprio and selector.specificity >=
+               sameprio and specificity >=
                     specificities[element][p.name]):
               # later, more specific or higher prio
               # NOTE: added explicit removeProperty to get around these warnings:
@@ -107,25 +149,27 @@ def getHtmlStyleView(document, css, media='all', name=None,
   return view
 
 #------------------------------------------------------------------------------
-# TODO: move this to use ET elements to remove the XML roundtrip...
 # TODO: this currently strips out the <!DOCTYPE> line if it appears, eg:
 #       <!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01//EN" "http://www.w3.org/TR/html4/strict.dtd">
-def inlineHtmlStyling_minidom(doc, css):
+def inlineHtmlStyling(etdoc, css, exclude=None):
+  '''
+  Inlines the CSS stylesheet `css` into the "style" attributes of the
+  ElementTree document `etdoc`. The document is modified in-place and
+  returned. Elements in the set `exclude` are left untouched, but
+  still participate in selector matching (e.g. for sibling
+  combinators).
+  '''
   def scb(element):
-    if element.hasAttribute('style'):
-      cssText = element.getAttribute('style')
+    cssText = cssmatch.getAttribute(element, 'style')
+    if cssText:
       return cssutils.css.CSSStyleDeclaration(cssText=cssText)
     return None
-  view = getHtmlStyleView(doc, css, styleCallback=scb)
+  view = getHtmlStyleView(etdoc, css, styleCallback=scb, exclude=exclude)
   for element, style in view.items():
-    v = style.getCssText(separator=u'')
-    element.setAttribute('style', v)
-  return doc
-def inlineHtmlStyling(etdoc, css):
-  html = serializeHtml(etdoc)
-  doc  = minidom.parseString(html)
-  ret  = inlineHtmlStyling_minidom(doc, css)
-  return parseXml(ret.toxml('UTF-8'))
+    if '{%s}style' % (htmlns,) in element.attrib:
+      del element.attrib['{%s}style' % (htmlns,)]
+    element.set('style', style.getCssText(separator=u''))
+  return etdoc
 
 #------------------------------------------------------------------------------
 def parseXml(data):
@@ -141,6 +185,84 @@ def parseXml(data):
   tree = etree.parse(src, parser=parser)
   return tree
 
+#------------------------------------------------------------------------------
+def selectCharset(text):
+  '''
+  Returns the first of the charsets "ascii", "iso-8859-1" and "utf-8"
+  that can represent `text` without loss. The charsets are tried in
+  that order because the `email` package then uses the most
+  human-readable transfer encoding possible (7bit, quoted-printable
+  and base64, respectively). `text` is scanned only once if it is a
+  unicode string; a byte string is assumed to be UTF-8 encoded if it
+  is valid UTF-8, and ISO-8859-1 encoded otherwise.
+  '''
+  if not text:
+    return 'ascii'
+  top = ord(max(text))
+  if top < 128:
+    return 'ascii'
+  if isinstance(text, unicode):
+    return 'iso-8859-1' if top < 256 else 'utf-8'
+  try:
+    text.decode('utf-8')
+    return 'utf-8'
+  except UnicodeDecodeError:
+    return 'iso-8859-1'
+
+#------------------------------------------------------------------------------
+def streamMessage(msg):
+  '''
+  Generates the serialized form of the :class:`email.message.Message`
+  `msg` as a sequence of string chunks, which, when joined, are
+  identical to ``msg.as_string()``. Unlike `as_string`, each MIME part
+  is serialized (and can be transmitted) separately, so the complete
+  message never needs to be held in memory as a single string. Parts
+  that provide an `iterPayload` method (such as
+  :class:`genemail.attachment.LazyMimePart`) have their payload
+  generated chunk by chunk as well.
+
+  Note that if a multipart message does not have a boundary set, a
+  random one is assigned before any output is generated; since the
+  part contents are not known at that point, it is not checked for
+  collisions (the standard generator's 64-bit random boundaries make
+  this a theoretical concern only).
+  '''
+  if hasattr(msg, 'iterPayload'):
+    buf = StringIO()
+    email.generator.Generator(buf)._write_headers(msg)
+    yield buf.getvalue()
+    for chunk in msg.iterPayload():
+      yield chunk
+    return
+  if not msg.is_multipart():
+    buf = StringIO()
+    email.generator.Generator(buf).flatten(msg)
+    yield buf.getvalue()
+    return
+  boundary = msg.get_boundary()
+  if not boundary:
+    boundary = email.generator._make_boundary()
+    msg.set_boundary(boundary)
+  buf = StringIO()
+  gen = email.generator.Generator(buf)
+  meth = getattr(msg, '_write_headers', None)
+  if meth is None:
+    gen._write_headers(msg)
+  else:
+    meth(gen)
+  if msg.preamble is not None:
+    buf.write(email.generator.fcre.sub('>From ', msg.preamble) + '\n')
+  buf.write('--' + boundary + '\n')
+  yield buf.getvalue()
+  for idx, part in enumerate(msg.get_payload()):
+    if idx > 0:
+      yield '\n--' + boundary + '\n'
+    for chunk in streamMessage(part):
+      yield chunk
+  yield '\n--' + boundary + '--\n'
+  if msg.epilogue is not None:
+    yield email.generator.fcre.sub('>From ', msg.epilogue)
+
 #------------------------------------------------------------------------------
 def serializeHtml(xdoc):
   '''
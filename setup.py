@@ -29,7 +29,6 @@ dependencies = [
   'TemplateAlchemy      >= 0.1.21',
   'cssutils             >= 0.9.10b1',
   'cssselect            >= 0.7.1',
-  'py-dom-xpath         >= 0.1',
   'html2text            >= 3.200.3',
   'globre               >= 0.1.3',
   'asset                >= 0.6.3',